@@ -6,6 +6,7 @@ import time
 import subprocess
 import sys
 import os
+import json
 
 # Debug: Log script startup
 import datetime
@@ -20,6 +21,24 @@ LAUNCHER_SCRIPT = "launcher_old.py"
 PYTHON_EXEC = sys.executable
 
 CHECK_INTERVAL = 180  # Seconds, auto polling interval
+# JSON metrics snapshot written by the launcher (METRICS_SNAPSHOT_PATH)
+METRICS_SNAPSHOT = os.getenv("METRICS_SNAPSHOT_PATH", "metrics.json")
+
+def metrics_summary():
+    """Short status from the launcher's metrics snapshot, or '' when there is none."""
+    try:
+        with open(METRICS_SNAPSHOT, encoding="utf-8") as f:
+            snap = json.load(f)
+    except (OSError, ValueError):
+        return ""
+    hists = snap.get("histograms", {})
+    classified = sum(h["count"] for name, h in hists.items() if name.startswith("aiemail_classify_seconds"))
+    sent = snap.get("counters", {}).get('aiemail_forwards_total{result="sent"}', 0)
+    llm = hists.get('aiemail_classify_seconds{source="llm"}', {})
+    text = f"已分类 {classified} · 已转发 {sent}"
+    if llm.get("count"):
+        text += f" · LLM {llm['avg_ms']:.0f}ms"
+    return text
 
 def create_image(color):
     image = Image.new('RGB', (64, 64), color)
@@ -119,6 +138,11 @@ class TrayControl:
                 self.pause_until = None
                 self.icon.icon = create_image('green')
                 self.icon.title = "AI邮件服务自动轮询中"
+            elif not self.pause_event.is_set():
+                summary = metrics_summary()
+                if summary:
+                    status = "正在运行分类/转发..." if self.is_running else "AI邮件服务自动轮询中"
+                    self.icon.title = f"{status}\n{summary}"
             time.sleep(3)
 
     def run(self):
@@ -0,0 +1,249 @@
+# benchmarks/bench_e2e.py
+# End-to-end benchmark, fully offline: a generated mailbox is served by local fake
+# IMAP, Ollama and Gmail API servers (benchmarks/fakes.py) and launcher_old.py or
+# main.py is run against them as a child process.
+#
+#   python benchmarks/bench_e2e.py [--messages 500] [--mode launcher|main] [--ollama-first-token-ms 20]
+#
+# Reports messages per second, IMAP / Ollama / Gmail round-trips per message and the
+# child's peak RSS. Needs the normal runtime dependencies (imapclient, google-api-python-client).
+import argparse
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from email import policy
+from email.message import EmailMessage
+from email.utils import formataddr, formatdate, make_msgid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fakes import FakeImapServer, FakeOllamaServer, FakeGmailServer, Mailbox  # noqa: E402
+
+PROCESSED = 'Processed'
+
+WORDS = (
+    "the a to of and in for on with at from by about as into like through after over between out "
+    "meeting project update invoice order account payment delivery schedule report review team "
+    "please find attached below thanks regards offer sale discount newsletter week news event "
+    "interview position application deadline shipment receipt subscription renewal password"
+).split()
+CJK = "您好附件是本周的项目进度报告请查收订单已发货感谢您的购买会议时间调整为下周三欢迎参加活动"
+SENDERS = [
+    ("Alice Chen", "alice@example.com"), ("Billing", "billing@shop.example"),
+    ("Weekly News", "news@media.example"), ("Team Lead", "lead@work.example"),
+    ("No Reply", "no-reply@service.example"), ("Jobs", "alerts@jobs.example"),
+    ("王小明", "xiaoming@example.cn"), ("Bank", "notice@bank.example"),
+]
+FOOTER = ("You are receiving this email because you subscribed to our newsletter.\n"
+          "Unsubscribe: https://click.media.example/u?id={n}&t=8f3a9c | Manage preferences | Privacy policy\n"
+          "© 2024 Media Example Inc. All rights reserved.")
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _paragraphs(rng, n, cjk=False):
+    out = []
+    for _ in range(n):
+        if cjk:
+            out.append(''.join(rng.choice(CJK) for _ in range(rng.randint(40, 160))))
+        else:
+            out.append(_text(rng, rng.randint(30, 120)).capitalize() + '.')
+    return '\n\n'.join(out)
+
+
+def _html(rng, n, text):
+    links = ''.join(f'<a href="https://click.media.example/r/{rng.getrandbits(64):x}?u={i}">{_text(rng, 3)}</a> '
+                    for i in range(rng.randint(5, 30)))
+    rows = ''.join(f'<tr><td style="padding:8px;font-family:Arial">{_text(rng, rng.randint(10, 40))}</td></tr>'
+                   for _ in range(rng.randint(10, 60)))
+    return (f'<html><head><style>td{{color:#333}} .x{{display:none}}</style></head><body>'
+            f'<div class="x">{_text(rng, 20)}</div><table>{rows}</table><p>{text}</p><p>{links}</p>'
+            f'<p>{FOOTER.format(n=n)}</p><img src="https://pixel.media.example/o/{n}.gif"></body></html>')
+
+
+def make_message(rng, n, attachment_kb):
+    """One generated message; the kind decides structure, charset and transfer encoding."""
+    name, addr = rng.choice(SENDERS)
+    msg = EmailMessage()
+    msg['From'] = formataddr((name, addr))
+    msg['To'] = 'bench@example.com'
+    msg['Date'] = formatdate(1700000000 + n * 60)
+    msg['Message-ID'] = make_msgid(domain='bench.example')
+    kind = rng.random()
+    cjk = addr.endswith('.cn')
+    msg['Subject'] = (''.join(rng.choice(CJK) for _ in range(12)) if cjk
+                      else _text(rng, rng.randint(3, 9)).capitalize())
+    if kind < 0.40:
+        # Plain text, sometimes a reply with quoted history and a signature
+        body = _paragraphs(rng, rng.randint(1, 5), cjk)
+        if rng.random() < 0.5:
+            quoted = '\n'.join('> ' + line for line in _paragraphs(rng, rng.randint(2, 8)).split('\n'))
+            body += f"\n\nOn Mon, 1 Jan 2024, {name} <{addr}> wrote:\n{quoted}"
+        body += f"\n\n-- \n{name}\n{_text(rng, 8)}"
+        msg.set_content(body, charset='utf-8', cte='base64' if cjk else 'quoted-printable')
+    else:
+        # Newsletter: stub text/plain next to a large text/html part
+        text = _paragraphs(rng, rng.randint(1, 3), cjk)
+        msg.set_content('View this email in your browser: https://media.example/v/%d' % n,
+                        cte='quoted-printable')
+        msg.add_alternative(_html(rng, n, text), subtype='html', charset='utf-8',
+                            cte='base64' if cjk or rng.random() < 0.3 else 'quoted-printable')
+    if kind >= 0.75 and attachment_kb:
+        # Attachments are never needed for classification (partial fetch skips them)
+        size = rng.randint(attachment_kb // 4, attachment_kb) * 1024
+        maintype, subtype, ext = rng.choice([('application', 'pdf', 'pdf'), ('image', 'png', 'png'),
+                                             ('application', 'zip', 'zip')])
+        msg.add_attachment(rng.randbytes(size), maintype=maintype, subtype=subtype, filename=f'file{n}.{ext}')
+    return msg.as_bytes(policy=policy.SMTP)
+
+
+def make_corpus(n, seed=1, unread=0.3, attachment_kb=256):
+    """[(raw bytes, seen)] for n messages; `unread` is the share without \\Seen."""
+    rng = random.Random(seed)
+    return [(make_message(rng, i, attachment_kb), rng.random() >= unread) for i in range(n)]
+
+
+def peak_rss_mb():
+    """Largest peak RSS among waited-for child processes (POSIX only)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return kb / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def child_env(workdir, imap, ollama, gmail, extra=()):
+    env = dict(os.environ)
+    env.update({
+        'IMAP_HOST': '127.0.0.1', 'IMAP_PORT': str(imap.port), 'IMAP_SSL': 'false',
+        'IMAP_USER': 'bench@example.com', 'IMAP_PASS': 'bench', 'ACCOUNTS_FILE': '',
+        'PROCESSED_CAT': PROCESSED, 'REPORT_TO': 'report@example.com',
+        'OLLAMA_HOST': '127.0.0.1', 'OLLAMA_PORT': str(ollama.port), 'MODEL_NAME': 'bench',
+        'GMAIL_API_ENDPOINT': gmail.url, 'GMAIL_TOKEN_PATH': os.path.join(workdir, 'token.pickle'),
+        'DB_PATH': os.path.join(workdir, 'bench.db'),
+        # Every message goes to the model: no cache hits, no sender shortcuts
+        'CACHE_ENABLED': 'false', 'REPUTATION_ENABLED': 'false', 'KNN_ENABLED': 'false',
+        'NB_ENABLED': 'false',
+        'IDLE_ENABLED': 'true', 'METRICS_PORT': '0',
+        'METRICS_SNAPSHOT_PATH': os.path.join(workdir, 'metrics.json'),
+        'PYTHONUNBUFFERED': '1',
+    })
+    env.update(extra)
+    return env
+
+
+def write_token(path):
+    """An access token that never expires, so no OAuth flow is started."""
+    from google.oauth2.credentials import Credentials
+    with open(path, 'wb') as f:
+        pickle.dump(Credentials(token='bench-token'), f)
+
+
+def run(args):
+    t0 = time.perf_counter()
+    corpus = make_corpus(args.messages, args.seed, args.unread, args.attachment_kb)
+    mailbox = Mailbox()
+    for raw, seen in corpus:
+        mailbox.add(raw, seen=seen)
+    corpus_mb = sum(len(raw) for raw, _ in corpus) / 2 ** 20
+    print(f"corpus:          {args.messages} messages, {corpus_mb:.1f} MB "
+          f"(generated in {time.perf_counter() - t0:.1f}s)")
+
+    imap = FakeImapServer(mailbox).start()
+    ollama = FakeOllamaServer(first_token_ms=args.ollama_first_token_ms, prompt_ms_per_1k=args.ollama_prompt_ms,
+                              token_ms=args.ollama_token_ms, parallel=args.ollama_parallel).start()
+    gmail = FakeGmailServer(mailbox).start()
+
+    with tempfile.TemporaryDirectory(prefix='bench_e2e_') as workdir:
+        write_token(os.path.join(workdir, 'token.pickle'))
+        env = child_env(workdir, imap, ollama, gmail, dict(v.split('=', 1) for v in args.env))
+        if args.mode == 'launcher':
+            cmd = [sys.executable, 'launcher_old.py', '--include-history']
+        else:
+            cmd = [sys.executable, 'main.py', '--uids', ','.join(map(str, sorted(mailbox.messages)))]
+        log_path = os.path.join(workdir, 'child.log')
+        with open(log_path, 'wb') as log:
+            start = time.perf_counter()
+            proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+            done = None
+            deadline = start + args.timeout
+            while time.perf_counter() < deadline:
+                if proc.poll() is not None:
+                    done = time.perf_counter()
+                    break
+                # The launcher enters IDLE once a round has nothing left to do
+                if (args.mode == 'launcher' and mailbox.idle_event.is_set()
+                        and mailbox.count_with_label(PROCESSED) == args.messages):
+                    done = time.perf_counter()
+                    break
+                time.sleep(0.02)
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        elapsed = (done or time.perf_counter()) - start
+        processed = mailbox.count_with_label(PROCESSED)
+        if done is None or processed < args.messages:
+            with open(log_path, 'rb') as f:
+                tail = f.read()[-3000:].decode('utf-8', 'replace')
+            print(f"[ERROR] {processed}/{args.messages} messages processed "
+                  f"({'timeout' if done is None else f'exit code {proc.returncode}'}); log tail:\n{tail}")
+        if args.keep_log:
+            with open(log_path, 'rb') as src, open(args.keep_log, 'wb') as dst:
+                dst.write(src.read())
+
+    working = (done or time.perf_counter()) - mailbox.first_command if mailbox.first_command else elapsed
+    n = max(1, processed)
+    imap_total = sum(mailbox.commands.values())
+    chat = ollama.requests['/api/chat'] + ollama.requests['/api/generate']
+    gmail_http = gmail.requests['batch'] + gmail.requests['single']
+    gmail_calls = gmail.requests['POST send'] + gmail.requests['GET get']
+    top = ', '.join(f'{name} {count}' for name, count in mailbox.commands.most_common(6))
+    rss = peak_rss_mb()
+
+    ollama.stop()
+    gmail.stop()
+    imap.stop()
+
+    print(f"mode:            {args.mode} ({' '.join(cmd[1:2])})")
+    print(f"processed:       {processed}/{args.messages}")
+    print(f"wall time:       {elapsed:.2f}s  ({processed / elapsed:.1f} msg/s incl. startup)")
+    print(f"processing time: {working:.2f}s  ({processed / working:.1f} msg/s from first FETCH/SEARCH)")
+    print(f"IMAP:            {imap_total} commands ({imap_total / n:.2f}/msg), "
+          f"{mailbox.bytes_sent / 2 ** 20:.1f} MB sent ({mailbox.bytes_sent / n / 1024:.1f} KB/msg)")
+    print(f"                 {top}")
+    print(f"Ollama:          {chat} requests ({chat / n:.2f}/msg), {ollama.cancelled} streams abandoned")
+    print(f"Gmail API:       {gmail_http} HTTP requests ({gmail_http / n:.3f}/msg) for {gmail_calls} calls, "
+          f"{len(gmail.sent)} forwards")
+    print(f"peak RSS:        {f'{rss:.0f} MB' if rss is not None else 'n/a'} (child process)")
+    return 0 if processed == args.messages else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark with fake IMAP/Ollama/Gmail servers")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--mode", choices=("launcher", "main"), default="launcher",
+                        help="launcher: launcher_old.py pipeline incl. forwarding; main: main.py --uids (no forwarding)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--unread", type=float, default=0.3, help="Share of unread messages")
+    parser.add_argument("--attachment-kb", type=int, default=256, help="Max attachment size (0 = none)")
+    parser.add_argument("--ollama-first-token-ms", type=float, default=20.0)
+    parser.add_argument("--ollama-prompt-ms", type=float, default=5.0, help="Prompt eval ms per 1000 characters")
+    parser.add_argument("--ollama-token-ms", type=float, default=8.0, help="ms per generated token")
+    parser.add_argument("--ollama-parallel", type=int, default=4, help="Concurrent generations (OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra environment for the child, e.g. --env FETCH_MODE=full")
+    parser.add_argument("--keep-log", help="Copy the child's output to this file")
+    sys.exit(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
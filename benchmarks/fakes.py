@@ -0,0 +1,677 @@
+# benchmarks/fakes.py
+# Local stand-ins for the services the classifier talks to, for offline benchmarks:
+#   FakeImapServer   - enough IMAP4rev1 (+ IDLE, X-GM-LABELS, X-GM-MSGID, X-GM-RAW) for launcher_old/main.py
+#   FakeOllamaServer - /api/chat and /api/generate with configurable prompt/token latency
+#   FakeGmailServer  - Gmail API batch endpoint with messages.get(format=raw) and messages.send
+# Every server counts the requests it handles, so round-trips per message can be reported.
+import base64
+import email
+import json
+import re
+import socketserver
+import threading
+import time
+import zlib
+from collections import Counter
+from email import policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------------------------------------------- IMAP
+
+CAPABILITIES = 'IMAP4rev1 IDLE X-GM-EXT-1 UIDPLUS'
+
+
+def _quote(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _tokens(text):
+    """Split IMAP arguments at top level: atoms, "quoted" strings, (lists) and atoms[with sections]<n>."""
+    tokens = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == ' ':
+            i += 1
+        elif c == '"':
+            j = i + 1
+            out = []
+            while text[j] != '"':
+                if text[j] == '\\':
+                    j += 1
+                out.append(text[j])
+                j += 1
+            tokens.append(''.join(out))
+            i = j + 1
+        else:
+            depth = 0
+            j = i
+            while j < len(text) and (depth or text[j] != ' '):
+                if text[j] in '([':
+                    depth += 1
+                elif text[j] in ')]':
+                    depth -= 1
+                j += 1
+            tokens.append(text[i:j])
+            i = j
+    return tokens
+
+
+def _unparen(token):
+    return token[1:-1] if token.startswith('(') and token.endswith(')') else token
+
+
+def _header_block(raw):
+    end = raw.find(b'\r\n\r\n')
+    return raw[:end + 4] if end >= 0 else raw
+
+
+def _header_fields(raw, names, exclude=False):
+    """HEADER.FIELDS (names) of a message: matching header lines plus the blank line."""
+    lines = _header_block(raw).split(b'\r\n')
+    out = []
+    keep = False
+    for line in lines:
+        if not line:
+            continue
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                out.append(line)
+            continue
+        name = line.split(b':', 1)[0].decode('ascii', 'ignore').upper()
+        keep = (name in names) != exclude
+        if keep:
+            out.append(line)
+    return b'\r\n'.join(out) + b'\r\n\r\n'
+
+
+class StoredMessage:
+    """One message in the fake mailbox, with its BODYSTRUCTURE and section bodies precomputed."""
+
+    def __init__(self, uid, raw, seen=False, labels=(), msgid=None):
+        self.uid = uid
+        self.raw = raw
+        self.flags = {'\\Seen'} if seen else set()
+        self.labels = set(labels)
+        self.msgid = msgid if msgid is not None else 1600000000000000000 + uid
+        msg = email.message_from_bytes(raw, policy=policy.compat32)
+        self.sections = {}
+        self.bodystructure = self._structure(msg, '')
+
+    def _payload(self, part):
+        payload = part.get_payload()
+        data = payload.encode('ascii', 'surrogateescape') if isinstance(payload, str) else b''
+        return data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+
+    def _structure(self, part, prefix):
+        if part.is_multipart():
+            subs = ''.join(self._structure(p, f'{prefix}.{i}' if prefix else str(i))
+                           for i, p in enumerate(part.get_payload(), 1))
+            return (f'({subs} {_quote(part.get_content_subtype().upper())} '
+                    f'("BOUNDARY" {_quote(part.get_boundary() or "")}) NIL NIL)')
+        section = prefix or '1'
+        body = self._payload(part)
+        self.sections[section] = body
+        params = part.get_params(header='content-type') or []
+        params = ' '.join(f'{_quote(k.upper())} {_quote(v)}' for k, v in params[1:] if isinstance(v, str))
+        encoding = (part.get('Content-Transfer-Encoding') or '7BIT').strip().upper()
+        fields = (f'{_quote(part.get_content_maintype().upper())} {_quote(part.get_content_subtype().upper())} '
+                  f'{"(" + params + ")" if params else "NIL"} NIL NIL {_quote(encoding)} {len(body)}')
+        if part.get_content_maintype() == 'text':
+            fields += ' %d' % (body.count(b'\n') + 1)
+        disposition = 'NIL'
+        if part.get_content_disposition():
+            filename = part.get_filename()
+            params = '("FILENAME" %s)' % _quote(filename) if filename else 'NIL'
+            disposition = f'({_quote(part.get_content_disposition().upper())} {params})'
+        return f'({fields} NIL {disposition} NIL NIL)'
+
+    def section(self, spec):
+        """Bytes of BODY[spec]."""
+        spec = spec.upper()
+        if spec == '':
+            return self.raw
+        if spec == 'HEADER':
+            return _header_block(self.raw)
+        if spec == 'TEXT':
+            return self.raw[len(_header_block(self.raw)):]
+        m = re.match(r'HEADER\.FIELDS(\.NOT)?\s*\((.*)\)$', spec)
+        if m:
+            return _header_fields(self.raw, set(m.group(2).split()), exclude=bool(m.group(1)))
+        return self.sections.get(spec, b'')
+
+
+class Mailbox:
+    """Shared state of the fake account: messages, labels and request counters."""
+
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = {}
+        self.folders = {'INBOX'}
+        self.lock = threading.RLock()
+        self.commands = Counter()
+        self.bytes_sent = 0
+        self.first_command = None
+        self.idle_event = threading.Event()
+        self.on_idle = None
+
+    def add(self, raw, seen=False, labels=()):
+        with self.lock:
+            uid = max(self.messages, default=0) + 1
+            self.messages[uid] = StoredMessage(uid, raw, seen, labels)
+            return uid
+
+    @property
+    def uidnext(self):
+        return max(self.messages, default=0) + 1
+
+    def by_msgid(self, msgid):
+        with self.lock:
+            return next((m for m in self.messages.values() if m.msgid == msgid), None)
+
+    def count_with_label(self, label):
+        with self.lock:
+            return sum(1 for m in self.messages.values() if label in m.labels)
+
+    def uid_range(self, spec):
+        """UIDs matching a sequence set such as 1:5,7,9:*."""
+        uids = sorted(self.messages)
+        top = uids[-1] if uids else 0
+        wanted = set()
+        for item in spec.split(','):
+            if ':' in item:
+                lo, hi = item.split(':')
+                lo = top if lo == '*' else int(lo)
+                hi = top if hi == '*' else int(hi)
+                # n:* with n past the end still matches the last message
+                lo, hi = min(lo, hi), max(lo, hi)
+                wanted.update(u for u in uids if lo <= u <= hi)
+            else:
+                uid = top if item == '*' else int(item)
+                if uid in self.messages:
+                    wanted.add(uid)
+        return sorted(wanted)
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.wfile.write(data)
+        self.server.mailbox.bytes_sent += len(data)
+
+    def read_command(self):
+        """One command line with any {n} literals inlined (as quoted text)."""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        parts = []
+        while True:
+            text = line.rstrip(b'\r\n')
+            m = re.search(rb'\{(\d+)\+?\}$', text)
+            if not m:
+                parts.append(text)
+                break
+            parts.append(text[:m.start()])
+            if not text.endswith(b'+}'):
+                self.send('+ Ready for literal\r\n')
+                self.wfile.flush()
+            literal = self.rfile.read(int(m.group(1)))
+            parts.append(b'"' + literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"')
+            line = self.rfile.readline()
+        return b''.join(parts).decode('utf-8', 'replace')
+
+    def handle(self):
+        self.selected = False
+        self.send(f'* OK [CAPABILITY {CAPABILITIES}] Fake IMAP ready\r\n')
+        self.wfile.flush()
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            tag, _, rest = line.partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            uid = command == 'UID'
+            if uid:
+                command, _, args = args.partition(' ')
+                command = command.upper()
+            mailbox = self.server.mailbox
+            name = f'UID {command}' if uid else command
+            mailbox.commands[name] += 1
+            if mailbox.first_command is None and command in ('FETCH', 'SEARCH', 'STORE'):
+                mailbox.first_command = time.monotonic()
+            handler = getattr(self, 'do_' + command, None)
+            try:
+                if handler is None:
+                    self.send(f'{tag} BAD Unknown command {command}\r\n')
+                elif handler(tag, args) is False:
+                    self.wfile.flush()
+                    return
+            except Exception as e:
+                self.send(f'{tag} BAD {type(e).__name__}: {e}\r\n')
+            self.wfile.flush()
+
+    def do_CAPABILITY(self, tag, args):
+        self.send(f'* CAPABILITY {CAPABILITIES}\r\n{tag} OK CAPABILITY completed\r\n')
+
+    def do_LOGIN(self, tag, args):
+        self.send(f'{tag} OK [CAPABILITY {CAPABILITIES}] Logged in\r\n')
+
+    def do_NOOP(self, tag, args):
+        self.send(f'{tag} OK NOOP completed\r\n')
+
+    def do_LOGOUT(self, tag, args):
+        self.send(f'* BYE Logging out\r\n{tag} OK LOGOUT completed\r\n')
+        return False
+
+    def do_LIST(self, tag, args):
+        with self.server.mailbox.lock:
+            folders = sorted(self.server.mailbox.folders)
+        for folder in folders:
+            self.send(f'* LIST (\\HasNoChildren) "/" {_quote(folder)}\r\n')
+        self.send(f'{tag} OK LIST completed\r\n')
+
+    def do_CREATE(self, tag, args):
+        with self.server.mailbox.lock:
+            self.server.mailbox.folders.add(_tokens(args)[0])
+        self.send(f'{tag} OK CREATE completed\r\n')
+
+    def do_SELECT(self, tag, args):
+        mailbox = self.server.mailbox
+        with mailbox.lock:
+            exists, uidnext = len(mailbox.messages), mailbox.uidnext
+        self.selected = True
+        self.send(f'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n'
+                  f'* {exists} EXISTS\r\n* 0 RECENT\r\n'
+                  f'* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n'
+                  f'* OK [UIDNEXT {uidnext}] Predicted next UID\r\n'
+                  f'{tag} OK [READ-WRITE] SELECT completed\r\n')
+
+    do_EXAMINE = do_SELECT
+
+    def do_IDLE(self, tag, args):
+        self.send('+ idling\r\n')
+        self.wfile.flush()
+        mailbox = self.server.mailbox
+        mailbox.idle_event.set()
+        if mailbox.on_idle is not None:
+            mailbox.on_idle()
+        while True:
+            line = self.rfile.readline()
+            if not line or line.strip().upper() == b'DONE':
+                break
+        mailbox.idle_event.clear()
+        if line:
+            self.send(f'{tag} OK IDLE terminated\r\n')
+
+    def _search(self, criteria):
+        mailbox = self.server.mailbox
+        with mailbox.lock:
+            result = set(mailbox.messages)
+            i = 0
+            while i < len(criteria):
+                key = criteria[i].upper()
+                if key == 'ALL':
+                    pass
+                elif key in ('UNSEEN', 'SEEN'):
+                    seen = {u for u, m in mailbox.messages.items() if '\\Seen' in m.flags}
+                    result &= seen if key == 'SEEN' else set(mailbox.messages) - seen
+                elif key == 'UID':
+                    i += 1
+                    result &= set(mailbox.uid_range(criteria[i]))
+                elif key == 'X-GM-LABELS':
+                    i += 1
+                    result &= {u for u, m in mailbox.messages.items()
+                               if any(l.lower() == criteria[i].lower() for l in m.labels)}
+                elif key == 'X-GM-RAW':
+                    # Only "label:X" / "-label:X" terms, as used for the Processed label
+                    i += 1
+                    for term in criteria[i].split():
+                        negate = term.startswith('-')
+                        label = term.lstrip('-')
+                        if not label.lower().startswith('label:'):
+                            continue
+                        label = label[6:].replace('-', ' ')
+                        has = {u for u, m in mailbox.messages.items()
+                               if any(l.lower() == label.lower() for l in m.labels)}
+                        result = result - has if negate else result & has
+                else:
+                    raise ValueError(f'unsupported search key {key}')
+                i += 1
+        return sorted(result)
+
+    def do_SEARCH(self, tag, args):
+        criteria = [_unparen(t) for t in _tokens(args)]
+        if criteria and criteria[0].upper() == 'CHARSET':
+            criteria = criteria[2:]
+        uids = self._search(criteria)
+        self.send(f'* SEARCH {" ".join(map(str, uids))}\r\n{tag} OK SEARCH completed\r\n')
+
+    def do_FETCH(self, tag, args):
+        mailbox = self.server.mailbox
+        tokens = _tokens(args)
+        items = _tokens(_unparen(tokens[1]))
+        with mailbox.lock:
+            uids = mailbox.uid_range(tokens[0])
+            seqs = {u: i for i, u in enumerate(sorted(mailbox.messages), 1)}
+            out = []
+            for uid in uids:
+                msg = mailbox.messages[uid]
+                fields = [f'UID {uid}']
+                for item in items:
+                    upper = item.upper()
+                    if upper == 'UID':
+                        continue
+                    if upper == 'FLAGS':
+                        fields.append(f'FLAGS ({" ".join(sorted(msg.flags))})')
+                    elif upper == 'X-GM-LABELS':
+                        fields.append(f'X-GM-LABELS ({" ".join(_quote(l) for l in sorted(msg.labels))})')
+                    elif upper == 'X-GM-MSGID':
+                        fields.append(f'X-GM-MSGID {msg.msgid}')
+                    elif upper == 'X-GM-THRID':
+                        fields.append(f'X-GM-THRID {msg.msgid}')
+                    elif upper in ('BODYSTRUCTURE', 'BODY'):
+                        fields.append(f'{upper} {msg.bodystructure}')
+                    elif upper == 'RFC822.SIZE':
+                        fields.append(f'RFC822.SIZE {len(msg.raw)}')
+                    elif upper in ('RFC822', 'BODY[]', 'BODY.PEEK[]') or upper.startswith(('BODY[', 'BODY.PEEK[')):
+                        m = re.match(r'BODY(?:\.PEEK)?\[(.*?)\](?:<(\d+)\.(\d+)>)?$', item, re.IGNORECASE) \
+                            if upper != 'RFC822' else None
+                        spec, origin, count = (m.group(1), m.group(2), m.group(3)) if m else ('', None, None)
+                        data = msg.section(spec)
+                        name = f'BODY[{spec.upper()}]' if upper != 'RFC822' else 'RFC822'
+                        if origin is not None:
+                            data = data[int(origin):int(origin) + int(count)]
+                            name += f'<{origin}>'
+                        if '.PEEK' not in upper:
+                            msg.flags.add('\\Seen')
+                        fields.append((f'{name} {{{len(data)}}}', data))
+                    else:
+                        raise ValueError(f'unsupported fetch item {item}')
+                out.append((seqs[uid], fields))
+        for seq, fields in out:
+            chunks = [f'* {seq} FETCH (']
+            for i, field in enumerate(fields):
+                sep = ' ' if i else ''
+                if isinstance(field, tuple):
+                    chunks.append(f'{sep}{field[0]}\r\n')
+                    chunks.append(field[1])
+                else:
+                    chunks.append(f'{sep}{field}')
+            chunks.append(')\r\n')
+            self.send(b''.join(c.encode() if isinstance(c, str) else c for c in chunks))
+        self.send(f'{tag} OK FETCH completed\r\n')
+
+    def do_STORE(self, tag, args):
+        mailbox = self.server.mailbox
+        tokens = _tokens(args)
+        action = tokens[1].upper()
+        values = _tokens(_unparen(' '.join(tokens[2:])))
+        silent = action.endswith('.SILENT')
+        action = action.replace('.SILENT', '')
+        with mailbox.lock:
+            uids = mailbox.uid_range(tokens[0])
+            for uid in uids:
+                msg = mailbox.messages[uid]
+                target = msg.labels if 'X-GM-LABELS' in action else msg.flags
+                if action.startswith('+'):
+                    target.update(values)
+                elif action.startswith('-'):
+                    target.difference_update(values)
+                else:
+                    target.clear()
+                    target.update(values)
+            seqs = {u: i for i, u in enumerate(sorted(mailbox.messages), 1)}
+            if not silent:
+                for uid in uids:
+                    msg = mailbox.messages[uid]
+                    self.send(f'* {seqs[uid]} FETCH (UID {uid} FLAGS ({" ".join(sorted(msg.flags))}))\r\n')
+        self.send(f'{tag} OK STORE completed\r\n')
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeImapServer:
+    """Plain-text IMAP server on 127.0.0.1 serving one Mailbox (any login is accepted)."""
+
+    def __init__(self, mailbox, port=0):
+        self.mailbox = mailbox
+        self.server = _ThreadingTCPServer(('127.0.0.1', port), _ImapHandler)
+        self.server.mailbox = mailbox
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-imap', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ---------------------------------------------------------------- HTTP helpers
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _HttpServer:
+    handler = None
+
+    def __init__(self, port=0):
+        self.requests = Counter()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler)
+        self.server.daemon_threads = True
+        self.server.owner = self
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ---------------------------------------------------------------- Ollama
+
+# Default answer set when a request has no enum schema
+DEFAULT_CATEGORIES = ['Work', 'Personal', 'Transaction', 'Promotion', 'Update', 'Opportunities', 'LowPriority']
+
+
+class _OllamaHandler(_QuietHandler):
+    def do_POST(self):
+        owner = self.server.owner
+        payload = json.loads(self.read_body() or b'{}')
+        owner.requests[self.path] += 1
+        if self.path == '/api/generate' and not payload.get('prompt'):
+            # Load / unload request
+            self.send_json({'model': payload.get('model'), 'response': '', 'done': True})
+            return
+        if self.path not in ('/api/chat', '/api/generate'):
+            self.send_json({'error': 'not found'}, status=404)
+            return
+        with owner.slots:
+            owner.answer(self, payload)
+
+    def do_GET(self):
+        self.server.owner.requests[self.path] += 1
+        self.send_json({'models': []})
+
+
+class FakeOllamaServer(_HttpServer):
+    """
+    Ollama-compatible stub. The answer is a schema-enum category picked from a hash
+    of the prompt, after prompt_ms_per_1k ms per 1000 prompt characters plus
+    first_token_ms, then token_ms per streamed output token. parallel limits
+    concurrent generations like OLLAMA_NUM_PARALLEL.
+    """
+    handler = _OllamaHandler
+
+    def __init__(self, port=0, first_token_ms=20.0, prompt_ms_per_1k=5.0, token_ms=8.0, parallel=4):
+        super().__init__(port)
+        self.first_token_ms = first_token_ms
+        self.prompt_ms_per_1k = prompt_ms_per_1k
+        self.token_ms = token_ms
+        self.slots = threading.BoundedSemaphore(max(1, parallel))
+        self.cancelled = 0
+
+    def answer(self, handler, payload):
+        if 'messages' in payload:
+            prompt = '\n'.join(m.get('content', '') for m in payload['messages'])
+            user = payload['messages'][-1].get('content', '')
+        else:
+            prompt = user = payload.get('prompt', '')
+        enum = (((payload.get('format') or {}).get('properties') or {}).get('category') or {}).get('enum') \
+            if isinstance(payload.get('format'), dict) else None
+        categories = enum or DEFAULT_CATEGORIES
+        category = categories[zlib.crc32(user.encode('utf-8', 'ignore')) % len(categories)]
+        answer = json.dumps({'category': category})
+        pieces = [answer[i:i + 4] for i in range(0, len(answer), 4)]
+        chat = 'messages' in payload
+        start = time.perf_counter()
+        time.sleep((self.first_token_ms + self.prompt_ms_per_1k * len(prompt) / 1000) / 1000)
+        prompt_eval = time.perf_counter() - start
+        final = {'model': payload.get('model'), 'done': True, 'done_reason': 'stop',
+                 'prompt_eval_count': len(prompt) // 4, 'prompt_eval_duration': int(prompt_eval * 1e9),
+                 'eval_count': len(pieces), 'eval_duration': int(len(pieces) * self.token_ms * 1e6),
+                 'load_duration': 0}
+        if not payload.get('stream', True):
+            final['message' if chat else 'response'] = {'role': 'assistant', 'content': answer} if chat else answer
+            handler.send_json(final)
+            return
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/x-ndjson')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+        try:
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(self.token_ms / 1000)
+                chunk = {'model': payload.get('model'), 'done': False}
+                if chat:
+                    chunk['message'] = {'role': 'assistant', 'content': piece}
+                else:
+                    chunk['response'] = piece
+                self._write_chunk(handler, chunk)
+            self._write_chunk(handler, final)
+            handler.wfile.write(b'0\r\n\r\n')
+            handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Client closed the stream before the final chunk
+            self.cancelled += 1
+            handler.close_connection = True
+
+    @staticmethod
+    def _write_chunk(handler, obj):
+        data = (json.dumps(obj) + '\n').encode()
+        handler.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        handler.wfile.flush()
+
+
+# ---------------------------------------------------------------- Gmail API
+
+_GMAIL_PATH = re.compile(r'^/gmail/v1/users/[^/]+/messages(?:/([^/?]+))?(?:/(send))?(?:\?(.*))?$')
+
+
+class _GmailHandler(_QuietHandler):
+    def do_POST(self):
+        owner = self.server.owner
+        body = self.read_body()
+        if self.path.startswith('/batch'):
+            owner.requests['batch'] += 1
+            boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get('Content-Type', '')).group(1)
+            replies = []
+            for part in body.split(b'--' + boundary.encode())[1:]:
+                if part.startswith(b'--'):
+                    break
+                # googleapiclient writes the parts with bare \n line ends
+                head, _, inner = part.replace(b'\r\n', b'\n').lstrip(b'\n').partition(b'\n\n')
+                content_id = re.search(rb'Content-ID:\s*<([^>]*)>', head, re.IGNORECASE)
+                request_line, _, rest = inner.partition(b'\n')
+                method, path = request_line.decode().split(' ')[:2]
+                inner_body = rest.partition(b'\n\n')[2].rstrip(b'\n')
+                status, reply = owner.call(method, path, inner_body)
+                replies.append((content_id.group(1).decode() if content_id else '', status, reply))
+            out_boundary = 'batch_fake_gmail'
+            out = []
+            for content_id, status, reply in replies:
+                data = json.dumps(reply)
+                out.append(f'--{out_boundary}\r\nContent-Type: application/http\r\n'
+                           f'Content-ID: <response-{content_id}>\r\n\r\n'
+                           f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                           f'Content-Type: application/json; charset=UTF-8\r\n'
+                           f'Content-Length: {len(data)}\r\n\r\n{data}\r\n')
+            payload = (''.join(out) + f'--{out_boundary}--\r\n').encode()
+            self.send_response(200)
+            self.send_header('Content-Type', f'multipart/mixed; boundary={out_boundary}')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        owner.requests['single'] += 1
+        status, reply = owner.call('POST', self.path, body)
+        self.send_json(reply, status)
+
+    def do_GET(self):
+        owner = self.server.owner
+        owner.requests['single'] += 1
+        status, reply = owner.call('GET', self.path, b'')
+        self.send_json(reply, status)
+
+
+class FakeGmailServer(_HttpServer):
+    """
+    Gmail API stub (set GMAIL_API_ENDPOINT to its url): batch requests,
+    messages.get(format=raw) from the fake mailbox by X-GM-MSGID, and messages.send.
+    """
+    handler = _GmailHandler
+
+    def __init__(self, mailbox, port=0):
+        super().__init__(port)
+        self.mailbox = mailbox
+        self.sent = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def call(self, method, path, body):
+        m = _GMAIL_PATH.match(path)
+        if not m:
+            return 404, {'error': {'code': 404, 'message': f'unknown path {path}'}}
+        gid, send = m.group(1), m.group(2) or m.group(1) == 'send'
+        with self._lock:
+            self.requests[f'{method} {"send" if send else "get"}'] += 1
+        if method == 'POST' and send:
+            raw = json.loads(body or b'{}').get('raw', '')
+            with self._lock:
+                self.sent.append(len(raw))
+                n = len(self.sent)
+            return 200, {'id': format(n, 'x'), 'threadId': format(n, 'x'), 'labelIds': ['SENT']}
+        if method == 'GET' and gid:
+            msg = self.mailbox.by_msgid(int(gid, 16))
+            if msg is None:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            return 200, {'id': gid, 'raw': base64.urlsafe_b64encode(msg.raw).decode()}
+        return 400, {'error': {'code': 400, 'message': f'unsupported {method} {path}'}}
@@ -0,0 +1,114 @@
+# classification_cache.py
+# Content-addressed cache of LLM classification results, stored in processed_emails.db.
+import hashlib
+import re
+import time
+from email.utils import parseaddr
+
+from config import MODEL_NAME, CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS
+from db_utils import get_db, db_lock
+
+# Run size/age eviction after this many inserts
+EVICT_EVERY = 200
+
+_SUBJECT_PREFIX = re.compile(r'^\s*((re|fw|fwd|回复|转发)\s*[:：]\s*)+', re.IGNORECASE)
+
+
+def _normalize(text: str) -> str:
+    """Lowercase, mask digits (OTP codes, order numbers, dates) and collapse whitespace."""
+    text = (text or "").lower()
+    text = re.sub(r'\d+', '0', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def make_key(headers: dict, body: str) -> str:
+    """Hash of normalized sender address, subject and (already truncated) body."""
+    sender = parseaddr(headers.get("From", ""))[1] or headers.get("From", "")
+    subject = _SUBJECT_PREFIX.sub("", headers.get("Subject", "") or "")
+    parts = (_normalize(sender), _normalize(subject), _normalize(body))
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8", "ignore")).hexdigest()
+
+
+class ClassificationCache:
+    """
+    Maps message content hashes to the category returned by the LLM.
+    Entries record the model name and prompt version; rows written by another
+    model or prompt are dropped on open. Old and surplus rows are evicted.
+    """
+
+    def __init__(self, prompt_version: str, model: str = MODEL_NAME, conn=None,
+                 max_entries: int = CACHE_MAX_ENTRIES, max_age_days: float = CACHE_MAX_AGE_DAYS):
+        self.conn = conn or get_db()
+        self.model = model
+        self.prompt_version = prompt_version
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        with db_lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS classification_cache (
+                    key TEXT PRIMARY KEY,
+                    category TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    created_at REAL,
+                    last_hit REAL,
+                    hits INTEGER DEFAULT 0
+                )
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_hit ON classification_cache(last_hit)")
+            self.conn.commit()
+        self.invalidate_stale()
+        self.evict()
+
+    def invalidate_stale(self):
+        """Delete entries produced by a different model or prompt."""
+        with db_lock:
+            cur = self.conn.execute(
+                "DELETE FROM classification_cache WHERE model != ? OR prompt_version != ?",
+                (self.model, self.prompt_version))
+            self.conn.commit()
+        if cur.rowcount:
+            print(f"[INFO] Classification cache: dropped {cur.rowcount} entries from an old model/prompt")
+
+    def evict(self):
+        """Drop entries older than max_age, then the least recently used beyond max_entries."""
+        now = time.time()
+        with db_lock:
+            self.conn.execute("DELETE FROM classification_cache WHERE created_at < ?", (now - self.max_age,))
+            self.conn.execute('''
+                DELETE FROM classification_cache WHERE key IN (
+                    SELECT key FROM classification_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+            self.conn.commit()
+
+    def get(self, key: str):
+        """Return the cached category for key, or None."""
+        with db_lock:
+            row = self.conn.execute(
+                "SELECT category FROM classification_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute(
+                "UPDATE classification_cache SET hits = hits + 1, last_hit = ? WHERE key = ?",
+                (time.time(), key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, category: str):
+        now = time.time()
+        with db_lock:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO classification_cache
+                    (key, category, model, prompt_version, created_at, last_hit, hits)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            ''', (key, category, self.model, self.prompt_version, now, now))
+            self.conn.commit()
+            self._inserts += 1
+            if self._inserts % EVICT_EVERY == 0:
+                self.evict()
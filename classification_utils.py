@@ -1,13 +1,39 @@
-import urllib.request
-import json
+import urllib.parse
+import http.client
+import hashlib
 import re
-from config import OLLAMA_URL, MODEL_NAME, CONTENT_CATS, OLLAMA_HOST, OLLAMA_PORT
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    OLLAMA_URL, MODEL_NAME, CONTENT_CATS, OLLAMA_MAX_INFLIGHT, OLLAMA_IDLE_UNLOAD,
+    OLLAMA_NUM_PREDICT, CACHE_ENABLED, REPUTATION_ENABLED, PROMPT_COMPACTION, PROMPT_BODY_TOKENS,
+    KNN_ENABLED, NB_ENABLED,
+)
+from ollama_utils import get_client, OllamaHTTPError
+from classification_cache import ClassificationCache, make_key as make_cache_key
+from sender_reputation import SenderReputation
+import knn_index
+import naive_bayes
+from rule_engine import match_rules
+from mime_utils import extract_text
+from prompt_compaction import compact_body, estimate_tokens
+from metrics import metrics
 import time
 import socket
 print("[DEBUG] classification_utils.py loaded.")
 
+# Path part of OLLAMA_URL, requests go through the shared keep-alive client
+GENERATE_PATH = urllib.parse.urlsplit(OLLAMA_URL).path or "/api/generate"
+# Classification uses the chat endpoint so the system prompt is a stable, reusable prefix
+CHAT_PATH = GENERATE_PATH.rsplit("/", 1)[0] + "/chat"
+
+# Limit email body size to avoid excessive requests
+MAX_BODY_CHARS = 7000
+
 # —— 丰富的邮件分类主 Prompt ——  
-MAIN_PROMPT = r"""
+# Static instructions, sent as the system message. It is identical for every email,
+# so Ollama evaluates it once and reuses the cached prefix for later requests.
+SYSTEM_PROMPT = r"""
 [System Command]
 You are a smart email classification assistant. Please strictly complete a single main category judgment for the following email:
 The category must strictly be selected from the following eight categories (no new categories, no plural form, no spaces, no case errors):
@@ -23,27 +49,98 @@ The category must strictly be selected from the following eight categories (no n
 
 【Output Requirements】
 - Only output and **only output** the following JSON format, no extra characters, explanations, explanations, line breaks, or comments!
-- Format must be: {{"category":"Category Name"}}
+- Format must be: {"category":"Category Name"}
 - Category name must strictly be one of the above eight categories, otherwise it is considered invalid.
 
 【Strict Classification Logic】
-- If the sender is on the blacklist (such as: Otter.ai, Gumtree, Everyday Rewards, Telstra Team, Prosple, Academia, 13cabs, Flybuys, DoorDash, email addresses containing Promotions@, No-Reply@, Unsubscribe@, etc.), regardless of content, directly classify as {{"category":"Promotion"}}
-- Emails from bigfamily are always {{"category":"Security"}}
+- If the sender is on the blacklist (such as: Otter.ai, Gumtree, Everyday Rewards, Telstra Team, Prosple, Academia, 13cabs, Flybuys, DoorDash, email addresses containing Promotions@, No-Reply@, Unsubscribe@, etc.), regardless of content, directly classify as {"category":"Promotion"}
+- Emails from bigfamily are always {"category":"Security"}
 - Bandmix defaults to Promotion, only select Personal if the dialog content is clearly private
-- LinkedIn, new job post, gradconnect, seek, hays, etc. Job-related platforms, if they are clearly involved in interviews/invitations/positions, they are {{"category":"Opportunities"}}, otherwise they are Promotion
+- LinkedIn, new job post, gradconnect, seek, hays, etc. Job-related platforms, if they are clearly involved in interviews/invitations/positions, they are {"category":"Opportunities"}, otherwise they are Promotion
 Special attention should be paid to LinkedIn, unless it is really receiving opportunities from enterprises, otherwise it should be classified as Promotion
 - If the subject or body contains verification code, secondary verification, login, security reminder, etc., prioritize Security
 - Orders, payments, express, bills, etc. prioritize Transaction
 - Advertisements, promotions, discounts, pushes prioritize Promotion
 - If it is really impossible to determine, it defaults to LowPriority
+"""
 
-—— Original Email Data ——  
+# Per-email part, sent as the user message
+USER_PROMPT = r"""—— Original Email Data ——  
 From: {from_addr}  
 Subject: {subject}  
 Body:  
 {body}
 """
 
+# Changes whenever the prompt text or body preprocessing changes, invalidating cached classifications
+PROMPT_VERSION = hashlib.sha256(
+    (SYSTEM_PROMPT + USER_PROMPT + (f"|compact:{PROMPT_BODY_TOKENS}" if PROMPT_COMPACTION else "")).encode("utf-8")
+).hexdigest()[:16]
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the shared ClassificationCache, or None when CACHE_ENABLED is off."""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ClassificationCache(PROMPT_VERSION)
+        return _cache
+
+_reputation = None
+
+
+def get_reputation():
+    """Return the shared SenderReputation, or None when REPUTATION_ENABLED is off."""
+    global _reputation
+    if not REPUTATION_ENABLED:
+        return None
+    with _cache_lock:
+        if _reputation is None:
+            _reputation = SenderReputation()
+        return _reputation
+
+_knn = None
+
+
+def get_knn():
+    """Return the shared KnnIndex, or None when KNN_ENABLED is off or numpy is missing."""
+    global _knn
+    if not KNN_ENABLED:
+        return None
+    with _cache_lock:
+        if _knn is None:
+            if not knn_index.available():
+                print("[WARN] KNN_ENABLED is set but numpy is not installed; nearest-neighbour fast path off")
+                _knn = False
+            else:
+                _knn = knn_index.KnnIndex()
+        return _knn or None
+
+_nb = None
+
+
+def get_nb():
+    """Return the trained NaiveBayes model, or None when NB_ENABLED is off, numpy is missing or there is no model."""
+    global _nb
+    if not NB_ENABLED:
+        return None
+    with _cache_lock:
+        if _nb is None:
+            if not naive_bayes.available():
+                print("[WARN] NB_ENABLED is set but numpy is not installed; naive Bayes classifier off")
+                _nb = False
+            else:
+                _nb = naive_bayes.NaiveBayes.load() or False
+                if _nb:
+                    print(f"[INFO] Naive Bayes model loaded ({_nb.meta.get('trained_on')} messages, "
+                          f"trained {_nb.meta.get('trained_at')})")
+        return _nb or None
+
 def safe_category(cat):
     """Prevent classification spelling/space etc. small errors"""
     if not cat:
@@ -72,6 +169,134 @@ def safe_category(cat):
         return cat
     return ""
 
+# JSON schema for Ollama structured output: the answer can only be one of the categories
+CATEGORY_SCHEMA = {
+    "type": "object",
+    "properties": {"category": {"type": "string", "enum": list(CONTENT_CATS)}},
+    "required": ["category"],
+}
+
+_CATEGORY_VALUE = re.compile(r'"category"\s*:\s*"([^"]*)"')
+
+
+def read_category_stream(chunks):
+    """
+    Read a streamed /api/chat (or /api/generate) response to its final chunk,
+    which carries Ollama's prompt-eval and timing counters. The enum schema
+    leaves only the closing '"}' after the value, so stopping at the category
+    would save next to nothing and lose those counters.
+    Returns (category or "", text received, {"first_token": s, "final": chunk or None}).
+    """
+    text = ""
+    meta = {"first_token": None, "final": None}
+    start = time.monotonic()
+    try:
+        for chunk in chunks:
+            if meta["first_token"] is None:
+                meta["first_token"] = time.monotonic() - start
+            if chunk.get("done"):
+                meta["final"] = chunk
+                break
+            text += chunk.get("message", {}).get("content", "") or chunk.get("response", "")
+        m = _CATEGORY_VALUE.search(text)
+        return (safe_category(m.group(1)) if m else ""), text, meta
+    finally:
+        chunks.close()
+
+
+class PromptStats:
+    """
+    Prompt size per classification call: estimated tokens sent, time to the first
+    streamed token (dominated by prompt evaluation) and the prompt tokens Ollama
+    actually evaluated (a reused prefix is not re-evaluated).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.sent_tokens = 0
+        self.first_token = 0.0
+        self.prompt_eval_count = 0
+        self.prompt_eval_seconds = 0.0
+
+    def record(self, sent_tokens, meta):
+        final = meta.get("final") or {}
+        with self._lock:
+            self.calls += 1
+            self.sent_tokens += sent_tokens
+            self.first_token += meta.get("first_token") or 0.0
+            # Ollama leaves the count out when the whole prompt came from its cache
+            self.prompt_eval_count += final.get("prompt_eval_count", 0)
+            self.prompt_eval_seconds += final.get("prompt_eval_duration", 0) / 1e9
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {
+                "calls": self.calls,
+                "avg_prompt_tokens_est": round(self.sent_tokens / self.calls) if self.calls else 0,
+                "avg_first_token_ms": round(1000 * self.first_token / self.calls) if self.calls else 0,
+            }
+            if self.calls:
+                out["avg_prompt_eval_count"] = round(self.prompt_eval_count / self.calls)
+                out["avg_prompt_eval_ms"] = round(1000 * self.prompt_eval_seconds / self.calls)
+                out["evaluated_share"] = round(self.prompt_eval_count / max(1, self.sent_tokens), 2)
+            return out
+
+
+prompt_stats = PromptStats()
+
+# Ollama's own timings in the final chunk (nanoseconds) -> histogram name
+OLLAMA_DURATIONS = {
+    "load_duration": "ollama_load_seconds",
+    "prompt_eval_duration": "ollama_prompt_eval_seconds",
+    "eval_duration": "ollama_eval_seconds",
+}
+
+
+def record_ollama_metrics(sent_tokens, meta):
+    """Per-request Ollama metrics: time to first token, token counts and the server timings of the final chunk."""
+    if meta.get("first_token") is not None:
+        metrics.observe("ollama_first_token_seconds", meta["first_token"])
+    metrics.inc("ollama_prompt_tokens_total", sent_tokens, kind="estimated")
+    final = meta.get("final") or {}
+    for field, name in OLLAMA_DURATIONS.items():
+        if field in final:
+            metrics.observe(name, final[field] / 1e9)
+    if final:
+        metrics.inc("ollama_prompt_tokens_total", final.get("prompt_eval_count", 0), kind="evaluated")
+    if "eval_count" in final:
+        metrics.inc("ollama_eval_tokens_total", final["eval_count"])
+
+
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+
+
+def build_messages(body, headers):
+    """Chat messages for one email: the fixed system prompt, then the email data."""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": USER_PROMPT.format(
+            from_addr=headers.get("From", ""),
+            subject=headers.get("Subject", ""),
+            body=body,
+        )},
+    ]
+
+
+def warmup_request():
+    """
+    (path, payload) that evaluates the system prompt right after the model is
+    loaded, so the first email already finds the prefix in Ollama's cache.
+    """
+    return CHAT_PATH, {
+        "model": MODEL_NAME,
+        "messages": [{"role": "system", "content": SYSTEM_PROMPT}],
+        "stream": False,
+        "options": {"num_predict": 1},
+        "keep_alive": max(1, int(OLLAMA_IDLE_UNLOAD)),
+    }
+
+
 def compose_email_data(body, headers):
     """Assemble email data for use in prompts"""
     return f"""From: {headers.get('From', '')}
@@ -80,111 +305,123 @@ Body:
 {body}
 """
 
-def classify_main(body: str, headers: dict) -> str:
+def classify_main(body: str, headers: dict, info: dict = None, residency=None) -> str:
     """
     Email classification main function, call order:
     1. Priority use Ollama API for classification
     2. If API fails, use simple rule-based classification
     3. If both fail, return default category LowPriority
+    If info is given, info["source"] is set to "cache", "llm" or "rules".
+    If residency (ollama_utils.ModelResidency) is given, the model is loaded only
+    here, for messages that actually reach the LLM.
     """
+    if info is None:
+        info = {}
     from_addr = headers.get("From", "").lower()
     subject = headers.get("Subject", "").lower()
     body_lower = body.lower() if body else ""
     
+    # Limit email body size to avoid excessive requests
+    if PROMPT_COMPACTION:
+        with metrics.timer("stage_seconds", stage="compact"):
+            truncated_body = compact_body(body, PROMPT_BODY_TOKENS)
+        if body and len(truncated_body) < len(body):
+            print(f"[DEBUG] Email body compacted: {len(body)} -> {len(truncated_body)} chars "
+                  f"(~{estimate_tokens(truncated_body)} tokens).")
+    else:
+        truncated_body = body[:MAX_BODY_CHARS] if body and len(body) > MAX_BODY_CHARS else body
+        if body and len(body) > MAX_BODY_CHARS:
+            print(f"[DEBUG] Email body truncated to {MAX_BODY_CHARS} characters.")
+
+    # Same content already classified by this model and prompt
+    cache = get_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = make_cache_key(headers, truncated_body or "")
+        cached = cache.get(cache_key)
+        if cached in CONTENT_CATS:
+            print(f"[INFO] Classification cache hit: {cached}")
+            info["source"] = "cache"
+            return cached
+
     # First try to use API for classification
     max_retries = 2  # Maximum retry times
     retry_count = 0
-    timeout_seconds = 10  # Set 10 seconds timeout
+    client = get_client()
+    # Model could not be loaded: go straight to the rules
+    if residency is not None and not residency.acquire():
+        retry_count = max_retries + 1
     
     while retry_count <= max_retries:
         try:
             print(f"[INFO] Attempting classification via Ollama API{' (Retry #'+str(retry_count)+')' if retry_count > 0 else ''}")
-            print(f"[DEBUG] API URL: {OLLAMA_URL}")
+            print(f"[DEBUG] API path: {CHAT_PATH}")
             print(f"[DEBUG] Model: {MODEL_NAME}")
 
-            # Limit email body size to avoid excessive requests
-            max_body_chars = 7000
-            truncated_body = body[:max_body_chars] if body and len(body) > max_body_chars else body
-            if body and len(body) > max_body_chars:
-                print(f"[DEBUG] Email body truncated to {max_body_chars} characters.")
-
-            # Assemble API request
+            # Assemble API request: fixed system message + per-email user message, output
+            # constrained to {"category": <one of CONTENT_CATS>}, streamed
+            messages = build_messages(truncated_body, headers)
             payload = {
                 "model": MODEL_NAME,
-                "prompt": MAIN_PROMPT.format(
-                    from_addr=headers.get("From",""),
-                    subject=headers.get("Subject",""),
-                    body=truncated_body
-                ),
-                "stream": False
+                "messages": messages,
+                "format": CATEGORY_SCHEMA,
+                "stream": True,
+                "options": {"num_predict": OLLAMA_NUM_PREDICT},
+                # Keep the model resident between messages (see ModelResidency)
+                "keep_alive": max(1, int(OLLAMA_IDLE_UNLOAD))
             }
-            data = json.dumps(payload).encode()
 
             print(f"[DEBUG] Sending API request...")
-            req = urllib.request.Request(
-                OLLAMA_URL,
-                data=data,
-                headers={"Content-Type": "application/json"}
-            )
-
-            # Set timeout time
-            with urllib.request.urlopen(req, timeout=timeout_seconds) as resp:
-                status_code = resp.status
-                print(f"[DEBUG] API response status: {status_code}")
-                response_data = json.loads(resp.read().decode())
-                text = response_data.get("response", "").strip()
-                print(f"[DEBUG] API raw response: {text}")
-
-                # Try to parse JSON directly
-                cat = ""
-                try:
-                    obj = json.loads(text)
-                    cat = obj.get("category", "")
-                except Exception as je:
-                    print(f"[DEBUG] JSON parse failed: {str(je)}")
-
-                    # Regex fallback: extract {"category":"xxx"}
-                    m = re.search(r'\{\s*"category"\s*:\s*"([A-Za-z]+)"\s*\}', text)
-                    if m:
-                        cat = m.group(1)
-                        print(f"[INFO] Category extracted via regex: {cat}")
-                    else:
-                        print(f"[ERROR] No category field found in LLM response.")
-                        cat = ""
-
-                cat = safe_category(cat)
-                print(f"[DEBUG] Normalized category: {cat}")
-
-                if cat in CONTENT_CATS:
-                    print(f"[INFO] Ollama API classification: {cat}")
-                    return cat
-                else:
-                    print(f"[DEBUG] Invalid category value '{cat}', not in allowed list.")
-            
+            # Pooled keep-alive connection, timeout set by OLLAMA_TIMEOUT
+            start = time.perf_counter()
+            cat, text, meta = read_category_stream(client.post_stream(CHAT_PATH, payload))
+            metrics.observe("ollama_request_seconds", time.perf_counter() - start)
+            sent_tokens = SYSTEM_PROMPT_TOKENS + estimate_tokens(messages[1]["content"])
+            prompt_stats.record(sent_tokens, meta)
+            final = meta["final"] or {}
+            record_ollama_metrics(sent_tokens, meta)
+            print(f"[DEBUG] Prompt ~{sent_tokens} tokens, first token after {1000 * (meta['first_token'] or 0):.0f} ms"
+                  + (f", Ollama evaluated {final['prompt_eval_count']}" if "prompt_eval_count" in final else ""))
+            print(f"[DEBUG] API raw response: {text}")
+
+            if cat in CONTENT_CATS:
+                print(f"[INFO] Ollama API classification: {cat}")
+                if cache is not None:
+                    cache.put(cache_key, cat)
+                if residency is not None:
+                    residency.touch()
+                info["source"] = "llm"
+                return cat
+            else:
+                print(f"[ERROR] No category field found in LLM response.")
+
             # If here, API call succeeded but no valid category, exit retry loop
             break
 
-        except urllib.error.HTTPError as e:
+        except OllamaHTTPError as e:
+            metrics.inc("ollama_errors_total", kind="http")
             print(f"[INFO] Ollama API HTTP error: {e.code} {e.reason}")
-            print(f"[DEBUG] Exception: HTTPError")
+            print(f"[DEBUG] Exception: OllamaHTTPError")
             retry_count += 1
             if retry_count <= max_retries:
                 print(f"[INFO] Retrying in 1 second...")
                 time.sleep(1)
             continue
 
-        except urllib.error.URLError as e:
-            print(f"[INFO] Ollama API network error: {str(e)}")
-            print(f"[DEBUG] Exception: URLError")
+        except socket.timeout:
+            metrics.inc("ollama_errors_total", kind="timeout")
+            print(f"[INFO] Ollama API request timed out.")
+            print(f"[DEBUG] Exception: socket.timeout")
             retry_count += 1
             if retry_count <= max_retries:
                 print(f"[INFO] Retrying in 1 second...")
                 time.sleep(1)
             continue
 
-        except socket.timeout:
-            print(f"[INFO] Ollama API request timed out.")
-            print(f"[DEBUG] Exception: socket.timeout")
+        except (OSError, http.client.HTTPException) as e:
+            metrics.inc("ollama_errors_total", kind="network")
+            print(f"[INFO] Ollama API network error: {str(e)}")
+            print(f"[DEBUG] Exception: {type(e).__name__}")
             retry_count += 1
             if retry_count <= max_retries:
                 print(f"[INFO] Retrying in 1 second...")
@@ -192,6 +429,7 @@ def classify_main(body: str, headers: dict) -> str:
             continue
 
         except Exception as e:
+            metrics.inc("ollama_errors_total", kind="other")
             print(f"[INFO] Ollama API call failed: '{str(e)[:100]}'...")
             print(f"[DEBUG] Exception: {type(e).__name__}")
             retry_count += 1
@@ -200,153 +438,93 @@ def classify_main(body: str, headers: dict) -> str:
                 time.sleep(1)
             continue
 
+    if residency is not None:
+        residency.touch()
+
     # API call failed or result invalid, use rule-based classification
     print(f"[INFO] Fallback to rule-based classification.")
+    info["source"] = "rules"
     
-    # Blacklist check - classify as Promotion
-    blacklist = [
-        "otter.ai", "everyday rewards", "telstra", "gumtree", "prosple", "academia",
-        "13cabs", "flybuys", "doordash", "promotions@", "no-reply@", "unsubscribe@",
-        "noreply@", "notifications@", "newsletter@", "marketing@", "bandmix",
-        "advertisement", "promotion", "discount", "sale", "off", "coupon"
-    ]
+    # Declarative rule table (rule_engine.RULES), matched in one pass per field
+    match = match_rules(from_addr, subject, body_lower)
+    if match:
+        cat, field, term = match
+        print(f"[INFO] Rule match ({field}): '{term}' -> {cat}")
+        return cat
 
-    if any(term in from_addr for term in blacklist):
-        match = next((term for term in blacklist if term in from_addr), None)
-        print(f"[INFO] Blacklist sender match: '{match}' -> Promotion")
-        return "Promotion"
-    
-    # Security category keywords
-    security_terms = [
-        "security", "verification code", "login", "password", "bigfamily",
-        "account", "security", "confirm", "authenticate", "secondary verification", "2fa", 
-        "identity verification", "secure", "authentication", "alert", "warning", "suspicious"
-    ]
-    
-    for term in security_terms:
-        if term in subject:
-            print(f"[INFO] Security keyword match (subject): '{term}' -> Security")
-            return "Security"
-        if term in from_addr:
-            print(f"[INFO] Security keyword match (sender): '{term}' -> Security")
-            return "Security"
-        if term in body_lower[:500]:
-            print(f"[INFO] Security keyword match (body): '{term}' -> Security")
-            return "Security"
-    
-    # Opportunities category keywords
-    opportunity_terms = [
-        "job", "career", "opportunity", "position", "interview", "hire", "recruitment",
-        "application", "resume", "position", "recruitment", "offer", "employment", "hiring",
-        "talent", "apply", "candidate", "job opening", "job opportunities", "career development"
-    ]
-    
-    for term in opportunity_terms:
-        if term in subject:
-            print(f"[INFO] Opportunity keyword match (subject): '{term}' -> Opportunities")
-            return "Opportunities"
-        if term in body_lower[:500]:
-            print(f"[INFO] Opportunity keyword match (body): '{term}' -> Opportunities")
-            return "Opportunities"
-    
-    # Work category keywords
-    work_terms = [
-        "urgent", "important", "action", "required", "please note", "urgent", 
-        "deadline", "payment", "invoice", "contract", "project", "task",
-        "meeting", "report", "work", "project", "task", "meeting", "report",
-        "colleague", "team", "customer", "customer", "collaborate", "collaborate", "collaborate"
-    ]
-    
-    for term in work_terms:
-        if term in subject:
-            print(f"[INFO] Work keyword match (subject): '{term}' -> Work")
-            return "Work"
-        if term in body_lower[:300]:
-            print(f"[INFO] Work keyword match (body): '{term}' -> Work")
-            return "Work"
-    
-    # Personal category keywords
-    personal_terms = [
-        "personal", "friend", "family", "social", "invite", "invitation",
-        "party", "celebration", "birthday", "wedding", "travel", "trip",
-        "private", "personal", "friend", "family", "social", "invite", "party", "celebration",
-        "birthday", "travel", "tour", "private", "vacation", "holiday"
-    ]
-    
-    for term in personal_terms:
-        if term in subject:
-            print(f"[INFO] Personal keyword match (subject): '{term}' -> Personal")
-            return "Personal"
-        if term in body_lower[:300]:
-            print(f"[INFO] Personal keyword match (body): '{term}' -> Personal")
-            return "Personal"
-    
-    # Update category keywords
-    update_terms = [
-        "update", "upgrade", "new version", "update", "patch", "version", "release",
-        "improvement", "enhancement", "system", "software", "app", "application",
-        "changelog", "change log", "new feature", "feature", "improvement"
-    ]
-    
-    for term in update_terms:
-        if term in subject:
-            print(f"[INFO] Update keyword match (subject): '{term}' -> Update")
-            return "Update"
-        if term in body_lower[:300]:
-            print(f"[INFO] Update keyword match (body): '{term}' -> Update")
-            return "Update"
-    
-    # Transaction category keywords
-    transaction_terms = [
-        "transaction", "receipt", "payment", "order", "purchase", "transaction", "payment",
-        "order", "payment", "bill", "invoice", "statement", "purchase", "bought",
-        "paid", "confirmation", "shipped", "delivery", "tracking", "bill"
-    ]
-    
-    for term in transaction_terms:
-        if term in subject:
-            print(f"[INFO] Transaction keyword match (subject): '{term}' -> Transaction")
-            return "Transaction"
-        if term in body_lower[:300]:
-            print(f"[INFO] Transaction keyword match (body): '{term}' -> Transaction")
-            return "Transaction"
-    
-    # Promotion category keywords (check when other rules don't match)
-    promotion_terms = [
-        "promotion", "discount", "sale", "offer", "deal", "coupon", "code",
-        "subscription", "newsletter", "marketing", "advertisement", "promotion", "discount",
-        "discount", "special price", "limited time", "flash sale", "full reduction", "new product", "activity", "special"
-    ]
-    
-    for term in promotion_terms:
-        if term in subject:
-            print(f"[INFO] Promotion keyword match (subject): '{term}' -> Promotion")
-            return "Promotion"
-        if term in from_addr:
-            print(f"[INFO] Promotion keyword match (sender): '{term}' -> Promotion")
-            return "Promotion"
-        if term in body_lower[:500]:
-            print(f"[INFO] Promotion keyword match (body): '{term}' -> Promotion")
-            return "Promotion"
-    
     # No rule matched, return default category
     print(f"[INFO] No rule matched. Defaulting to LowPriority.")
     return "LowPriority"
 
-def classify_content(body: str, headers: dict) -> str:
+def classify_content(body: str, headers: dict, residency=None, info: dict = None) -> str:
+    """
+    Entry: return one of the eight categories.
+    Senders with a stable history are answered from the reputation table, confident
+    predictions of the local naive Bayes model and messages whose nearest
+    already-classified neighbours agree from the kNN index; everything else goes
+    through classify_main (which loads the model through residency, if given).
+    If info is given, info["source"] is set to "reputation", "nb", "knn" or one of classify_main's.
+    """
+    if info is None:
+        info = {}
+    start = time.perf_counter()
+    reputation = get_reputation()
+    from_addr = headers.get("From", "")
+    if reputation is not None:
+        cat = reputation.lookup(from_addr)
+        if cat in CONTENT_CATS:
+            print(f"[INFO] Sender reputation fast path: {cat}")
+            info["source"] = "reputation"
+            metrics.observe("classify_seconds", time.perf_counter() - start, source="reputation")
+            return cat
+    nb = get_nb()
+    if nb is not None:
+        cat = nb.lookup(headers, body)
+        if cat in CONTENT_CATS:
+            print(f"[INFO] Naive Bayes fast path: {cat}")
+            info["source"] = "nb"
+            metrics.observe("classify_seconds", time.perf_counter() - start, source="nb")
+            return cat
+    knn = get_knn()
+    vector = None
+    if knn is not None:
+        vector = knn.embed(headers, body)
+        cat = knn.lookup(vector)
+        if cat in CONTENT_CATS:
+            print(f"[INFO] Nearest-neighbour fast path: {cat}")
+            info["source"] = "knn"
+            metrics.observe("classify_seconds", time.perf_counter() - start, source="knn")
+            return cat
+    cat = classify_main(body, headers, info, residency)
+    metrics.observe("classify_seconds", time.perf_counter() - start, source=info.get("source", "rules"))
+    # Only fresh LLM answers feed the reputation table and the kNN index
+    if info.get("source") == "llm":
+        if reputation is not None:
+            reputation.record(from_addr, cat)
+        if vector is not None:
+            knn.add(vector, cat)
+    return cat
+
+def classify_many(messages, max_inflight: int = OLLAMA_MAX_INFLIGHT, infos: list = None) -> list:
     """
-    Entry: directly return the result of classify_main (one of the eight categories)
+    Classify a list of (body, headers) pairs keeping up to max_inflight
+    requests in flight. Results are returned in input order; infos, if given,
+    receives one classify_content info dict per message.
     """
-    return classify_main(body, headers)
+    messages = list(messages)
+    details = [{} for _ in messages]
+    if infos is not None:
+        infos.extend(details)
+    if max_inflight <= 1 or len(messages) <= 1:
+        return [classify_content(body, headers, info=info) for (body, headers), info in zip(messages, details)]
+    with ThreadPoolExecutor(max_workers=min(max_inflight, len(messages))) as pool:
+        return list(pool.map(lambda m, info: classify_content(*m, info=info), messages, details))
 
-def fetch_plaintext(msg) -> str:
+def fetch_plaintext(msg, limit: int = MAX_BODY_CHARS) -> str:
     """
-    Extract pure text content from email.message.Message:
-    - Prefer to return text/plain part
-    - If not, decode the entire payload
+    Extract the text to classify from email.message.Message:
+    - the best inline text part: text/plain, or text/html converted to text
+      when there is no plain part or only a stub
+    - decoded with the declared charset, stopping after limit characters
     """
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                return (part.get_payload(decode=True) or b"").decode(errors="ignore")
-    return (msg.get_payload(decode=True) or b"").decode(errors="ignore")
+    return extract_text(msg, limit)
@@ -19,14 +19,25 @@ if env_path.exists():
 IMAP_HOST = os.getenv("IMAP_HOST")
 IMAP_USER = os.getenv("IMAP_USER")
 IMAP_PASS = os.getenv("IMAP_PASS")
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+IMAP_SSL  = os.getenv("IMAP_SSL", "True").lower() in ("1", "true", "yes")
 PROCESSED_CAT = os.getenv("PROCESSED_CAT", "Processed")
 
+# Multi-account daemon (daemon.py): JSON file listing the mailboxes, see accounts.example.json.
+# The daemon does not need IMAP_HOST/IMAP_USER/IMAP_PASS.
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "")
+
 # Reporting feature toggle and recipient
 REPORT_ENABLED = os.getenv("REPORT_ENABLED", "False").lower() in ("1", "true", "yes")
 print("[DEBUG] config REPORT_ENABLED =", REPORT_ENABLED)
 
 REPORT_TO      = os.getenv("REPORT_TO", "")
 
+# Gmail API: OAuth token file, and an alternative API root (e.g. the local stub used by
+# benchmarks/bench_e2e.py); empty = the real Gmail API
+GMAIL_TOKEN_PATH   = os.getenv("GMAIL_TOKEN_PATH", "token.pickle")
+GMAIL_API_ENDPOINT = os.getenv("GMAIL_API_ENDPOINT", "")
+
 # SMTP configuration for sending reports
 SMTP_HOST      = os.getenv("SMTP_HOST", "")
 SMTP_PORT      = int(os.getenv("SMTP_PORT", "587"))
@@ -61,6 +72,95 @@ OLLAMA_PORT = int(os.getenv("OLLAMA_PORT", "11434"))  # Use default port 11434
 OLLAMA_URL  = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}/api/generate"  # Use /api/generate path
 # Model name priority: environment variable > working_api.txt > default value
 MODEL_NAME  = os.getenv("MODEL_NAME", working_model or "mistral:latest")  # Use a verified available model
+# Per-request timeout (seconds) and number of classification requests kept in flight at once.
+# Set OLLAMA_NUM_PARALLEL on the Ollama server to at least OLLAMA_MAX_INFLIGHT.
+OLLAMA_TIMEOUT      = float(os.getenv("OLLAMA_TIMEOUT", "10"))
+OLLAMA_MAX_INFLIGHT = int(os.getenv("OLLAMA_MAX_INFLIGHT", "4"))
+# Seconds the model stays loaded in VRAM after the last request before it is unloaded
+OLLAMA_IDLE_UNLOAD  = float(os.getenv("OLLAMA_IDLE_UNLOAD", "600"))
+# Maximum tokens generated per classification; the JSON answer {"category": "..."} needs about a dozen
+OLLAMA_NUM_PREDICT  = int(os.getenv("OLLAMA_NUM_PREDICT", "24"))
+
+# IMAP IDLE push mode: wait for server notifications instead of polling every CHECK_INTERVAL
+IDLE_ENABLED        = os.getenv("IDLE_ENABLED", "True").lower() in ("1", "true", "yes")
+IDLE_RENEW_SECONDS  = float(os.getenv("IDLE_RENEW_SECONDS", "540"))   # re-issue IDLE before the server drops it
+IDLE_RESYNC_SECONDS = float(os.getenv("IDLE_RESYNC_SECONDS", "3600"))  # safety round even without notifications
+
+# Read, unprocessed history is drained in chunks of HISTORY_CHUNK at HISTORY_RATE_PER_MIN
+# messages per minute (0 = no limit; --include-history also removes the limit).
+# Unread mail is always processed first.
+HISTORY_RATE_PER_MIN = float(os.getenv("HISTORY_RATE_PER_MIN", "10"))
+HISTORY_CHUNK        = int(os.getenv("HISTORY_CHUNK", "30"))
+
+# How message text is fetched for classification:
+#   partial - BODYSTRUCTURE + headers, then only the text part, first PARTIAL_FETCH_BYTES bytes
+#   full    - whole message (BODY.PEEK[]) including attachments
+FETCH_MODE          = os.getenv("FETCH_MODE", "partial").lower()
+PARTIAL_FETCH_BYTES = int(os.getenv("PARTIAL_FETCH_BYTES", "32768"))
+
+# Prompt compaction: strip quoted replies, signatures, footers and tracking URLs from the body
+# and cut it to PROMPT_BODY_TOKENS approximate tokens (instead of a character limit)
+PROMPT_COMPACTION  = os.getenv("PROMPT_COMPACTION", "True").lower() in ("1", "true", "yes")
+PROMPT_BODY_TOKENS = int(os.getenv("PROMPT_BODY_TOKENS", "800"))
+
+# Local state database (processing history, classification cache)
+DB_PATH = os.getenv("DB_PATH", "processed_emails.db")
+
+# Classification cache: skip Ollama for messages already classified with the same model and prompt
+CACHE_ENABLED      = os.getenv("CACHE_ENABLED", "True").lower() in ("1", "true", "yes")
+CACHE_MAX_ENTRIES  = int(os.getenv("CACHE_MAX_ENTRIES", "50000"))
+CACHE_MAX_AGE_DAYS = float(os.getenv("CACHE_MAX_AGE_DAYS", "90"))
+
+# Sender reputation: answer directly for senders whose past categories are stable
+REPUTATION_ENABLED        = os.getenv("REPUTATION_ENABLED", "True").lower() in ("1", "true", "yes")
+REPUTATION_MIN_COUNT      = float(os.getenv("REPUTATION_MIN_COUNT", "5"))     # decayed observations needed
+REPUTATION_MIN_SHARE      = float(os.getenv("REPUTATION_MIN_SHARE", "0.95"))  # share of the top category
+REPUTATION_HALF_LIFE_DAYS = float(os.getenv("REPUTATION_HALF_LIFE_DAYS", "60"))
+
+# Nearest-neighbour fast path (opt-in, needs numpy): sender, subject and the first KNN_BODY_CHARS
+# of the body are embedded (KNN_EMBEDDER "hash" = local hashing vectorizer, "ollama" = KNN_EMBED_MODEL via
+# /api/embed) into a memory-mapped index of already classified mail. The majority category of the
+# KNN_K nearest messages is used when at least KNN_MIN_AGREEMENT of them have it with a cosine
+# similarity of at least KNN_MIN_SIMILARITY; otherwise the message goes to the LLM.
+KNN_ENABLED        = os.getenv("KNN_ENABLED", "False").lower() in ("1", "true", "yes")
+KNN_INDEX_PATH     = os.getenv("KNN_INDEX_PATH", "knn_index.f32")
+KNN_EMBEDDER       = os.getenv("KNN_EMBEDDER", "hash").lower()
+KNN_EMBED_MODEL    = os.getenv("KNN_EMBED_MODEL", "nomic-embed-text")
+KNN_HASH_DIM       = int(os.getenv("KNN_HASH_DIM", "512"))
+KNN_K              = int(os.getenv("KNN_K", "5"))
+KNN_MIN_SIMILARITY = float(os.getenv("KNN_MIN_SIMILARITY", "0.8"))
+KNN_MIN_AGREEMENT  = float(os.getenv("KNN_MIN_AGREEMENT", "0.8"))
+KNN_BODY_CHARS     = int(os.getenv("KNN_BODY_CHARS", "1000"))
+
+# Local naive Bayes classifier (needs numpy), trained from the LLM answers in the ledger with
+# `python naive_bayes.py`. Its answer is used when its confidence is at least NB_MIN_CONFIDENCE;
+# anything less goes on to the kNN index and the LLM. Opt-in; no model file = off.
+NB_ENABLED        = os.getenv("NB_ENABLED", "False").lower() in ("1", "true", "yes")
+NB_MODEL_PATH     = os.getenv("NB_MODEL_PATH", "nb_model.npz")
+NB_MIN_CONFIDENCE = float(os.getenv("NB_MIN_CONFIDENCE", "0.98"))
+NB_HASH_BITS      = int(os.getenv("NB_HASH_BITS", "18"))
+NB_BODY_CHARS     = int(os.getenv("NB_BODY_CHARS", "1000"))
+
+# Forwarding to REPORT_TO through the Gmail API: messages per batch HTTP request,
+# forwarding threads (each with its own service) and retries for rate-limited/5xx items
+FORWARD_BATCH_SIZE = int(os.getenv("FORWARD_BATCH_SIZE", "50"))
+FORWARD_WORKERS    = int(os.getenv("FORWARD_WORKERS", "2"))
+FORWARD_RETRIES    = int(os.getenv("FORWARD_RETRIES", "3"))
+
+# Staged pipeline (fetch -> parse -> classify -> label -> forward): messages per batch,
+# batches buffered between stages, and workers per stage. IMAP fetch and labelling share
+# one connection and run one at a time; forwarding uses FORWARD_WORKERS.
+PIPELINE_BATCH_SIZE       = int(os.getenv("PIPELINE_BATCH_SIZE", "20"))
+PIPELINE_QUEUE_SIZE       = int(os.getenv("PIPELINE_QUEUE_SIZE", "2"))
+PIPELINE_PARSE_WORKERS    = int(os.getenv("PIPELINE_PARSE_WORKERS", "2"))
+PIPELINE_CLASSIFY_WORKERS = int(os.getenv("PIPELINE_CLASSIFY_WORKERS", str(OLLAMA_MAX_INFLIGHT)))
+
+# Metrics: per-stage counters and latency histograms, served as Prometheus text on
+# 127.0.0.1:METRICS_PORT (0 = off) and written to METRICS_SNAPSHOT_PATH as JSON for the tray
+METRICS_ENABLED          = os.getenv("METRICS_ENABLED", "True").lower() in ("1", "true", "yes")
+METRICS_PORT             = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_SNAPSHOT_PATH    = os.getenv("METRICS_SNAPSHOT_PATH", "metrics.json")
+METRICS_SNAPSHOT_SECONDS = float(os.getenv("METRICS_SNAPSHOT_SECONDS", "30"))
 
 # Label mapping (main categories)
 MAIN_CATS = [
@@ -75,10 +175,13 @@ OLD_LABELS = list(LABEL_MAP.values())
 # Used by classification_utils
 CONTENT_CATS = list(LABEL_MAP.keys())
 
-# Validate critical settings
-_missing = [v for v in ("IMAP_HOST", "IMAP_USER", "IMAP_PASS") if not globals().get(v)]
-if _missing:
-    raise RuntimeError(f"Missing required config vars in .env: {', '.join(_missing)}")
+
+def require_imap_config():
+    """Validate the single-account IMAP settings (launcher_old.py, main.py); daemon.py reads its accounts file instead."""
+    missing = [v for v in ("IMAP_HOST", "IMAP_USER", "IMAP_PASS") if not globals().get(v)]
+    if missing:
+        raise RuntimeError(f"Missing required config vars in .env: {', '.join(missing)}")
+
 
 CATEGORY_PREFIX = {
     "Work": "【工作】",
@@ -0,0 +1,209 @@
+# daemon.py
+# Multi-account daemon: one sync/label/forward loop per mailbox, all feeding one
+# shared classification queue served by a single warm model.
+import argparse
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from imapclient import IMAPClient
+from imapclient.exceptions import IMAPClientAbortError
+
+from config import ACCOUNTS_FILE, IDLE_ENABLED, IDLE_RESYNC_SECONDS, OLLAMA_MAX_INFLIGHT, HISTORY_RATE_PER_MIN
+from classification_utils import get_knn, get_nb, get_reputation, prompt_stats, warmup_request
+from fair_queue import FairClassifier
+from gmail_forward import GmailForwarder
+from gmailauth import get_credentials
+from gmail_utils import ensure_labels
+from imap_sync import supports_idle, wait_for_changes, MailboxSync, WorkScheduler
+from launcher_old import init_db, CHECK_INTERVAL
+from ledger import get_ledger
+from metrics import metrics, start_metrics, write_snapshot
+from ollama_utils import ModelResidency
+from pipeline import run_pipeline
+
+Account = namedtuple('Account', 'name host port ssl user password report_to token_file include_history')
+
+
+def load_accounts(path=ACCOUNTS_FILE) -> list:
+    """
+    Read the accounts file: a JSON list of {"name", "host", "port", "ssl", "user",
+    "password" or "password_env", "report_to", "token_file", "include_history"}.
+    Forwarding is enabled for accounts with a report_to address. Read history is
+    drained at HISTORY_RATE_PER_MIN, or without a limit when include_history is set.
+    """
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    accounts = []
+    for entry in entries:
+        name = entry.get('name') or entry['user']
+        password = entry.get('password') or os.getenv(entry.get('password_env', ''), '')
+        if not password:
+            raise RuntimeError(f"Account '{name}' in {path} has no password or password_env")
+        accounts.append(Account(
+            name=name,
+            host=entry.get('host', 'imap.gmail.com'),
+            port=int(entry.get('port', 993)),
+            ssl=bool(entry.get('ssl', True)),
+            user=entry['user'],
+            password=password,
+            report_to=entry.get('report_to', ''),
+            token_file=entry.get('token_file', f'token_{name}.pickle'),
+            include_history=bool(entry.get('include_history', False)),
+        ))
+    if len({a.name for a in accounts}) != len(accounts):
+        raise RuntimeError(f"Account names in {path} must be unique")
+    return accounts
+
+
+class AccountWorker(threading.Thread):
+    """
+    Sync, label and forward loop for one mailbox on its own IMAP connection.
+    Classification goes through the shared FairClassifier.
+    """
+
+    def __init__(self, account, classifier, poll=False, seed_reputation=False, seed_knn=False):
+        super().__init__(name=f"account-{account.name}", daemon=True)
+        self.account = account
+        self.classifier = classifier
+        self.poll = poll
+        # Tables that were empty at startup are seeded from this mailbox's labels on the first connection
+        self.seed_reputation = seed_reputation
+        self.seed_knn = seed_knn
+        self.forwarder = None
+        if account.report_to:
+            self.forwarder = GmailForwarder(token_path=account.token_file,
+                                            report_to=account.report_to, sender=account.user)
+
+    def log(self, level, text):
+        print(f"[{level}] [{self.account.name}] {text}")
+
+    def connect(self):
+        imap = IMAPClient(self.account.host, port=self.account.port, ssl=self.account.ssl)
+        imap.login(self.account.user, self.account.password)
+        imap.select_folder('INBOX')
+        self.log("INFO", f"IMAP connection established: {self.account.host}")
+        return imap
+
+    def seed(self, imap):
+        """Seed the shared reputation table and kNN index from messages already carrying a category label."""
+        if self.seed_reputation:
+            get_reputation().bootstrap_from_imap(imap)
+            self.seed_reputation = False
+        if self.seed_knn:
+            get_knn().bootstrap_from_imap(imap)
+            self.seed_knn = False
+
+    def process(self, imap, sync, uids, mark_seen):
+        run_pipeline(imap, uids, self.forwarder, mark_seen=mark_seen, on_batch_done=sync.discard,
+                     classify_submit=self.classifier.submitter(self.account.name), sync=sync)
+
+    def wait(self, imap, use_idle, max_wait=None):
+        """Block until the mailbox changes, the resync interval passes or max_wait seconds elapse."""
+        if max_wait is not None and max_wait <= 0:
+            return
+        if use_idle:
+            timeout = IDLE_RESYNC_SECONDS if max_wait is None else min(IDLE_RESYNC_SECONDS, max_wait)
+            events = wait_for_changes(imap, timeout)
+            if events:
+                self.log("INFO", f"IDLE wake-up: {events[:5]}")
+        else:
+            time.sleep(CHECK_INTERVAL if max_wait is None else min(CHECK_INTERVAL, max_wait))
+
+    def run(self):
+        while True:
+            imap = None
+            try:
+                imap = self.connect()
+                use_idle = IDLE_ENABLED and not self.poll and supports_idle(imap)
+                ensure_labels(imap)
+                self.seed(imap)
+                sync = MailboxSync(imap, account=self.account.name)
+                scheduler = WorkScheduler(
+                    sync, history_rate=0 if self.account.include_history else HISTORY_RATE_PER_MIN)
+                while True:
+                    sync.refresh()
+                    uids, mark_seen = scheduler.next_batch()
+                    if uids:
+                        kind = "unread" if mark_seen else "historical"
+                        self.log("INFO", f"Processing {len(uids)} {kind} unprocessed emails")
+                        with metrics.timer("round_seconds", kind="unread" if mark_seen else "history"):
+                            self.process(imap, sync, uids, mark_seen)
+                        continue
+                    self.wait(imap, use_idle, scheduler.history_wait())
+            except (IMAPClientAbortError, OSError) as e:
+                self.log("WARN", f"IMAP connection lost ({e}), reconnecting in 30s...")
+            except Exception as e:
+                self.log("ERROR", f"Account loop failed: {e}; restarting in 30s")
+            finally:
+                if imap is not None:
+                    try:
+                        imap.logout()
+                    except Exception:
+                        pass
+            time.sleep(30)
+
+
+def run_daemon(accounts, poll=False, max_inflight=OLLAMA_MAX_INFLIGHT):
+    init_db()
+    start_metrics()
+    # Authorize forwarding accounts up front (may open the browser OAuth flow)
+    for account in accounts:
+        if account.report_to:
+            get_credentials(account.token_file)
+    # Empty reputation table / kNN index: seeded from past results, then from every account's labels
+    reputation = get_reputation()
+    seed_reputation = reputation is not None and reputation.is_empty()
+    if seed_reputation:
+        reputation.bootstrap_from_db()
+    knn = get_knn()
+    seed_knn = knn is not None and knn.is_empty()
+    # One model for every account: loaded on first use, unloaded after OLLAMA_IDLE_UNLOAD idle seconds
+    residency = ModelResidency(warmup=warmup_request())
+    classifier = FairClassifier(max_inflight=max_inflight, residency=residency)
+    workers = [AccountWorker(account, classifier, poll=poll, seed_reputation=seed_reputation, seed_knn=seed_knn)
+               for account in accounts]
+    for worker in workers:
+        worker.start()
+    print(f"[INFO] Daemon started for {len(workers)} accounts: {', '.join(a.name for a in accounts)}")
+    try:
+        while True:
+            residency.wait(CHECK_INTERVAL)
+            print(f"[INFO] Classification queue: {classifier.stats()}")
+            print(f"[INFO] Model residency: {residency.stats()}")
+            print(f"[INFO] Prompt stats: {prompt_stats.stats()}")
+            print(f"[INFO] Ledger: {get_ledger().stats()}")
+            if reputation is not None:
+                print(f"[INFO] Sender reputation: {reputation.stats()}")
+            if knn is not None:
+                print(f"[INFO] kNN index: {knn.stats()}")
+            nb = get_nb()
+            if nb is not None:
+                print(f"[INFO] Naive Bayes: {nb.stats()}")
+            for worker in workers:
+                if not worker.is_alive():
+                    print(f"[ERROR] [{worker.account.name}] account thread stopped")
+    except KeyboardInterrupt:
+        print("[INFO] 收到退出信号，退出中...")
+    finally:
+        classifier.shutdown(wait=False)
+        residency.shutdown()
+        try:
+            write_snapshot()
+        except OSError:
+            pass
+        print("[INFO] Daemon exited, model unloaded.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AI 邮件分类器 multi-account daemon")
+    parser.add_argument('--accounts', default=ACCOUNTS_FILE, help='Accounts JSON file (default: ACCOUNTS_FILE)')
+    parser.add_argument('--poll', action='store_true', help='不使用 IMAP IDLE，按 CHECK_INTERVAL 轮询')
+    parser.add_argument('--max-inflight', type=int, default=OLLAMA_MAX_INFLIGHT,
+                        help='Concurrent classification requests shared by all accounts')
+    args = parser.parse_args()
+    if not args.accounts:
+        parser.error("no accounts file: set ACCOUNTS_FILE or pass --accounts")
+    run_daemon(load_accounts(args.accounts), poll=args.poll, max_inflight=args.max_inflight)
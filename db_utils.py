@@ -0,0 +1,23 @@
+# db_utils.py
+# Shared SQLite connection to the local state database (processed_emails.db).
+import sqlite3
+import threading
+from config import DB_PATH
+
+# Serialises access to the shared connection from worker threads
+db_lock = threading.RLock()
+
+_conn = None
+
+
+def get_db():
+    """Return the process-wide connection to DB_PATH, opening it (in WAL mode) on first use."""
+    global _conn
+    with db_lock:
+        if _conn is None:
+            _conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+            # WAL: readers (tray, isolated main.py processes) never block the writer;
+            # NORMAL sync is durable across application crashes in WAL mode
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute("PRAGMA synchronous=NORMAL")
+        return _conn
@@ -0,0 +1,91 @@
+# fair_queue.py
+# Classification queue shared by several mailboxes, served round-robin by one worker pool.
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from config import OLLAMA_MAX_INFLIGHT
+from classification_utils import classify_content
+
+
+class FairClassifier:
+    """
+    One queue of classification jobs for all accounts, drained by max_inflight
+    worker threads against the single loaded model. Accounts take turns one
+    message at a time, so a large backlog on one account delays the others by
+    at most one message per turn instead of the whole backlog.
+    """
+
+    def __init__(self, max_inflight=OLLAMA_MAX_INFLIGHT, residency=None, classify=classify_content):
+        self.residency = residency
+        self.classify = classify
+        self._queues = OrderedDict()   # account -> deque of (future, body, headers, info)
+        self._turns = deque()          # accounts with queued jobs, in serving order
+        self._cond = threading.Condition()
+        self._closed = False
+        self.served = {}
+        self._workers = [threading.Thread(target=self._work, name=f"classify-{i}", daemon=True)
+                         for i in range(max(1, max_inflight))]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, account, body, headers, info=None) -> Future:
+        """Queue one message for account; the Future resolves to its category (info as in classify_content)."""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("FairClassifier is shut down")
+            queue = self._queues.setdefault(account, deque())
+            if not queue:
+                self._turns.append(account)
+            queue.append((future, body, headers, info))
+            self._cond.notify()
+        return future
+
+    def submitter(self, account):
+        """submit() bound to one account, in the form Pipeline(classify_submit=...) expects."""
+        return lambda body, headers, info=None: self.submit(account, body, headers, info)
+
+    def _next(self):
+        # Caller holds self._cond
+        account = self._turns.popleft()
+        queue = self._queues[account]
+        job = queue.popleft()
+        if queue:
+            self._turns.append(account)
+        self.served[account] = self.served.get(account, 0) + 1
+        return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._turns and not self._closed:
+                    self._cond.wait()
+                if not self._turns:
+                    return
+                future, body, headers, info = self._next()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # The model is loaded only when a message gets past the fast paths to the LLM
+                if self.residency is not None:
+                    future.set_result(self.classify(body, headers, residency=self.residency, info=info))
+                else:
+                    future.set_result(self.classify(body, headers, info=info))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stats(self) -> dict:
+        """Messages served and still queued per account."""
+        with self._cond:
+            return {"served": dict(self.served),
+                    "pending": {a: len(q) for a, q in self._queues.items() if q}}
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs; workers exit once the queue is drained."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
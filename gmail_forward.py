@@ -0,0 +1,252 @@
+# gmail_forward.py
+# Forwarding stage: rewrites messages for the report address and sends them through Gmail API batch requests.
+import base64
+import email
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
+from email.parser import BytesParser
+from email.utils import parseaddr, formataddr
+
+from googleapiclient.errors import HttpError
+
+from config import (
+    REPORT_TO, IMAP_USER, CATEGORY_PREFIX, LABEL_MAP, EXCLUDED_CATEGORIES, PROCESSED_CAT,
+    FORWARD_BATCH_SIZE, FORWARD_WORKERS, FORWARD_RETRIES,
+)
+from gmailauth import get_service, TOKEN_PATH
+from imap_sync import uid_set
+from metrics import metrics
+
+# raw: message bytes when already fetched; msgid: X-GM-MSGID used to fetch them otherwise
+ForwardItem = namedtuple('ForwardItem', 'uid category raw msgid')
+
+# Per-item failures worth retrying: rate limits and server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RETRY_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'backendError')
+# The only failures after which a send is known not to have happened
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def gmail_id_from_msgid(msgid):
+    """IMAP X-GM-MSGID (decimal) -> Gmail API message id (the same number in hex)."""
+    return format(int(msgid), 'x')
+
+
+def build_forward(raw_bytes: bytes, assigned: str, report_to: str = REPORT_TO, sender: str = IMAP_USER) -> str:
+    """
+    Rewrite a message for report_to: category prefix on the subject, From set to
+    sender (our address) with the original display name, Reply-To the original sender.
+    Returns the base64url raw body for messages.send.
+    """
+    msg = BytesParser(policy=policy.default).parsebytes(raw_bytes)
+    subject = msg.get('Subject', '')
+    from_addr = msg.get('From', '')
+    prefix = CATEGORY_PREFIX.get(assigned, "【其他】")
+    orig_name, _ = parseaddr(from_addr)
+    for name, value in (('To', report_to), ('Subject', prefix + subject),
+                        ('From', formataddr((orig_name, sender))), ('Reply-To', from_addr)):
+        if msg.get(name) is not None:
+            msg.replace_header(name, value)
+        else:
+            msg[name] = value
+    return base64.urlsafe_b64encode(msg.as_bytes()).decode()
+
+
+def forward_candidates(uids, imap, results=None, report_to=REPORT_TO) -> list:
+    """
+    ForwardItems for the messages among uids that should go to report_to.
+    results is process_uids() output ({uid: {'category', 'msgid', 'from', ...}});
+    without it (isolated classification) categories are read back from the labels.
+    """
+    if not uids:
+        return []
+    cats = set(LABEL_MAP.values())
+    if results is None:
+        # 一次 FETCH 拉取标签、X-GM-MSGID 和发件人
+        results = {}
+        for uid, d in imap.fetch(uids, ['X-GM-LABELS', 'X-GM-MSGID', 'BODY.PEEK[HEADER.FIELDS (FROM)]']).items():
+            labels = [l.decode() if isinstance(l, bytes) else l for l in d.get(b'X-GM-LABELS', [])]
+            header = next((v for k, v in d.items() if k.upper().startswith(b'BODY[HEADER')), b'')
+            results[uid] = {
+                'category': next((lbl for lbl in labels if lbl in cats), None),
+                'msgid': d.get(b'X-GM-MSGID'),
+                'from': email.message_from_bytes(header or b'').get('From', ''),
+            }
+            print(f"[DEBUG] UID {uid} labels: {labels}")
+
+    to_send = []
+    for uid in uids:
+        info = results.get(uid)
+        if not info:
+            continue
+        from_addr = info.get('from', '')
+        if report_to.lower() in from_addr.lower():
+            print(f"[INFO] UID {uid} 来自 {report_to}，跳过转发")
+            continue
+        assigned = info.get('category')
+        print(f"[DEBUG] UID {uid} assigned = {assigned}")
+        if assigned not in EXCLUDED_CATEGORIES:
+            to_send.append(uid)
+        else:
+            print(f"[INFO] UID {uid} 属于 {assigned}，不转发")
+    if not to_send:
+        return []
+
+    # Messages with neither fetched bytes nor X-GM-MSGID: whole message over IMAP
+    # in one FETCH (PEEK keeps \Seen unchanged)
+    raw = {uid: results[uid].get('raw') for uid in to_send}
+    missing = [uid for uid in to_send if not raw[uid] and not results[uid].get('msgid')]
+    if missing:
+        for uid, d in imap.fetch(missing, ['BODY.PEEK[]']).items():
+            raw[uid] = d.get(b'BODY[]')
+
+    return [ForwardItem(uid, results[uid].get('category'), raw[uid], results[uid].get('msgid'))
+            for uid in to_send]
+
+
+def label_forwarded(imap, outcome):
+    """Add the Processed label to the forwarded messages of a forward() result in one STORE."""
+    sent = [uid for uid, ok in outcome.items() if ok is True]
+    if sent:
+        imap.add_gmail_labels(uid_set(sent), [PROCESSED_CAT], silent=True)
+    return sent
+
+
+def _retryable(exc, idempotent=True) -> bool:
+    """
+    Whether a per-item failure is worth another attempt. A non-idempotent call
+    (messages.send) is only retried when rate-limited: after a server error or a
+    transport failure Gmail may already have sent the message.
+    """
+    if isinstance(exc, HttpError):
+        status = exc.resp.status
+        content = exc.content.decode('utf-8', 'ignore') if isinstance(exc.content, bytes) else str(exc.content)
+        if not idempotent:
+            return status == 429 or (status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS))
+        if status in RETRY_STATUS:
+            return True
+        return status == 403 and any(reason in content for reason in RETRY_REASONS)
+    return idempotent and isinstance(exc, OSError)
+
+
+def _chunks(items, n):
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+
+class GmailForwarder:
+    """
+    Sends forwards on a small thread pool, so forwarding overlaps classification.
+    Each thread uses its own Gmail service (gmailauth.get_service); requests are
+    grouped into batch HTTP requests and only failed items are retried.
+    token_path, report_to and sender select the account.
+    """
+
+    def __init__(self, workers=FORWARD_WORKERS, batch_size=FORWARD_BATCH_SIZE, retries=FORWARD_RETRIES,
+                 token_path=TOKEN_PATH, report_to=REPORT_TO, sender=IMAP_USER):
+        self.token_path = token_path
+        self.report_to = report_to
+        self.sender = sender
+        self.batch_size = max(1, min(int(batch_size), 100))  # Gmail allows 100 calls per batch
+        self.retries = retries
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='forward')
+
+    def _execute(self, service, make_request, keys, op='send', idempotent=False):
+        """
+        Run make_request(key) for every key in batch requests (op names them in metrics).
+        Returns {key: response or exception}; retryable failures are resent with backoff.
+        Unless idempotent, a failure of the batch request itself is not retried.
+        """
+        results = {}
+        pending = list(keys)
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            if attempt:
+                time.sleep(min(30.0, 2 ** attempt) + random.random())
+                print(f"[INFO] Gmail API: retrying {len(pending)} items (attempt {attempt + 1})")
+            retry = []
+            for chunk in _chunks(pending, self.batch_size):
+                replies = {}
+
+                def callback(request_id, response, exception):
+                    replies[request_id] = (response, exception)
+
+                batch = service.new_batch_http_request(callback=callback)
+                for i, key in enumerate(chunk):
+                    batch.add(make_request(key), request_id=str(i))
+                try:
+                    with metrics.timer("gmail_batch_seconds", op=op):
+                        batch.execute()
+                    failed = False
+                except (HttpError, OSError) as e:
+                    # The batch request itself failed: every item gets the error
+                    replies = {str(i): (None, e) for i in range(len(chunk))}
+                    failed = True
+                for i, key in enumerate(chunk):
+                    response, exc = replies.get(str(i), (None, RuntimeError('no reply in batch response')))
+                    if exc is None:
+                        results[key] = response
+                    elif attempt < self.retries and (idempotent or not failed) and _retryable(exc, idempotent):
+                        metrics.inc("gmail_retries_total", op=op)
+                        retry.append(key)
+                    else:
+                        results[key] = exc
+            pending = retry
+        return results
+
+    def forward(self, items) -> dict:
+        """
+        Forward the ForwardItems; returns {uid: True} for sent messages and
+        {uid: exception} for the ones that failed after retries.
+        """
+        items = list(items)
+        if not items:
+            return {}
+        service = get_service(self.token_path)
+        messages = service.users().messages()
+        outcome = {}
+
+        # Message bytes not fetched yet: one batched messages.get(format=raw) by X-GM-MSGID
+        raw = {item.uid: item.raw for item in items if item.raw}
+        by_id = {gmail_id_from_msgid(item.msgid): item.uid for item in items if not item.raw and item.msgid}
+        if by_id:
+            got = self._execute(service, lambda gid: messages.get(userId='me', id=gid, format='raw'), by_id,
+                                op='get', idempotent=True)
+            for gid, uid in by_id.items():
+                if isinstance(got.get(gid), dict):
+                    raw[uid] = base64.urlsafe_b64decode(got[gid]['raw'])
+                else:
+                    outcome[uid] = got.get(gid)
+        bodies = {}
+        for item in items:
+            if item.uid not in raw:
+                outcome.setdefault(item.uid, RuntimeError('message bytes unavailable'))
+                continue
+            try:
+                bodies[item.uid] = build_forward(raw[item.uid], item.category, self.report_to, self.sender)
+            except Exception as e:
+                outcome[item.uid] = e
+
+        sent = self._execute(service, lambda uid: messages.send(userId='me', body={'raw': bodies[uid]}), bodies)
+        for uid, result in sent.items():
+            outcome[uid] = True if isinstance(result, dict) else result
+
+        for uid, result in outcome.items():
+            if result is not True:
+                print(f"[ERROR] Forward failed uid={uid}: {result}")
+        ok = sum(1 for r in outcome.values() if r is True)
+        metrics.inc("forwards_total", ok, result="sent")
+        metrics.inc("forwards_total", len(outcome) - ok, result="failed")
+        print(f"[INFO] Forwarded {ok}/{len(items)} emails → {self.report_to}")
+        return outcome
+
+    def submit(self, items):
+        """Forward in the background; returns a Future resolving to forward()'s result."""
+        return self._pool.submit(self.forward, list(items))
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -13,4 +13,4 @@ def ensure_labels(imap):
     needed = set(LABEL_MAP.values())|{LABEL_MAP[PROCESSED_CAT]}
     for lbl in needed-existing:
         try: imap.create_folder(lbl)
-        except: pass
\ No newline at end of file
+        except: pass
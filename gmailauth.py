@@ -1,11 +1,16 @@
 # gmailauth.py
 
+import json
 import os
 import pickle
+import threading
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+from config import GMAIL_API_ENDPOINT, GMAIL_TOKEN_PATH
 
 #
 SCOPES = [
@@ -14,32 +19,59 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.compose',
 ]
 
-def get_service():
-    creds = None
-    # 1) 
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as f:
-            creds = pickle.load(f)
-
-   
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+# Default token file (single-account launcher)
+TOKEN_PATH = GMAIL_TOKEN_PATH
+
+# One credential per token file, shared by every thread's service
+_creds = {}
+_creds_lock = threading.Lock()
+# httplib2 (used by googleapiclient) is not thread-safe: one service per thread
+_local = threading.local()
+
+def get_credentials(token_path=TOKEN_PATH):
+    """Load, refresh or obtain the OAuth credential (cached; refreshed once when expired)."""
+    with _creds_lock:
+        creds = _creds.get(token_path)
+        # 1)
+        if creds is None and os.path.exists(token_path):
+            with open(token_path, 'rb') as f:
+                creds = pickle.load(f)
+
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    'credentials.json', SCOPES
+                )
+                creds = flow.run_local_server(port=0)
+            # save token
+            with open(token_path, 'wb') as f:
+                pickle.dump(creds, f)
+        _creds[token_path] = creds
+        return creds
+
+def get_service(token_path=TOKEN_PATH):
+    """Gmail API service for the calling thread and token file, built once and reused."""
+    creds = get_credentials(token_path)
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    service = services.get(token_path)
+    if service is None:
+        if GMAIL_API_ENDPOINT:
+            # Bundled discovery document with its root (batch requests included) moved to the endpoint
+            doc = json.loads(get_static_doc('gmail', 'v1'))
+            doc['rootUrl'] = GMAIL_API_ENDPOINT.rstrip('/') + '/'
+            service = build_from_document(doc, credentials=creds)
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES
+            # 3)
+            service = build(
+                'gmail', 'v1',
+                credentials=creds,
+                cache_discovery=False,
+                static_discovery=False
             )
-            creds = flow.run_local_server(port=0)
-        # save token
-        with open('token.pickle', 'wb') as f:
-            pickle.dump(creds, f)
-
-    # 3)
-    service = build(
-        'gmail', 'v1',
-        credentials=creds,
-        cache_discovery=False,
-        static_discovery=False
-    )
+        services[token_path] = service
 
     return service
@@ -0,0 +1,366 @@
+# imap_sync.py
+# Mailbox change detection: IMAP IDLE push notifications and incremental
+# discovery of unprocessed messages (UIDVALIDITY / UIDNEXT / CONDSTORE).
+import time
+
+from config import IDLE_RENEW_SECONDS, PROCESSED_CAT, HISTORY_RATE_PER_MIN, HISTORY_CHUNK
+from db_utils import get_db, db_lock
+from ledger import get_ledger
+from metrics import metrics
+
+# Untagged responses that mean the mailbox content or flags/labels changed
+WAKE_RESPONSES = (b'EXISTS', b'FETCH')
+
+
+def supports_idle(imap) -> bool:
+    return imap.has_capability('IDLE')
+
+
+def _wake_events(responses):
+    return [r for r in responses if isinstance(r, tuple) and len(r) > 1 and r[1] in WAKE_RESPONSES]
+
+
+def wait_for_changes(imap, max_wait, tick=5.0, on_tick=None, renew=IDLE_RENEW_SECONDS):
+    """
+    Block in IMAP IDLE until the server reports EXISTS or FETCH, or max_wait seconds pass.
+    IDLE is re-issued every `renew` seconds so the server never times it out.
+    on_tick() is called about every `tick` seconds while waiting.
+    Returns the wake-up responses ([] on timeout).
+    """
+    deadline = time.monotonic() + max_wait
+    while True:
+        imap.idle()
+        started = time.monotonic()
+        events = []
+        try:
+            while not events:
+                now = time.monotonic()
+                remaining = min(deadline - now, renew - (now - started))
+                if remaining <= 0:
+                    break
+                events = _wake_events(imap.idle_check(timeout=min(tick, remaining)))
+                if on_tick is not None:
+                    on_tick()
+        finally:
+            _, responses = imap.idle_done()
+        events += _wake_events(responses)
+        if events:
+            return events
+        if time.monotonic() >= deadline:
+            return []
+
+
+def _chunks(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i+n]
+
+
+def uid_set(uids) -> str:
+    """Compact IMAP sequence set for uids, e.g. [1, 2, 3, 7] -> "1:3,7"."""
+    parts = []
+    start = prev = None
+    for uid in sorted(set(uids)):
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            parts.append(f"{start}:{prev}" if prev != start else str(start))
+        start = prev = uid
+    if start is not None:
+        parts.append(f"{start}:{prev}" if prev != start else str(start))
+    return ",".join(parts)
+
+
+def _labels(d):
+    return [l.decode() if isinstance(l, bytes) else l for l in d.get(b'X-GM-LABELS', [])]
+
+
+def _is_unseen(d):
+    flags = [f.decode() if isinstance(f, bytes) else f for f in d.get(b'FLAGS', [])]
+    return '\\Seen' not in flags
+
+
+def is_gmail(imap) -> bool:
+    """Gmail IMAP extensions (X-GM-RAW, X-GM-LABELS, X-GM-MSGID) are available."""
+    return imap.has_capability('X-GM-EXT-1')
+
+
+def unprocessed_query() -> str:
+    """Gmail search query for messages without the Processed label."""
+    # Gmail search spells spaces in label names as dashes
+    return '-label:' + PROCESSED_CAT.replace(' ', '-')
+
+
+def get_unprocessed_uids(imap, limit_to_unseen=False):
+    """
+    UIDs of messages without the Processed label.
+    On Gmail the filtering is done by the server in a single X-GM-RAW search;
+    other servers fall back to fetching X-GM-LABELS in batches of 100.
+    """
+    label = "unread and unprocessed" if limit_to_unseen else "unprocessed"
+    if is_gmail(imap):
+        criteria = ['X-GM-RAW', unprocessed_query()]
+        if limit_to_unseen:
+            criteria = ['UNSEEN'] + criteria
+        unproc = sorted(imap.search(criteria))
+        print(f"[INFO] Detected {len(unproc)} {label} emails (server-side search).")
+        return unproc
+
+    target_uids = imap.search(['UNSEEN']) if limit_to_unseen else imap.search(['ALL'])
+    if not target_uids:
+        print("[INFO] 没有邮件需要检查")
+        return []
+    unproc = []
+    for batch in _chunks(target_uids, 100):
+        data = imap.fetch(batch, ['X-GM-LABELS'])
+        for uid, d in data.items():
+            if PROCESSED_CAT not in _labels(d):
+                unproc.append(uid)
+    print(f"[INFO] Detected {len(unproc)} {label} emails.")
+    return unproc
+
+
+class MailboxSync:
+    """
+    Incrementally maintained set of unprocessed UIDs for one folder.
+    The folder's UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ and the pending UIDs are
+    stored in processed_emails.db. refresh() only fetches messages changed since
+    the stored modseq (CONDSTORE) or, without CONDSTORE, UIDs at or above the
+    stored UIDNEXT. The whole folder is rescanned only on first use or when
+    UIDVALIDITY changes. With several accounts in one database, account
+    namespaces the stored state. Messages in the processing ledger count as
+    processed whatever their labels say; record(), mark_sent(), forwarded()
+    and results() read and write the ledger rows of this folder.
+    """
+
+    def __init__(self, imap, folder='INBOX', conn=None, account=None, ledger=None):
+        self.imap = imap
+        self.folder = folder
+        # Row key in sync_state/sync_pending/processed; a bare folder name for the single-account launcher
+        self.key = f"{account}/{folder}" if account else folder
+        self.conn = conn or get_db()
+        self.ledger = ledger or get_ledger()
+        with db_lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    folder TEXT PRIMARY KEY,
+                    uidvalidity INTEGER,
+                    uidnext INTEGER,
+                    highestmodseq INTEGER,
+                    updated_at REAL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_pending (
+                    folder TEXT NOT NULL,
+                    uid INTEGER NOT NULL,
+                    unseen INTEGER NOT NULL,
+                    PRIMARY KEY (folder, uid)
+                )
+            ''')
+            self.conn.commit()
+        state = self._load_state()
+        self.uidvalidity = state[0] if state else None
+
+    def _load_state(self):
+        with db_lock:
+            return self.conn.execute(
+                "SELECT uidvalidity, uidnext, highestmodseq FROM sync_state WHERE folder = ?",
+                (self.key,)).fetchone()
+
+    def _save_state(self, uidvalidity, uidnext, modseq):
+        with db_lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_state (folder, uidvalidity, uidnext, highestmodseq, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)", (self.key, uidvalidity, uidnext, modseq, time.time()))
+            self.conn.commit()
+
+    def _status(self):
+        status = self.imap.select_folder(self.folder)
+        uidvalidity = status.get(b'UIDVALIDITY')
+        uidnext = status.get(b'UIDNEXT')
+        modseq = status.get(b'HIGHESTMODSEQ')
+        if modseq is None and self.imap.has_capability('CONDSTORE'):
+            modseq = self.imap.folder_status(self.folder, [b'HIGHESTMODSEQ']).get(b'HIGHESTMODSEQ')
+        return uidvalidity, uidnext, modseq
+
+    def _apply(self, data, min_uid=0):
+        """Update pending rows from FETCH results (X-GM-LABELS, FLAGS)."""
+        added = removed = 0
+        done = self.ledger.processed(self.key, self.uidvalidity, data.keys())
+        with db_lock:
+            for uid, d in data.items():
+                if uid < min_uid:
+                    continue
+                if uid in done or PROCESSED_CAT in _labels(d):
+                    self.conn.execute("DELETE FROM sync_pending WHERE folder = ? AND uid = ?", (self.key, uid))
+                    removed += 1
+                else:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO sync_pending (folder, uid, unseen) VALUES (?, ?, ?)",
+                        (self.key, uid, int(_is_unseen(d))))
+                    added += 1
+            self.conn.commit()
+        return added, removed
+
+    def full_resync(self):
+        """Rebuild the pending set from the whole folder."""
+        print(f"[INFO] Full resync of {self.folder}...")
+        with db_lock:
+            self.conn.execute("DELETE FROM sync_pending WHERE folder = ?", (self.key,))
+            self.conn.commit()
+        if is_gmail(self.imap):
+            # Two server-side searches instead of fetching labels for every message
+            pending = get_unprocessed_uids(self.imap)
+            unseen = set(get_unprocessed_uids(self.imap, limit_to_unseen=True))
+        else:
+            # No Gmail labels: the ledger alone says what has been processed
+            pending = self.imap.search(['ALL'])
+            unseen = set(self.imap.search(['UNSEEN']))
+        done = self.ledger.processed(self.key, self.uidvalidity, pending)
+        with db_lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO sync_pending (folder, uid, unseen) VALUES (?, ?, ?)",
+                [(self.key, uid, int(uid in unseen)) for uid in pending if uid not in done])
+            self.conn.commit()
+        print(f"[INFO] Full resync: {len(pending) - len(done)} pending, {len(done)} already in the ledger")
+
+    def refresh(self):
+        """Bring the pending set up to date with the server."""
+        with metrics.timer("stage_seconds", stage="sync"):
+            self._refresh()
+
+    def _refresh(self):
+        uidvalidity, uidnext, modseq = self._status()
+        state = self._load_state()
+        if state is None or state[0] != uidvalidity:
+            if state is not None:
+                print(f"[INFO] UIDVALIDITY changed ({state[0]} -> {uidvalidity})")
+            self.uidvalidity = uidvalidity
+            self.full_resync()
+        else:
+            _, last_uidnext, last_modseq = state
+            if modseq is not None and last_modseq is not None:
+                if modseq > last_modseq:
+                    # New messages and label/flag changes since the last round
+                    data = self.imap.fetch('1:*', ['X-GM-LABELS', 'FLAGS'],
+                                           modifiers=[f'CHANGEDSINCE {last_modseq}'])
+                    added, removed = self._apply(data)
+                    print(f"[INFO] Incremental sync: {len(data)} changed, {added} pending, {removed} processed")
+            elif uidnext and last_uidnext and uidnext > last_uidnext:
+                # No CONDSTORE: only new UIDs are discovered
+                data = self.imap.fetch(f'{last_uidnext}:*', ['X-GM-LABELS', 'FLAGS'])
+                added, _ = self._apply(data, min_uid=last_uidnext)
+                print(f"[INFO] Incremental sync: {added} new pending")
+        self._save_state(uidvalidity, uidnext, modseq)
+
+    def unprocessed(self, limit_to_unseen=False):
+        """Pending UIDs in ascending order, optionally only unread ones."""
+        sql = "SELECT uid FROM sync_pending WHERE folder = ?" + (" AND unseen = 1" if limit_to_unseen else "")
+        with db_lock:
+            uids = [row[0] for row in self.conn.execute(sql + " ORDER BY uid", (self.key,))]
+        label = "unread and unprocessed" if limit_to_unseen else "unprocessed"
+        print(f"[INFO] {len(uids)} {label} emails pending.")
+        return uids
+
+    def discard(self, uids):
+        """Drop UIDs that have been handled (or no longer exist) from the pending set."""
+        with db_lock:
+            self.conn.executemany("DELETE FROM sync_pending WHERE folder = ? AND uid = ?",
+                                  [(self.key, uid) for uid in uids])
+            self.conn.commit()
+
+    def record(self, results):
+        """Write label_batch() results to the ledger (one transaction)."""
+        self.ledger.record(self.key, self.uidvalidity, results)
+
+    def mark_sent(self, uids):
+        self.ledger.mark_sent(self.key, self.uidvalidity, uids)
+
+    def forwarded(self, uids) -> set:
+        """UIDs among uids already forwarded, from the ledger."""
+        return self.ledger.sent(self.key, self.uidvalidity, uids)
+
+    def results(self, uids) -> dict:
+        """Ledger results for uids, in forward_candidates() form."""
+        return self.ledger.results(self.key, self.uidvalidity, uids)
+
+
+# Seconds before a batch that is still pending right after being processed is retried
+STALL_BACKOFF = 60.0
+
+
+class WorkScheduler:
+    """
+    Picks the next UIDs to process from a MailboxSync's persistent pending set.
+    Unread mail has strict priority and is always taken in full; read history is
+    released HISTORY_CHUNK at a time at history_rate messages per minute
+    (token bucket; 0 = as fast as possible, None = never).
+    """
+
+    def __init__(self, sync, history_rate=HISTORY_RATE_PER_MIN, chunk=HISTORY_CHUNK):
+        self.sync = sync
+        self.history_rate = history_rate
+        self.chunk = max(1, chunk)
+        self.tokens = float(self.chunk)
+        self._updated = time.monotonic()
+        self._last = None
+        self._stalled_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.history_rate:
+            self.tokens = min(self.chunk, self.tokens + (now - self._updated) * self.history_rate / 60.0)
+        self._updated = now
+
+    def _release(self, uids, mark_seen):
+        # The same UIDs coming back means the last attempt failed: back off instead of spinning
+        now = time.monotonic()
+        if uids == self._last:
+            if not self._stalled_until:
+                self._stalled_until = now + STALL_BACKOFF
+                print(f"[WARN] {len(uids)} UIDs still pending after processing, retrying in {STALL_BACKOFF:.0f}s")
+            if now < self._stalled_until:
+                return [], False
+        self._stalled_until = 0.0
+        self._last = uids
+        return uids, mark_seen
+
+    def next_batch(self):
+        """
+        Return (uids, mark_seen): all pending unread mail, else a history chunk
+        if the rate allows one now, else ([], False).
+        """
+        unread = self.sync.unprocessed(limit_to_unseen=True)
+        if unread:
+            return self._release(unread, True)
+        if self.history_rate is None:
+            return [], False
+        history = self.sync.unprocessed(limit_to_unseen=False)
+        if not history:
+            return [], False
+        size = min(self.chunk, len(history))
+        if self.history_rate:
+            self._refill()
+            if self.tokens < size:
+                return [], False
+        uids, mark_seen = self._release(history[:size], False)
+        if uids and self.history_rate:
+            self.tokens -= size
+        return uids, mark_seen
+
+    def history_wait(self):
+        """Seconds until the next history chunk may start, or None when no history is waiting."""
+        if self.history_rate is None:
+            return None
+        with db_lock:
+            pending = self.sync.conn.execute(
+                "SELECT COUNT(*) FROM sync_pending WHERE folder = ?", (self.sync.key,)).fetchone()[0]
+        if not pending:
+            return None
+        stalled = max(0.0, self._stalled_until - time.monotonic()) if self._stalled_until else 0.0
+        if not self.history_rate:
+            return stalled
+        self._refill()
+        missing = min(self.chunk, pending) - self.tokens
+        return max(stalled, missing * 60.0 / self.history_rate)
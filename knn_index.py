@@ -0,0 +1,243 @@
+# knn_index.py
+# Nearest-neighbour fast path: embeddings of already classified mail in a memory-mapped
+# NumPy index; a message close to several agreeing neighbours skips the LLM.
+import http.client
+import json
+import math
+import os
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency, the fast path is off without it
+    np = None
+
+from config import (
+    MAIN_CATS, OLLAMA_URL, OLLAMA_IDLE_UNLOAD, KNN_INDEX_PATH, KNN_EMBEDDER, KNN_EMBED_MODEL, KNN_HASH_DIM,
+    KNN_K, KNN_MIN_SIMILARITY, KNN_MIN_AGREEMENT, KNN_BODY_CHARS,
+)
+from metrics import metrics
+from ollama_utils import get_client, OllamaHTTPError
+from text_features import features, feature_hash
+
+EMBED_PATH = urllib.parse.urlsplit(OLLAMA_URL).path.rsplit("/", 1)[0] + "/embed"
+
+# Share of the cosine similarity contributed by each feature field (sender, subject, body)
+FIELD_WEIGHTS = {"a": 0.3, "s": 0.3, "b": 0.4}
+
+# Bump when the hashing vectorizer changes; an index built by another embedder is discarded
+HASH_VERSION = 1
+
+
+def available() -> bool:
+    return np is not None
+
+
+def hash_vector(headers: dict, body: str, dim: int = KNN_HASH_DIM, body_chars: int = KNN_BODY_CHARS):
+    """
+    Signed feature-hashing embedding with sublinear term frequency. Each field is
+    normalised on its own and scaled so the dot product of two vectors is the
+    FIELD_WEIGHTS-weighted mean of the per-field cosine similarities.
+    """
+    fields = {}
+    for feat in features(headers, body, body_chars):
+        fields.setdefault(feat[0], Counter())[feat] += 1
+    vec = np.zeros(dim, dtype=np.float32)
+    for field, counts in fields.items():
+        hashes = np.fromiter((feature_hash(f) for f in counts), dtype=np.uint32, count=len(counts))
+        values = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        values[hashes & 0x80000000 != 0] *= -1
+        part = np.zeros(dim, dtype=np.float32)
+        np.add.at(part, hashes % dim, values)
+        norm = np.linalg.norm(part)
+        if norm:
+            vec += part * (math.sqrt(FIELD_WEIGHTS.get(field, 0.0)) / norm)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def embed_text(headers: dict, body: str, body_chars: int = KNN_BODY_CHARS) -> str:
+    """Text sent to the embedding model."""
+    return f"From: {headers.get('From', '')}\nSubject: {headers.get('Subject', '')}\n\n{(body or '')[:body_chars]}"
+
+
+class KnnIndex:
+    """
+    Append-only float32 file of rows [vector..., category index], memory-mapped for
+    search so startup does not read it. New LLM answers are appended as they arrive;
+    the mapping is refreshed from the file size, so rows written by other processes
+    (isolated main.py runs) are picked up too. A <path>.json sidecar records the
+    embedder; an index built by a different embedder is discarded.
+    """
+
+    def __init__(self, path=KNN_INDEX_PATH, embedder=KNN_EMBEDDER, model=KNN_EMBED_MODEL, dim=KNN_HASH_DIM,
+                 k=KNN_K, min_similarity=KNN_MIN_SIMILARITY, min_agreement=KNN_MIN_AGREEMENT):
+        self.path = path
+        self.meta_path = f"{path}.json"
+        self.embedder = embedder
+        self.model = model
+        self.k = k
+        self.min_similarity = min_similarity
+        self.min_agreement = min_agreement
+        self.embedder_id = f"ollama:{model}" if embedder == "ollama" else f"hash:{dim}:v{HASH_VERSION}"
+        # Unknown for Ollama embeddings until the first vector comes back
+        self.dim = None if embedder == "ollama" else dim
+        self.rows = 0
+        self.lookups = 0
+        self.saved = 0
+        self._mm = None
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        if meta.get("embedder") != self.embedder_id:
+            if os.path.exists(self.path):
+                print(f"[INFO] kNN index: built by {meta.get('embedder')}, now {self.embedder_id}; starting a new one")
+                os.remove(self.path)
+            meta = {"embedder": self.embedder_id, "dim": self.dim}
+            if self.dim:
+                self._write_meta(meta)
+        self.dim = meta.get("dim") or self.dim
+        if self.dim and os.path.exists(self.path):
+            row_bytes = 4 * (self.dim + 1)
+            size = os.path.getsize(self.path)
+            if size % row_bytes:
+                # A partly written last row (crash during append)
+                with open(self.path, "r+b") as f:
+                    f.truncate(size - size % row_bytes)
+            self.rows = size // row_bytes
+
+    def _write_meta(self, meta):
+        tmp = f"{self.meta_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+    def embed(self, headers: dict, body: str):
+        """Unit vector for one message, or None when the embedding model fails."""
+        vectors = self.embed_many([(headers, body)])
+        return None if vectors is None else vectors[0]
+
+    def embed_many(self, messages):
+        """Unit vectors (one row per (headers, body)), or None when the embedding model fails."""
+        messages = list(messages)
+        if not messages:
+            return None
+        if self.embedder != "ollama":
+            return np.stack([hash_vector(headers, body, self.dim) for headers, body in messages])
+        try:
+            with metrics.timer("knn_embed_seconds"):
+                resp = get_client().post_json(EMBED_PATH, {
+                    "model": self.model,
+                    "input": [embed_text(headers, body) for headers, body in messages],
+                    "keep_alive": max(1, int(OLLAMA_IDLE_UNLOAD)),
+                })
+            vectors = np.asarray(resp["embeddings"], dtype=np.float32)
+        except (OllamaHTTPError, OSError, http.client.HTTPException, ValueError, KeyError) as e:
+            metrics.inc("knn_errors_total")
+            print(f"[WARN] kNN embedding failed ({type(e).__name__}: {e}), using the LLM")
+            return None
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+    def _matrix(self):
+        """Current rows as a read-only memmap (None when empty). Caller holds _lock."""
+        if self.dim is None or not os.path.exists(self.path):
+            return None
+        rows = os.path.getsize(self.path) // (4 * (self.dim + 1))
+        if rows != self.rows or self._mm is None:
+            self.rows = rows
+            self._mm = np.memmap(self.path, dtype=np.float32, mode="r", shape=(rows, self.dim + 1)) if rows else None
+        return self._mm
+
+    def add_many(self, vectors, categories):
+        """Append vectors with their categories in one write."""
+        cats = [MAIN_CATS.index(c) if c in MAIN_CATS else -1 for c in categories]
+        keep = [i for i, c in enumerate(cats) if c >= 0]
+        if vectors is None or not keep:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)[keep]
+        rows = np.hstack([vectors, np.asarray([cats[i] for i in keep], dtype=np.float32)[:, None]])
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._write_meta({"embedder": self.embedder_id, "dim": self.dim})
+            if vectors.shape[1] != self.dim:
+                print(f"[WARN] kNN index: vector size {vectors.shape[1]} != {self.dim}, not added")
+                return
+            # Release the mapping before the file grows (required on Windows)
+            self._mm = None
+            with open(self.path, "ab") as f:
+                f.write(rows.tobytes())
+            self.rows += len(keep)
+
+    def add(self, vector, category: str):
+        if vector is not None:
+            self.add_many(vector[None, :], [category])
+
+    def search(self, vector, k=None):
+        """The k nearest rows as [(similarity, category)], most similar first."""
+        k = k or self.k
+        with self._lock:
+            matrix = self._matrix()
+            if matrix is None or vector is None or len(vector) != self.dim:
+                return []
+            # Rows are [vector, label]; a zero in the label position keeps the product contiguous
+            sims = matrix @ np.append(vector, np.float32(0.0))
+            k = min(k, len(sims))
+            top = np.argpartition(-sims, k - 1)[:k]
+            top = top[np.argsort(-sims[top])]
+            labels = matrix[top, self.dim].astype(int)
+        return [(float(sims[i]), MAIN_CATS[label]) for i, label in zip(top, labels)]
+
+    def lookup(self, vector):
+        """The category agreed on by the nearest neighbours, or None."""
+        start = time.perf_counter()
+        neighbours = self.search(vector)
+        metrics.observe("knn_search_seconds", time.perf_counter() - start)
+        with self._lock:
+            self.lookups += 1
+        if len(neighbours) < self.k:
+            return None
+        votes = Counter(cat for sim, cat in neighbours if sim >= self.min_similarity)
+        if not votes:
+            return None
+        cat, count = votes.most_common(1)[0]
+        print(f"[DEBUG] kNN: {count}/{self.k} neighbours {cat}, nearest similarity {neighbours[0][0]:.3f}")
+        if count / self.k < self.min_agreement:
+            return None
+        with self._lock:
+            self.saved += 1
+        return cat
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._matrix() is None
+
+    def bootstrap_from_imap(self, imap, per_label=300, batch=100):
+        """Seed from the newest per_label messages carrying each Gmail category label (headers and text part only)."""
+        # main imports classification_utils, which imports this module
+        from main import fetch_partial
+        labelled = {}
+        for cat in MAIN_CATS:
+            for uid in imap.search(['X-GM-LABELS', cat])[-per_label:]:
+                # Messages carrying two category labels are ambiguous
+                labelled[uid] = cat if uid not in labelled else None
+        uids = [uid for uid, cat in labelled.items() if cat]
+        for i in range(0, len(uids), batch):
+            parsed = fetch_partial(imap, uids[i:i + batch])
+            vectors = self.embed_many([(headers, body) for _, _, _, body, headers in parsed])
+            self.add_many(vectors, [labelled[uid] for uid, *_ in parsed])
+        print(f"[INFO] kNN index: seeded from {len(uids)} labeled messages ({self.rows} rows)")
+        return len(uids)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rows": self.rows, "lookups": self.lookups, "llm_calls_saved": self.saved}
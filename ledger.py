@@ -0,0 +1,142 @@
+# ledger.py
+# Processing ledger in processed_emails.db: one row per classified message, the
+# local system of record for "already processed" and "already forwarded" checks.
+import threading
+from datetime import datetime, timezone
+
+from db_utils import get_db, db_lock
+
+_UPSERT = '''
+    INSERT INTO processed (folder, uidvalidity, uid, msgid, processed_at, was_unread, category, source, from_addr)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (folder, uidvalidity, uid) DO UPDATE SET
+        msgid = COALESCE(excluded.msgid, msgid),
+        processed_at = excluded.processed_at,
+        was_unread = COALESCE(was_unread, excluded.was_unread),
+        category = excluded.category,
+        source = COALESCE(excluded.source, source),
+        from_addr = COALESCE(excluded.from_addr, from_addr)
+'''
+
+
+def _placeholders(n):
+    return ','.join('?' * n)
+
+
+class Ledger:
+    """
+    Rows are keyed by (folder, uidvalidity, uid); folder is the MailboxSync key
+    (account/folder for the multi-account daemon). Writes are one transaction
+    per labelled batch. source records what produced the category ("llm",
+    "cache", "rules", "reputation", "nb", "knn"; NULL for rows written before it
+    was tracked). A 'processed' table from older versions (keyed by uid alone,
+    never written) is kept as processed_v1.
+    """
+
+    def __init__(self, conn=None):
+        self.conn = conn or get_db()
+        with db_lock:
+            columns = [col[1] for col in self.conn.execute("PRAGMA table_info(processed)")]
+            if columns and 'uidvalidity' not in columns:
+                print("[INFO] Ledger: renaming old processed table to processed_v1")
+                self.conn.execute("ALTER TABLE processed RENAME TO processed_v1")
+            elif columns and 'source' not in columns:
+                self.conn.execute("ALTER TABLE processed ADD COLUMN source TEXT")
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS processed (
+                    folder TEXT NOT NULL,
+                    uidvalidity INTEGER NOT NULL,
+                    uid INTEGER NOT NULL,
+                    msgid INTEGER,
+                    processed_at TEXT,
+                    sent INTEGER DEFAULT 0,
+                    was_unread INTEGER,
+                    category TEXT,
+                    source TEXT,
+                    from_addr TEXT,
+                    PRIMARY KEY (folder, uidvalidity, uid)
+                )
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_uid ON processed (uidvalidity, uid)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_category ON processed (category)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_at ON processed (processed_at)")
+            self.conn.commit()
+
+    def record(self, folder, uidvalidity, results):
+        """Upsert label_batch() results ({uid: {'category', 'source', 'msgid', 'from', 'unread'}}) in one transaction."""
+        if not results:
+            return
+        now = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        rows = []
+        for uid, info in results.items():
+            msgid = info.get('msgid')
+            unread = info.get('unread')
+            rows.append((folder, uidvalidity, uid, int(msgid) if msgid is not None else None, now,
+                         None if unread is None else int(unread), info.get('category'), info.get('source'),
+                         info.get('from') or None))
+        with db_lock:
+            self.conn.executemany(_UPSERT, rows)
+            self.conn.commit()
+
+    def mark_sent(self, folder, uidvalidity, uids):
+        """Flag forwarded messages in one transaction."""
+        uids = list(uids)
+        if not uids:
+            return
+        with db_lock:
+            self.conn.executemany("UPDATE processed SET sent = 1 WHERE folder = ? AND uidvalidity = ? AND uid = ?",
+                                  [(folder, uidvalidity, uid) for uid in uids])
+            self.conn.commit()
+
+    def _select(self, columns, folder, uidvalidity, uids, where=''):
+        rows = []
+        uids = list(uids)
+        with db_lock:
+            # Bound parameters per statement stay under SQLite's limit
+            for i in range(0, len(uids), 500):
+                chunk = uids[i:i + 500]
+                rows.extend(self.conn.execute(
+                    f"SELECT {columns} FROM processed WHERE folder = ? AND uidvalidity = ? "
+                    f"AND uid IN ({_placeholders(len(chunk))}){where}",
+                    (folder, uidvalidity, *chunk)))
+        return rows
+
+    def processed(self, folder, uidvalidity, uids) -> set:
+        """The UIDs among uids that already have a ledger row."""
+        return {row[0] for row in self._select('uid', folder, uidvalidity, uids)}
+
+    def sent(self, folder, uidvalidity, uids) -> set:
+        """The UIDs among uids that have already been forwarded."""
+        return {row[0] for row in self._select('uid', folder, uidvalidity, uids, ' AND sent = 1')}
+
+    def results(self, folder, uidvalidity, uids) -> dict:
+        """Stored results for uids in forward_candidates() form ({uid: {'category', 'msgid', 'from'}})."""
+        return {uid: {'category': category, 'msgid': msgid, 'from': from_addr or ''}
+                for uid, category, msgid, from_addr
+                in self._select('uid, category, msgid, from_addr', folder, uidvalidity, uids)}
+
+    def categories(self, folder, uidvalidity, sources) -> dict:
+        """{uid: category} for the rows of folder whose category came from one of sources."""
+        sources = list(sources)
+        with db_lock:
+            return dict(self.conn.execute(
+                f"SELECT uid, category FROM processed WHERE folder = ? AND uidvalidity = ? "
+                f"AND source IN ({_placeholders(len(sources))})", (folder, uidvalidity, *sources)))
+
+    def stats(self) -> dict:
+        with db_lock:
+            total, sent = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(sent), 0) FROM processed").fetchone()
+        return {"processed": total, "forwarded": sent}
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    """Return the shared Ledger on the process-wide connection."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger()
+        return _ledger
@@ -4,9 +4,19 @@ import argparse
 import sys
 from imapclient import IMAPClient
 
-from config import IMAP_HOST, IMAP_USER, IMAP_PASS, PROCESSED_CAT, LABEL_MAP
-from classification_utils import classify_content, fetch_plaintext
+from config import (
+    IMAP_HOST, IMAP_PORT, IMAP_SSL, IMAP_USER, IMAP_PASS, PROCESSED_CAT, LABEL_MAP, OLLAMA_MAX_INFLIGHT,
+    FETCH_MODE, PARTIAL_FETCH_BYTES, require_imap_config,
+)
+from classification_utils import classify_many, fetch_plaintext, MAX_BODY_CHARS
 from gmail_utils import ensure_labels
+from imap_sync import uid_set
+from ledger import get_ledger
+from metrics import metrics
+from mime_utils import choose_text_part, find_section, decode_partial
+
+# Only the headers classification and forwarding need
+HEADER_FETCH = 'BODY.PEEK[HEADER.FIELDS (FROM TO SUBJECT DATE)]'
 
 
 def chunk_list(lst, n):
@@ -15,6 +25,220 @@ def chunk_list(lst, n):
         yield lst[i:i+n]
 
 
+def _is_seen(data):
+    # —— Read flags from FETCH result ——  
+    raw_flags = data.get(b'FLAGS', [])  # 可能是 bytes 或 str
+    flags = []
+    for f in raw_flags:
+        flags.append(f.decode() if isinstance(f, bytes) else f)
+    return '\\Seen' in flags
+
+
+def _headers(msg):
+    return {
+        'From': msg.get('From', ''),
+        'To': msg.get('To', ''),
+        'Subject': msg.get('Subject', ''),
+        'Date': msg.get('Date', '')
+    }
+
+
+def fetch_full_data(imap, batch):
+    """IMAP step of fetch_full: whole messages (BODY.PEEK[]) with labels, flags and X-GM-MSGID."""
+    # Add 'FLAGS' to get system flags at once
+    fetch_attrs = ['BODY.PEEK[]', 'X-GM-LABELS', 'FLAGS', 'X-GM-MSGID']
+    return imap.fetch(batch, fetch_attrs)
+
+
+def parse_full(batch, batch_data):
+    """Parse step of fetch_full (no IMAP access). Returns [(uid, data, seen, body, headers)]."""
+    parsed = []
+    for uid in batch:
+        data = batch_data.get(uid, {})
+
+        # Extract body
+        msg_bytes = None
+        for key in (b'BODY[]', b'BODY.PEEK[]', b'BODY[PEEK[]]', b'RFC822'):
+            if key in data:
+                msg_bytes = data[key]
+                break
+        if not msg_bytes:
+            print(f"[WARN] UID {uid} has no body, skipped.")
+            continue
+
+        msg = email.message_from_bytes(msg_bytes)
+        body = fetch_plaintext(msg)
+        parsed.append((uid, data, _is_seen(data), body, _headers(msg)))
+    return parsed
+
+
+def fetch_full(imap, batch):
+    """Fetch whole messages (BODY.PEEK[]) and parse them. Returns [(uid, data, seen, body, headers)]."""
+    return parse_full(batch, fetch_full_data(imap, batch))
+
+
+def fetch_partial_data(imap, batch, max_bytes=PARTIAL_FETCH_BYTES):
+    """
+    IMAP step of fetch_partial: BODYSTRUCTURE and headers, then the chosen text
+    parts. Returns (batch_data, {uid: TextPart}, {uid: raw part bytes}).
+    """
+    batch_data = imap.fetch(batch, ['BODYSTRUCTURE', HEADER_FETCH, 'X-GM-LABELS', 'FLAGS', 'X-GM-MSGID'])
+
+    # Group UIDs by section so each distinct part spec costs one FETCH
+    text_parts = {}
+    plan = {}
+    for uid in batch:
+        part = choose_text_part(batch_data.get(uid, {}).get(b'BODYSTRUCTURE'))
+        if part is not None:
+            text_parts[uid] = part
+            plan.setdefault(part.section, []).append(uid)
+
+    raws = {}
+    for section, uids in plan.items():
+        part_data = imap.fetch(uids, [f'BODY.PEEK[{section}]<0.{max_bytes}>'])
+        for uid, d in part_data.items():
+            raws[uid] = find_section(d, section)
+    return batch_data, text_parts, raws
+
+
+def parse_partial(batch, fetched, max_bytes=PARTIAL_FETCH_BYTES):
+    """Parse step of fetch_partial (no IMAP access). Returns [(uid, data, seen, body, headers)]."""
+    batch_data, text_parts, raws = fetched
+    parsed = []
+    for uid in batch:
+        data = batch_data.get(uid)
+        if not data:
+            print(f"[WARN] UID {uid} has no data, skipped.")
+            continue
+        raw = raws.get(uid)
+        body = ''
+        if raw is not None:
+            body = decode_partial(raw, text_parts[uid], truncated=len(raw) >= max_bytes, limit=MAX_BODY_CHARS)
+        header_bytes = next((v for k, v in data.items() if k.upper().startswith(b'BODY[HEADER')), b'')
+        msg = email.message_from_bytes(header_bytes or b'')
+        parsed.append((uid, data, _is_seen(data), body, _headers(msg)))
+    return parsed
+
+
+def fetch_partial(imap, batch, max_bytes=PARTIAL_FETCH_BYTES):
+    """
+    Fetch BODYSTRUCTURE and headers first, then only the chosen text part with a
+    byte-range partial fetch (BODY.PEEK[section]<0.max_bytes>), so attachments are
+    never downloaded. Returns [(uid, data, seen, body, headers)].
+    """
+    return parse_partial(batch, fetch_partial_data(imap, batch, max_bytes), max_bytes)
+
+
+# FETCH_MODE -> (IMAP step, parse step)
+FETCHERS = {
+    'full': (fetch_full_data, parse_full),
+    'partial': (fetch_partial_data, parse_partial),
+}
+
+
+def label_batch(imap, parsed, categories, mark_seen=False, sources=None):
+    """
+    Apply classification results for one fetched batch: one X-GM-LABELS STORE per
+    label set and one flag STORE. sources, if given, holds each category's
+    classify_content source ("llm", "rules", ...).
+    Returns {uid: {'category', 'source', 'msgid', 'from', 'subject', 'raw', 'unread'}}.
+    """
+    results = {}
+    # Apply results in UID order, collecting STOREs per label set / flag change
+    label_groups = {}
+    unseen_uids = []
+    sources = sources or [None] * len(parsed)
+    for (uid, data, seen, body, headers), category, source in zip(parsed, categories, sources):
+        # Ensure there is a classification result, if not, default to LowPriority
+        if not category or category not in LABEL_MAP:
+            category = "LowPriority"
+            source = "default"
+            print(f"[INFO] UID {uid} cannot be classified. Using default LowPriority.")
+
+        # Add labels
+        existing = [lbl.decode() if isinstance(lbl, bytes) else lbl
+                    for lbl in data.get(b'X-GM-LABELS', [])]
+
+        # Ensure both labels exist, one is the category label, one is the Processed label
+        labels_to_add = []
+
+        # Check category label
+        category_label = LABEL_MAP.get(category)
+        if category_label and category_label not in existing:
+            labels_to_add.append(category_label)
+
+        # Check Processed label
+        processed_label = LABEL_MAP.get(PROCESSED_CAT)
+        if processed_label and processed_label not in existing:
+            labels_to_add.append(processed_label)
+
+        # Add labels
+        if labels_to_add:
+            label_groups.setdefault(tuple(labels_to_add), []).append(uid)
+            print(f"[INFO] UID {uid} labeled: {labels_to_add}")
+        else:
+            print(f"[INFO] UID {uid} already has required labels. No action taken.")
+
+        # Carried to the forwarding stage: X-GM-MSGID is the Gmail API id (in hex)
+        results[uid] = {
+            'category': category,
+            'source': source,
+            'msgid': data.get(b'X-GM-MSGID'),
+            'from': headers.get('From', ''),
+            'subject': headers.get('Subject', ''),
+            'raw': data.get(b'BODY[]'),
+            'unread': not seen,
+        }
+        if not seen:
+            unseen_uids.append(uid)
+
+    # One X-GM-LABELS STORE per distinct label set
+    for labels, group in label_groups.items():
+        imap.add_gmail_labels(uid_set(group), list(labels), silent=True)
+
+    # Restore original seen status with a single flag STORE
+    done = [uid for uid, *_ in parsed]
+    if mark_seen:
+        if done:
+            imap.add_flags(uid_set(done), ['\\Seen'], silent=True)
+            print(f"[INFO] {len(done)} messages marked as Seen.")
+    elif unseen_uids:
+        imap.remove_flags(uid_set(unseen_uids), ['\\Seen'], silent=True)
+    return results
+
+
+def process_uids(imap, uids, mark_seen=False, max_inflight=OLLAMA_MAX_INFLIGHT):
+    """
+    Classify and label the given UIDs on an already-open IMAPClient.
+    INBOX must be selected and labels ensured by the caller.
+    Returns {uid: {'category', 'msgid', 'from', 'subject', 'raw'}} for every message
+    that was labeled; 'raw' holds the full message only in FETCH_MODE=full.
+    """
+    results = {}
+    fetch_data, parse = FETCHERS.get(FETCH_MODE, FETCHERS['partial'])
+
+    # Batch processing
+    for batch in chunk_list(uids, 50):
+        # Parse the whole batch first so classification can run concurrently
+        with metrics.timer("stage_seconds", stage="fetch"):
+            fetched = fetch_data(imap, batch)
+        with metrics.timer("stage_seconds", stage="parse"):
+            parsed = parse(batch, fetched)
+
+        # Call classification, keeping several requests in flight
+        infos = []
+        with metrics.timer("stage_seconds", stage="classify"):
+            categories = classify_many([(body, headers) for _, _, _, body, headers in parsed],
+                                       max_inflight=max_inflight, infos=infos)
+
+        with metrics.timer("stage_seconds", stage="label"):
+            results.update(label_batch(imap, parsed, categories, mark_seen=mark_seen,
+                                       sources=[info.get("source") for info in infos]))
+        metrics.inc("stage_messages_total", len(parsed), stage="label")
+
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(description="AI email classifier: process specific UIDs")
     parser.add_argument(
@@ -26,7 +250,12 @@ def main():
         '--mark-seen', action='store_true',
         help='Mark processed messages as Seen'
     )
+    parser.add_argument(
+        '--max-inflight', type=int, default=OLLAMA_MAX_INFLIGHT,
+        help='Maximum number of concurrent Ollama classification requests'
+    )
     args = parser.parse_args()
+    require_imap_config()
 
     # Parse UIDs
     try:
@@ -39,99 +268,25 @@ def main():
     print(f"[INFO] Processing {len(uids)} messages.")
 
     # Connect to IMAP
-    imap = IMAPClient(IMAP_HOST, ssl=True)
+    imap = IMAPClient(IMAP_HOST, port=IMAP_PORT, ssl=IMAP_SSL)
     imap.login(IMAP_USER, IMAP_PASS)
-    imap.select_folder('INBOX')
+    status = imap.select_folder('INBOX')
     print("[INFO] IMAP connection established and INBOX selected.")
 
     # Ensure labels exist
     ensure_labels(imap)
     print("[INFO] Gmail labels checked.")
 
-    # Batch processing
-    for batch in chunk_list(uids, 50):
-        # Add 'FLAGS' to get system flags at once
-        fetch_attrs = ['BODY.PEEK[]', 'X-GM-LABELS', 'FLAGS', 'X-GM-MSGID']
-
-        batch_data = imap.fetch(batch, fetch_attrs)
-
-        for uid in batch:
-            data = batch_data.get(uid, {})
-
-            # —— Read flags from FETCH result ——  
-            raw_flags = data.get(b'FLAGS', [])  # 可能是 bytes 或 str
-            flags = []
-            for f in raw_flags:
-                flags.append(f.decode() if isinstance(f, bytes) else f)
-            seen = '\\Seen' in flags
-
-            # Extract body
-            msg_bytes = None
-            for key in (b'BODY[]', b'BODY.PEEK[]', b'BODY[PEEK[]]', b'RFC822'):
-                if key in data:
-                    msg_bytes = data[key]
-                    break
-            if not msg_bytes:
-                print(f"[WARN] UID {uid} has no body, skipped.")
-                continue
-
-            msg = email.message_from_bytes(msg_bytes)
-            body = fetch_plaintext(msg)
-            headers = {
-                'From': msg.get('From', ''),
-                'To': msg.get('To', ''),
-                'Subject': msg.get('Subject', ''),
-                'Date': msg.get('Date', '')
-            }
-
-            # Call classification
-            category = classify_content(body, headers)
-            
-            # Ensure there is a classification result, if not, default to LowPriority
-            if not category or category not in LABEL_MAP:
-                category = "LowPriority"
-                print(f"[INFO] UID {uid} cannot be classified. Using default LowPriority.")
-
-            # Add labels
-            existing = [lbl.decode() if isinstance(lbl, bytes) else lbl
-                        for lbl in data.get(b'X-GM-LABELS', [])]
-            
-            # Ensure both labels exist, one is the category label, one is the Processed label
-            labels_to_add = []
-            
-            # Check category label
-            category_label = LABEL_MAP.get(category)
-            if category_label and category_label not in existing:
-                labels_to_add.append(category_label)
-            
-            # Check Processed label
-            processed_label = LABEL_MAP.get(PROCESSED_CAT)
-            if processed_label and processed_label not in existing:
-                labels_to_add.append(processed_label)
-            
-            # Add labels
-            if labels_to_add:
-                imap.add_gmail_labels(uid, labels_to_add, silent=True)
-                print(f"[INFO] UID {uid} labeled: {labels_to_add}")
-            else:
-                print(f"[INFO] UID {uid} already has required labels. No action taken.")
-
-            # Restore original seen status
-            if args.mark_seen:
-                imap.add_flags(uid, ['\\Seen'])
-                print(f"[INFO] UID {uid} marked as Seen.")
-            else:
-                if not seen:
-                    imap.remove_flags(uid, ['\\Seen'])
-                    
-                else:
-                    print(f"[INFO] UID {uid} was already Seen. No change.")
-
-    # Logout
     try:
-        imap.logout()
-    except Exception:
-        pass
+        results = process_uids(imap, uids, mark_seen=args.mark_seen, max_inflight=args.max_inflight)
+        # The launcher reads categories for forwarding back from the ledger
+        get_ledger().record('INBOX', status.get(b'UIDVALIDITY'), results)
+    finally:
+        # Logout
+        try:
+            imap.logout()
+        except Exception:
+            pass
     print("[INFO] IMAP logout complete. main.py finished.")
 
 
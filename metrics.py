@@ -0,0 +1,172 @@
+# metrics.py
+# In-process counters and latency histograms per processing stage, served as
+# Prometheus text on localhost and written periodically as a JSON snapshot (read by the tray).
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import METRICS_ENABLED, METRICS_PORT, METRICS_SNAPSHOT_PATH, METRICS_SNAPSHOT_SECONDS
+
+# Histogram bucket upper bounds in seconds (IMAP/Gmail round-trips up to slow model loads)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = 'aiemail_'
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+
+def _series(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return PREFIX + name
+    return PREFIX + name + '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Metrics:
+    """
+    Counters and histograms keyed by name and labels. An update is one lock
+    acquisition and a bisect, so instrumenting every message costs microseconds.
+    With enabled=False every update returns immediately.
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}   # key -> [bucket counts..., +Inf count], sum
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            hist[0][i] += 1
+            hist[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the with-block (also when it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(v[0]), v[1]) for k, v in self._histograms.items()}
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}{name} counter')
+                typed.add(name)
+            lines.append(f'{_series(name, labels)} {value}')
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{_series(name + "_bucket", labels, [("le", bound)])} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{_series(name + "_bucket", labels, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{_series(name + "_sum", labels)} {total:.6f}')
+            lines.append(f'{_series(name + "_count", labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """Counters, and count / average / sum per histogram, keyed by series name."""
+        with self._lock:
+            counters = {_series(name, labels): value for (name, labels), value in self._counters.items()}
+            histograms = {}
+            for (name, labels), (counts, total) in self._histograms.items():
+                n = sum(counts)
+                histograms[_series(name, labels)] = {
+                    "count": n, "sum_s": round(total, 3), "avg_ms": round(1000 * total / n, 1) if n else 0}
+        return {"updated": time.time(), "started": self.started, "pid": os.getpid(),
+                "counters": counters, "histograms": histograms}
+
+
+metrics = Metrics()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in ('/', '/metrics'):
+            body, ctype = metrics.render().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, ctype = json.dumps(metrics.snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_snapshot(path=METRICS_SNAPSHOT_PATH):
+    """Write the JSON snapshot atomically (readers never see a partial file)."""
+    if not path or not metrics.enabled:
+        return
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(metrics.snapshot(), f)
+    os.replace(tmp, path)
+
+
+def _snapshot_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot(path)
+        except OSError as e:
+            print(f"[WARN] Metrics snapshot not written: {e}")
+
+
+def start_metrics(port=METRICS_PORT, snapshot_path=METRICS_SNAPSHOT_PATH, interval=METRICS_SNAPSHOT_SECONDS):
+    """
+    Serve /metrics (Prometheus text) and /metrics.json on 127.0.0.1:port and write
+    the snapshot to snapshot_path every interval seconds, both from daemon threads.
+    port 0 or an empty path disables that part.
+    """
+    if not metrics.enabled:
+        return
+    if port:
+        try:
+            server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        except OSError as e:
+            print(f"[WARN] Metrics endpoint not started on port {port}: {e}")
+        else:
+            threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+            print(f"[INFO] Metrics: http://127.0.0.1:{port}/metrics")
+    if snapshot_path and interval > 0:
+        threading.Thread(target=_snapshot_loop, args=(snapshot_path, interval),
+                         name='metrics-snapshot', daemon=True).start()
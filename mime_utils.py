@@ -0,0 +1,273 @@
+# mime_utils.py
+# Helpers for reading message text without downloading whole messages:
+# pick the text part from an IMAP BODYSTRUCTURE or a parsed message, and decode it
+# (transfer encoding, charset, HTML) incrementally up to a character budget.
+import base64
+import binascii
+import codecs
+import quopri
+import re
+from collections import namedtuple
+from html.parser import HTMLParser
+
+TextPart = namedtuple('TextPart', 'section subtype encoding charset size')
+
+# A text/plain part shorter than this ("view this email in your browser") loses to text/html
+MIN_PLAIN_BYTES = 200
+# Encoded bytes decoded per step while filling a character budget
+DECODE_CHUNK = 8192
+# Declared charsets that are better read with a superset codec
+CHARSET_ALIASES = {
+    'gb2312': 'gb18030', 'gbk': 'gb18030', 'x-gbk': 'gb18030',
+    'ks_c_5601-1987': 'cp949', 'iso-8859-1': 'cp1252', 'us-ascii': 'cp1252',
+}
+
+
+def _s(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'ignore')
+    return value or ''
+
+
+def _params(raw):
+    """BODYSTRUCTURE parameter list (k1, v1, k2, v2, ...) -> dict with lower-case keys."""
+    if not isinstance(raw, (list, tuple)):
+        return {}
+    items = list(raw)
+    return {_s(items[i]).lower(): _s(items[i + 1]) for i in range(0, len(items) - 1, 2)}
+
+
+def _is_attachment(part):
+    # Extension data (disposition) follows the basic fields; look for ("ATTACHMENT", (...))
+    for field in part[7:]:
+        if isinstance(field, tuple) and field and _s(field[0]).lower() == 'attachment':
+            return True
+    return 'name' in _params(part[2])
+
+
+def iter_parts(bodystructure, prefix=''):
+    """Yield (section, part) for every leaf part; message/rfc822 parts are not descended into."""
+    if bodystructure is None:
+        return
+    if isinstance(bodystructure[0], (list, tuple)) and not isinstance(bodystructure[0], (bytes, str)):
+        for i, part in enumerate(bodystructure[0], 1):
+            yield from iter_parts(part, f'{prefix}.{i}' if prefix else str(i))
+    else:
+        yield (prefix or '1'), bodystructure
+
+
+def choose_text_part(bodystructure):
+    """
+    Return the TextPart to classify on: the first inline text/plain part,
+    otherwise the first inline text/html part, otherwise None.
+    """
+    candidates = {}
+    try:
+        for section, part in iter_parts(bodystructure):
+            if _s(part[0]).lower() != 'text' or _is_attachment(part):
+                continue
+            subtype = _s(part[1]).lower()
+            if subtype in ('plain', 'html') and subtype not in candidates:
+                charset = _params(part[2]).get('charset', '') or 'utf-8'
+                size = part[6] if isinstance(part[6], int) else 0
+                candidates[subtype] = TextPart(section, subtype, _s(part[5]).lower() or '7bit', charset, size)
+    except (IndexError, TypeError):
+        return None
+    return _best(candidates, lambda part: part.size)
+
+
+def _best(candidates, size_of):
+    """text/plain unless it is a stub next to a text/html alternative."""
+    plain, html = candidates.get('plain'), candidates.get('html')
+    if plain is not None and html is not None and size_of(plain) < MIN_PLAIN_BYTES:
+        return html
+    return plain if plain is not None else html
+
+
+def find_section(data: dict, section: str) -> bytes:
+    """Locate a BODY[section]<origin> item in a FETCH response."""
+    prefix = f'BODY[{section}]'.encode()
+    for key, value in data.items():
+        if isinstance(key, bytes) and key.upper().startswith(prefix):
+            return value or b''
+    return b''
+
+
+def _codec(charset: str) -> str:
+    """Codec name for a declared charset, falling back to UTF-8 for unknown ones."""
+    charset = (charset or 'utf-8').strip().strip('"').lower()
+    charset = CHARSET_ALIASES.get(charset, charset)
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return 'utf-8'
+
+
+def decode_charset(data: bytes, charset: str) -> str:
+    """Decode with the declared charset, falling back to UTF-8; a cut multi-byte tail is ignored."""
+    return data.decode(_codec(charset), errors='ignore')
+
+
+def iter_transfer_decoded(raw: bytes, encoding: str, chunk: int = DECODE_CHUNK):
+    """
+    Undo the Content-Transfer-Encoding piece by piece, so a caller that has
+    enough text can stop without decoding the rest of the part.
+    """
+    encoding = (encoding or '').lower()
+    pos = 0
+    carry = b''
+    while pos < len(raw):
+        piece = raw[pos:pos + chunk]
+        pos += chunk
+        if encoding == 'base64':
+            data = carry + re.sub(rb'[^A-Za-z0-9+/=]', b'', piece)
+            cut = len(data) // 4 * 4
+            data, carry = data[:cut], data[cut:]
+            try:
+                yield base64.b64decode(data)
+            except binascii.Error:
+                return
+        elif encoding == 'quoted-printable':
+            data = carry + piece
+            if pos < len(raw):
+                # Keep the last (possibly incomplete) line for the next step
+                cut = data.rfind(b'\n') + 1
+                data, carry = data[:cut], data[cut:]
+            else:
+                # Drop an escape cut off by a byte-range fetch
+                data = re.sub(rb'=[0-9A-Fa-f]?$', b'', data)
+            yield quopri.decodestring(data)
+        else:
+            yield piece
+
+
+class HtmlToText(HTMLParser):
+    """
+    Streaming HTML -> plain text: drops scripts, styles and markup, turns block
+    elements into line breaks and stops collecting once limit characters are kept.
+    """
+    SKIP = {'script', 'style', 'head', 'title', 'noscript', 'template', 'svg'}
+    BLOCK = {'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'section', 'article', 'header',
+             'footer', 'blockquote', 'pre', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+    CELL = {'td', 'th'}
+
+    def __init__(self, limit=None):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.skip = 0
+        self.done = False
+
+    def _emit(self, text):
+        if self.done:
+            return
+        if self.limit is not None and self.length + len(text) >= self.limit:
+            text = text[:self.limit - self.length]
+            self.done = True
+        self.parts.append(text)
+        self.length += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skip += 1
+        elif tag in self.BLOCK:
+            self._emit('\n')
+        elif tag in self.CELL:
+            self._emit(' ')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK:
+            self._emit('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skip = max(0, self.skip - 1)
+        elif tag in self.BLOCK:
+            self._emit('\n')
+
+    def handle_data(self, data):
+        if not self.skip:
+            text = re.sub(r'[ \t\r\f\v\u00a0]+', ' ', data.replace('\n', ' '))
+            if text.strip():
+                self._emit(text)
+
+    def text(self) -> str:
+        text = re.sub(r' *\n[ \n]*', '\n', ''.join(self.parts))
+        return text.strip()
+
+
+def decode_text(raw: bytes, encoding: str, charset: str, subtype: str = 'plain',
+                limit: int = None, truncated: bool = False) -> str:
+    """
+    Text of one text/* part: transfer and charset decoding done incrementally,
+    HTML converted to text, stopping once limit characters are available.
+    """
+    decoder = codecs.getincrementaldecoder(_codec(charset))(errors='ignore')
+    html = HtmlToText(limit) if subtype == 'html' else None
+    out, length = [], 0
+    for data in iter_transfer_decoded(raw or b'', encoding):
+        text = decoder.decode(data)
+        if html is not None:
+            html.feed(text)
+            if html.done:
+                break
+        else:
+            out.append(text)
+            length += len(text)
+            if limit is not None and length >= limit:
+                break
+    else:
+        text = decoder.decode(b'', final=not truncated)
+        if html is not None:
+            html.feed(text)
+        else:
+            out.append(text)
+    if html is not None:
+        html.close()
+        return html.text()
+    return ''.join(out)[:limit] if limit is not None else ''.join(out)
+
+
+def decode_partial(raw: bytes, part: TextPart, truncated: bool = False, limit: int = None) -> str:
+    """Text of a (possibly byte-range) fetched part."""
+    return decode_text(raw, part.encoding, part.charset, part.subtype, limit=limit, truncated=truncated)
+
+
+def extract_text(msg, limit: int = None) -> str:
+    """
+    Classification text of a parsed email.message.Message: the best inline text
+    part (text/plain, or text/html when plain is missing or a stub), decoded up
+    to limit characters.
+    """
+    candidates = {}
+    for part in msg.walk():
+        if part.is_multipart() or part.get_content_maintype() != 'text':
+            continue
+        if part.get_content_disposition() == 'attachment' or part.get_filename():
+            continue
+        subtype = part.get_content_subtype()
+        if subtype in ('plain', 'html') and subtype not in candidates:
+            candidates[subtype] = part
+    part = _best(candidates, lambda p: len(p.get_payload() or ''))
+    if part is None:
+        if msg.is_multipart():
+            return ''
+        part = msg
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    raw = None
+    if encoding in ('base64', 'quoted-printable'):
+        # Still encoded, so ASCII; decoded incrementally below
+        payload = part.get_payload()
+        try:
+            raw = payload.encode('ascii') if isinstance(payload, str) else None
+        except UnicodeEncodeError:
+            raw = None
+    if raw is None:
+        # 7bit/8bit/binary: get_payload() returns 8-bit text already charset-decoded, the bytes come from decode=True
+        raw = part.get_payload(decode=True)
+        if not isinstance(raw, bytes):
+            return ''
+        encoding = ''
+    subtype = 'html' if part.get_content_type() == 'text/html' else 'plain'
+    return decode_text(raw, encoding, part.get_content_charset(), subtype, limit=limit)
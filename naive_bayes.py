@@ -0,0 +1,262 @@
+# naive_bayes.py
+# Local naive Bayes classifier over hashed sender/subject/body features, trained from the
+# LLM answers recorded in the processing ledger. Run this file to train: python naive_bayes.py
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency, the classifier is off without it
+    np = None
+
+from config import (
+    MAIN_CATS, NB_MODEL_PATH, NB_MIN_CONFIDENCE, NB_HASH_BITS, NB_BODY_CHARS,
+)
+from text_features import features, feature_hash
+
+# Bump when text_features changes in a way that invalidates trained models
+FEATURE_VERSION = 1
+
+# Additive smoothing of the per-category feature counts
+ALPHA = 0.1
+
+# Confidence thresholds reported after training, to choose NB_MIN_CONFIDENCE
+REPORT_THRESHOLDS = (0.9, 0.95, 0.98, 0.99, 0.999)
+
+# Ledger sources whose category is an LLM answer (cache hits replay earlier ones). Labels from
+# the rules, reputation, kNN or this model itself would make training and evaluation circular.
+LLM_SOURCES = ("llm", "cache")
+
+
+def available() -> bool:
+    return np is not None
+
+
+def hashed_features(headers: dict, body: str, bits: int, body_chars: int):
+    """Distinct hashed feature indices of one message (presence, not counts)."""
+    mask = (1 << bits) - 1
+    return np.unique(np.fromiter((feature_hash(f) & mask for f in features(headers, body, body_chars)),
+                                 dtype=np.uint32))
+
+
+class NaiveBayes:
+    """
+    Multinomial naive Bayes over binary hashed features. Training is a single
+    np.bincount over (category, feature) pairs; the saved model is the count
+    matrix plus metadata in a compressed .npz. A prediction hashes the message
+    and sums one column slice of the log-probability matrix.
+    """
+
+    def __init__(self, counts, class_docs, bits, body_chars, meta=None):
+        self.counts = counts
+        self.class_docs = class_docs
+        self.bits = bits
+        self.body_chars = body_chars
+        self.meta = meta or {}
+        self.lookups = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+        smoothed = counts.astype(np.float64) + ALPHA
+        self.log_prob = np.log(smoothed / smoothed.sum(axis=1, keepdims=True)).astype(np.float32)
+        self.log_prior = np.log((class_docs + 1.0) / (class_docs.sum() + len(class_docs))).astype(np.float32)
+
+    @classmethod
+    def train(cls, docs, labels, bits=NB_HASH_BITS, body_chars=NB_BODY_CHARS):
+        """docs: hashed_features() arrays; labels: MAIN_CATS indices."""
+        labels = np.asarray(labels, dtype=np.int64)
+        lengths = np.fromiter((len(d) for d in docs), dtype=np.int64, count=len(docs))
+        flat = np.concatenate(docs).astype(np.int64) if docs else np.zeros(0, dtype=np.int64)
+        rows = np.repeat(labels, lengths)
+        dim = 1 << bits
+        counts = np.bincount(rows * dim + flat, minlength=len(MAIN_CATS) * dim).reshape(len(MAIN_CATS), dim)
+        class_docs = np.bincount(labels, minlength=len(MAIN_CATS))
+        return cls(counts.astype(np.uint32), class_docs, bits, body_chars)
+
+    def scores(self, idx):
+        """Posterior probability per category for hashed_features() indices."""
+        logits = self.log_prior + self.log_prob[:, idx].sum(axis=1)
+        logits = np.exp(logits - logits.max())
+        return logits / logits.sum()
+
+    def predict(self, headers: dict, body: str):
+        """(category, confidence) for one message."""
+        probs = self.scores(hashed_features(headers, body, self.bits, self.body_chars))
+        best = int(probs.argmax())
+        return MAIN_CATS[best], float(probs[best])
+
+    def lookup(self, headers: dict, body: str, min_confidence=NB_MIN_CONFIDENCE):
+        """The predicted category when its confidence reaches min_confidence, else None."""
+        cat, confidence = self.predict(headers, body)
+        print(f"[DEBUG] Naive Bayes: {cat} ({confidence:.3f})")
+        with self._lock:
+            self.lookups += 1
+            if confidence < min_confidence:
+                return None
+            self.saved += 1
+        return cat
+
+    def save(self, path=NB_MODEL_PATH):
+        meta = dict(self.meta, categories=MAIN_CATS, bits=self.bits, body_chars=self.body_chars,
+                    feature_version=FEATURE_VERSION)
+        tmp = f"{path}.tmp.npz"
+        np.savez_compressed(tmp, counts=self.counts, class_docs=self.class_docs, meta=json.dumps(meta))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=NB_MODEL_PATH):
+        """The saved model, or None when it is missing or was trained for other categories/features."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("categories") != MAIN_CATS or meta.get("feature_version") != FEATURE_VERSION:
+                print(f"[WARN] Naive Bayes model {path} was trained for other categories/features; retrain it")
+                return None
+            return cls(data["counts"], data["class_docs"], meta["bits"], meta["body_chars"], meta)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"lookups": self.lookups, "llm_calls_saved": self.saved}
+
+
+def labelled_uids(imap, per_label):
+    """{uid: category} for the newest per_label messages of each category label (ambiguous ones dropped)."""
+    labelled = {}
+    for cat in MAIN_CATS:
+        for uid in imap.search(['X-GM-LABELS', cat])[-per_label:]:
+            labelled[uid] = cat if uid not in labelled else None
+    return {uid: cat for uid, cat in labelled.items() if cat}
+
+
+def llm_labelled_uids(ledger, folder, uidvalidity, per_label):
+    """{uid: category} for the newest per_label ledger rows of each category answered by the LLM."""
+    by_cat = {}
+    for uid, cat in ledger.categories(folder, uidvalidity, LLM_SOURCES).items():
+        if cat in MAIN_CATS:
+            by_cat.setdefault(cat, []).append(uid)
+    return {uid: cat for cat, uids in by_cat.items() for uid in sorted(uids)[-per_label:]}
+
+
+def stream_labelled(imap, labelled, bits, body_chars, batch=200):
+    """Yield (uid, category, hashed features) per message, fetching headers and the start of the text part."""
+    # main imports classification_utils, which imports this module
+    from main import fetch_partial
+    uids = sorted(labelled)
+    # A few bytes per body character cover multi-byte charsets and transfer encoding
+    max_bytes = max(1024, 4 * body_chars)
+    for i in range(0, len(uids), batch):
+        for uid, _, _, body, headers in fetch_partial(imap, uids[i:i + batch], max_bytes=max_bytes):
+            yield uid, labelled[uid], hashed_features(headers, body, bits, body_chars)
+        print(f"[INFO] Fetched {min(i + batch, len(uids))}/{len(uids)} labeled messages")
+
+
+def evaluate(model, docs, labels, min_confidence=NB_MIN_CONFIDENCE) -> dict:
+    """Held-out accuracy overall and for the predictions above min_confidence (the ones that skip the LLM)."""
+    if not docs:
+        return {"held_out": 0, "accuracy": None, "coverage": None, "confident_accuracy": None,
+                "scoring_us_per_message": None, "per_category": {}, "thresholds": {}}
+    start = time.perf_counter()
+    probs = np.stack([model.scores(d) for d in docs])
+    per_message_us = 1e6 * (time.perf_counter() - start) / len(docs)
+    predicted = probs.argmax(axis=1)
+    confident = probs.max(axis=1) >= min_confidence
+    correct = predicted == np.asarray(labels)
+    report = {
+        "held_out": len(docs),
+        "accuracy": round(float(correct.mean()), 4),
+        "coverage": round(float(confident.mean()), 4),
+        "confident_accuracy": round(float(correct[confident].mean()), 4) if confident.any() else None,
+        "scoring_us_per_message": round(per_message_us, 1),
+        "per_category": {},
+        "thresholds": {},
+    }
+    for threshold in sorted(set(REPORT_THRESHOLDS) | {min_confidence}):
+        above = probs.max(axis=1) >= threshold
+        report["thresholds"][threshold] = {
+            "coverage": round(float(above.mean()), 4),
+            "accuracy": round(float(correct[above].mean()), 4) if above.any() else None}
+    for i, cat in enumerate(MAIN_CATS):
+        actual = np.asarray(labels) == i
+        if actual.any():
+            report["per_category"][cat] = {"n": int(actual.sum()),
+                                           "recall": round(float(correct[actual].mean()), 3)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local naive Bayes classifier from the LLM's past answers")
+    parser.add_argument('--out', default=NB_MODEL_PATH, help='Model file (default: NB_MODEL_PATH)')
+    parser.add_argument('--folder', default='INBOX', help='Folder to read, e.g. "[Gmail]/All Mail"')
+    parser.add_argument('--account', help='Daemon account name whose ledger rows to use (default: the launcher\'s)')
+    parser.add_argument('--all-labels', action='store_true',
+                        help='Use every Gmail category label instead of the ledger\'s LLM answers; these include '
+                             'rule, reputation, kNN and naive Bayes results, so accuracy is partly self-agreement')
+    parser.add_argument('--per-label', type=int, default=10000, help='Newest messages used per category label')
+    parser.add_argument('--holdout', type=float, default=0.1, help='Share of messages kept out for evaluation')
+    parser.add_argument('--min-confidence', type=float, default=NB_MIN_CONFIDENCE,
+                        help='Confidence threshold evaluated (default: NB_MIN_CONFIDENCE)')
+    parser.add_argument('--bits', type=int, default=NB_HASH_BITS, help='log2 of the hashed feature space')
+    parser.add_argument('--body-chars', type=int, default=NB_BODY_CHARS, help='Body characters used as features')
+    args = parser.parse_args()
+    if np is None:
+        sys.exit("[ERROR] numpy is required: pip install numpy")
+
+    from imapclient import IMAPClient
+    from config import IMAP_HOST, IMAP_PORT, IMAP_SSL, IMAP_USER, IMAP_PASS, require_imap_config
+
+    require_imap_config()
+
+    imap = IMAPClient(IMAP_HOST, port=IMAP_PORT, ssl=IMAP_SSL)
+    imap.login(IMAP_USER, IMAP_PASS)
+    status = imap.select_folder(args.folder, readonly=True)
+    print(f"[INFO] IMAP connection established, {args.folder} selected (read-only).")
+    try:
+        if args.all_labels:
+            labelled = labelled_uids(imap, args.per_label)
+        else:
+            from ledger import get_ledger
+            key = f"{args.account}/{args.folder}" if args.account else args.folder
+            labelled = llm_labelled_uids(get_ledger(), key, status.get(b'UIDVALIDITY'), args.per_label)
+        print(f"[INFO] {len(labelled)} labeled messages: {dict(Counter(labelled.values()))}")
+        if not labelled:
+            sys.exit("[ERROR] No messages carry a category label yet." if args.all_labels else
+                     "[ERROR] No LLM answers for this folder in the ledger yet (or use --all-labels).")
+        train_docs, train_labels, test_docs, test_labels = [], [], [], []
+        start = time.perf_counter()
+        for uid, cat, doc in stream_labelled(imap, labelled, args.bits, args.body_chars):
+            # Stable split: the same messages are held out on every run
+            held_out = zlib.crc32(str(uid).encode()) % 1000 < args.holdout * 1000
+            (test_docs if held_out else train_docs).append(doc)
+            (test_labels if held_out else train_labels).append(MAIN_CATS.index(cat))
+    finally:
+        try:
+            imap.logout()
+        except Exception:
+            pass
+    print(f"[INFO] Features extracted in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    model = NaiveBayes.train(train_docs, train_labels, args.bits, args.body_chars)
+    print(f"[INFO] Trained on {len(train_docs)} messages in {1000 * (time.perf_counter() - start):.0f} ms")
+    report = evaluate(model, test_docs, test_labels, args.min_confidence)
+    print(f"[INFO] Held-out accuracy: {report['accuracy']} on {report['held_out']} messages; "
+          f"confidence >= {args.min_confidence}: {report['coverage']} of messages "
+          f"at {report['confident_accuracy']} accuracy; {report['scoring_us_per_message']} us/message")
+    for cat, row in report["per_category"].items():
+        print(f"[INFO]   {cat:<14} n={row['n']:<6} recall={row['recall']}")
+    for threshold, row in report["thresholds"].items():
+        print(f"[INFO]   confidence >= {threshold:<6} skips the LLM for {row['coverage']:.1%} at {row['accuracy']} accuracy")
+    model.meta = {"trained_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "trained_on": len(train_docs),
+                  "labels": "gmail" if args.all_labels else "llm", "evaluation": report}
+    model.save(args.out)
+    print(f"[INFO] Model saved to {args.out} ({os.path.getsize(args.out) / 1024:.0f} KB)")
+
+
+if __name__ == '__main__':
+    main()
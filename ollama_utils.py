@@ -1,31 +1,41 @@
 # ollama_utils.py
-# Utility functions to start and stop the Ollama CLI server without external HTTP or requests dependency.
+# Utility functions to start and stop the Ollama CLI server and talk to its HTTP API
+# without external HTTP or requests dependency.
 import subprocess
 import socket
 import time
 import sys
-from config import OLLAMA_PORT
+import json
+import queue
+import threading
+import http.client
+from config import (
+    OLLAMA_HOST, OLLAMA_PORT, OLLAMA_TIMEOUT, OLLAMA_MAX_INFLIGHT,
+    MODEL_NAME, OLLAMA_IDLE_UNLOAD,
+)
+from metrics import metrics
 
 
-def is_port_listening(port: int) -> bool:
+def is_port_listening(port: int, host: str = "127.0.0.1") -> bool:
     """Check if local TCP port is open."""
     with socket.socket() as s:
         s.settimeout(0.5)
         try:
-            s.connect(("127.0.0.1", port))
+            s.connect((host, port))
             return True
         except Exception:
             return False
 
 
-def start_ollama():
+def start_ollama(kill_existing=True):
     """
     Start the Ollama CLI server and wait until the TCP port is listening.
     Does not print server logs to console.
     """
     print("[INFO] Starting Ollama service...")
     # Ensure any previous instance is terminated
-    kill_ollama()
+    if kill_existing:
+        kill_ollama()
 
     # Launch the Ollama server quietly
     CREATE_NO_WINDOW = 0x08000000
@@ -38,6 +48,7 @@ def start_ollama():
     )
 
     # Wait for TCP port to become available
+    start = time.perf_counter()
     for i in range(40):
         if is_port_listening(OLLAMA_PORT):
             print(f"[INFO] Ollama TCP port {OLLAMA_PORT} open after {i * 0.5:.1f}s")
@@ -45,6 +56,8 @@ def start_ollama():
         time.sleep(0.5)
     else:
         print(f"[ERROR] TCP port {OLLAMA_PORT} did not open. Check Ollama CLI installation.")
+        metrics.inc("ollama_server_start_failures_total")
+    metrics.observe("ollama_server_start_seconds", time.perf_counter() - start)
 
     return proc
 
@@ -59,4 +72,275 @@ def kill_ollama():
 def kill_ollama_and_exit():
     """Kill Ollama processes and exit the script."""
     kill_ollama()
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)
+
+
+class OllamaHTTPError(Exception):
+    """Non-200 response from the Ollama API."""
+
+    def __init__(self, code, reason, body=b""):
+        super().__init__(f"{code} {reason}")
+        self.code = code
+        self.reason = reason
+        self.body = body
+
+
+class OllamaClient:
+    """
+    Minimal thread-safe Ollama HTTP client.
+    Keeps up to pool_size persistent keep-alive connections so that repeated and
+    concurrent requests skip TCP setup.
+    """
+
+    def __init__(self, host=OLLAMA_HOST, port=OLLAMA_PORT, pool_size=OLLAMA_MAX_INFLIGHT, timeout=OLLAMA_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, conn, reuse):
+        if reuse:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def post_json(self, path: str, payload: dict) -> dict:
+        """POST a JSON payload and return the decoded JSON response."""
+        body = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"}
+        conn = self._acquire()
+        reuse = False
+        try:
+            for attempt in range(2):
+                try:
+                    conn.request("POST", path, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # Server closed an idle keep-alive connection; reconnect once
+                    conn.close()
+                    if attempt:
+                        raise
+            if resp.status != 200:
+                raise OllamaHTTPError(resp.status, resp.reason, data)
+            reuse = not resp.will_close
+            return json.loads(data.decode())
+        finally:
+            self._release(conn, reuse)
+
+    def post_stream(self, path: str, payload: dict):
+        """
+        POST a JSON payload and yield each object of the newline-delimited JSON
+        response stream. The connection goes back to the pool once the final
+        {"done": true} object has been read; a generator closed before that drops it.
+        """
+        body = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json"}
+        conn = self._acquire()
+        reuse = False
+        try:
+            for attempt in range(2):
+                try:
+                    conn.request("POST", path, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    # Server closed an idle keep-alive connection; reconnect once
+                    conn.close()
+                    if attempt:
+                        raise
+            if resp.status != 200:
+                raise OllamaHTTPError(resp.status, resp.reason, resp.read())
+            for line in resp:
+                line = line.strip()
+                if not line:
+                    continue
+                obj = json.loads(line.decode())
+                if "error" in obj:
+                    raise OllamaHTTPError(500, obj["error"], line)
+                if obj.get("done"):
+                    # Consume the end of the chunked body so the connection can be reused
+                    resp.read()
+                    reuse = not resp.will_close
+                    yield obj
+                    return
+                yield obj
+        finally:
+            self._release(conn, reuse)
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> OllamaClient:
+    """Return the process-wide shared OllamaClient."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OllamaClient()
+        return _client
+
+
+class ModelResidency:
+    """
+    Keeps the Ollama server up and the model loaded while there is work,
+    replacing the per-round start_ollama()/kill_ollama() cycle.
+    The model is pinned with keep_alive and unloaded only after idle_timeout
+    seconds without use. Load/unload timings are collected in self.timings.
+    """
+
+    def __init__(self, model=MODEL_NAME, client=None, idle_timeout=OLLAMA_IDLE_UNLOAD, manage_server=True,
+                 warmup=None):
+        self.model = model
+        # Optional (path, payload) sent after each load, e.g. to evaluate a fixed system prompt
+        self.warmup = warmup
+        self.client = client or get_client()
+        self.idle_timeout = idle_timeout
+        # keep_alive in whole seconds; 0 would tell Ollama to unload right away
+        self.keep_alive = max(1, int(idle_timeout))
+        self.manage_server = manage_server
+        self.server_proc = None
+        self.loaded = False
+        self.last_used = 0.0
+        self.timings = {
+            "server_start": None,
+            "loads": 0, "last_load": None, "total_load": 0.0, "load_failures": 0,
+            "unloads": 0, "last_unload": None, "total_unload": 0.0,
+        }
+        self._lock = threading.RLock()
+
+    def _is_warm(self):
+        # Ollama drops the model by itself once keep_alive expires
+        return self.loaded and time.monotonic() - self.last_used < self.idle_timeout
+
+    def ensure_server(self):
+        """Start `ollama serve` if nothing is listening on the API port."""
+        if is_port_listening(self.client.port, self.client.host):
+            return
+        if not self.manage_server:
+            raise ConnectionError(f"Ollama is not listening on {self.client.host}:{self.client.port}")
+        t0 = time.monotonic()
+        self.server_proc = start_ollama(kill_existing=False)
+        self.timings["server_start"] = time.monotonic() - t0
+
+    def acquire(self) -> bool:
+        """
+        Make sure the model is resident and mark it as in use. Returns False when the
+        server or model is unavailable; classification then falls back to the rules.
+        """
+        with self._lock:
+            if not self._is_warm():
+                t0 = time.monotonic()
+                try:
+                    self.ensure_server()
+                    # A generate request without prompt only loads the model
+                    self.client.post_json("/api/generate", {"model": self.model, "keep_alive": self.keep_alive})
+                except (OllamaHTTPError, OSError, http.client.HTTPException) as e:
+                    self.timings["load_failures"] += 1
+                    metrics.inc("ollama_errors_total", kind="load")
+                    print(f"[WARN] Model {self.model} could not be loaded: {e}")
+                    self.loaded = False
+                    return False
+                elapsed = time.monotonic() - t0
+                self.timings["loads"] += 1
+                self.timings["last_load"] = elapsed
+                self.timings["total_load"] += elapsed
+                metrics.observe("ollama_model_load_seconds", elapsed)
+                self.loaded = True
+                print(f"[INFO] Model {self.model} loaded in {elapsed:.2f}s (keep_alive {self.keep_alive}s)")
+                if self.warmup is not None:
+                    t0 = time.monotonic()
+                    try:
+                        self.client.post_json(*self.warmup)
+                        metrics.observe("ollama_warmup_seconds", time.monotonic() - t0)
+                        print(f"[INFO] Prompt prefix warmed up in {time.monotonic() - t0:.2f}s")
+                    except (OllamaHTTPError, OSError, http.client.HTTPException) as e:
+                        print(f"[WARN] Prompt warm-up failed: {e}")
+            self.last_used = time.monotonic()
+            return True
+
+    def touch(self):
+        """Record use of the model, postponing the idle unload."""
+        with self._lock:
+            self.last_used = time.monotonic()
+
+    def hold(self):
+        """Context manager: acquire() on entry, touch() on exit."""
+        return _ResidencyHold(self)
+
+    def unload(self):
+        """Unload the model from memory now (the server keeps running)."""
+        with self._lock:
+            if not self.loaded:
+                return
+            t0 = time.monotonic()
+            try:
+                self.client.post_json("/api/generate", {"model": self.model, "keep_alive": 0})
+            except Exception as e:
+                print(f"[WARN] Model unload request failed: {e}")
+            elapsed = time.monotonic() - t0
+            self.loaded = False
+            self.timings["unloads"] += 1
+            self.timings["last_unload"] = elapsed
+            self.timings["total_unload"] += elapsed
+            print(f"[INFO] Model {self.model} unloaded in {elapsed:.2f}s")
+
+    def release_if_idle(self):
+        """Unload the model once it has been idle for idle_timeout seconds."""
+        with self._lock:
+            if self.loaded and time.monotonic() - self.last_used >= self.idle_timeout:
+                self.unload()
+
+    def wait(self, seconds, step=5.0):
+        """Sleep for seconds while unloading the model once it turns idle."""
+        deadline = time.monotonic() + seconds
+        while True:
+            self.release_if_idle()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(step, remaining))
+
+    def shutdown(self):
+        """Unload the model and stop the server if this manager started it."""
+        self.unload()
+        if self.server_proc is not None:
+            kill_ollama()
+            self.server_proc = None
+
+    def stats(self) -> dict:
+        """Snapshot of load/unload timings."""
+        with self._lock:
+            return dict(self.timings, loaded=self._is_warm())
+
+
+class _ResidencyHold:
+    def __init__(self, residency):
+        self.residency = residency
+
+    def __enter__(self):
+        self.residency.acquire()
+        return self.residency
+
+    def __exit__(self, *exc):
+        self.residency.touch()
+        return False
@@ -0,0 +1,183 @@
+# pipeline.py
+# Staged asyncio pipeline: IMAP fetch -> parse -> classify -> label -> forward.
+# Stages are connected by bounded queues, so fetching batch N+1, classifying batch N
+# and labelling/forwarding batch N-1 overlap, and a slow stage holds back the ones before it.
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    FETCH_MODE, FORWARD_WORKERS, PIPELINE_BATCH_SIZE, PIPELINE_QUEUE_SIZE,
+    PIPELINE_PARSE_WORKERS, PIPELINE_CLASSIFY_WORKERS,
+)
+from classification_utils import classify_content
+from gmail_forward import forward_candidates, label_forwarded
+from main import FETCHERS, chunk_list, label_batch
+from metrics import metrics
+
+# End-of-input marker, one per worker of the receiving stage
+STOP = object()
+# Batches classified at once; the classify pool stays busy while one batch finishes
+CLASSIFY_BATCHES = 2
+
+
+class Pipeline:
+    """
+    Runs the processing stages for a list of UIDs on one open IMAPClient.
+    IMAP calls (fetch, label STOREs) go through a single thread since they share
+    the connection; parsing and classification use their own thread pools and
+    forwarding uses the GmailForwarder. on_batch_done(batch) runs after a batch
+    has been labelled and forwarded. classify_submit(body, headers, info) -> Future
+    replaces the local classify pool (e.g. a queue shared by several accounts).
+    With a MailboxSync, labelled and forwarded batches are written to its ledger
+    and messages the ledger shows as forwarded are not sent again.
+    """
+
+    def __init__(self, imap, forwarder=None, mark_seen=False, on_batch_done=None, classify_submit=None, sync=None,
+                 batch_size=PIPELINE_BATCH_SIZE, queue_size=PIPELINE_QUEUE_SIZE,
+                 parse_workers=PIPELINE_PARSE_WORKERS, classify_workers=PIPELINE_CLASSIFY_WORKERS,
+                 forward_workers=FORWARD_WORKERS):
+        self.imap = imap
+        self.forwarder = forwarder
+        self.mark_seen = mark_seen
+        self.on_batch_done = on_batch_done
+        self.classify_submit = classify_submit
+        self.sync = sync
+        self.batch_size = max(1, batch_size)
+        self.queue_size = max(1, queue_size)
+        self.parse_workers = max(1, parse_workers)
+        self.classify_workers = max(1, classify_workers)
+        self.forward_workers = max(1, forward_workers)
+        self.fetch_data, self.parse = FETCHERS.get(FETCH_MODE, FETCHERS['partial'])
+        self.results = {}
+        # Seconds spent in each stage (summed over workers) and batches handled
+        self.busy = {}
+        self.batches = {}
+
+    async def _call(self, pool, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+    async def _timed(self, name, coro):
+        start = time.monotonic()
+        try:
+            return await coro
+        finally:
+            elapsed = time.monotonic() - start
+            self.busy[name] = self.busy.get(name, 0.0) + elapsed
+            self.batches[name] = self.batches.get(name, 0) + 1
+            metrics.observe("stage_seconds", elapsed, stage=name)
+
+    async def _stage(self, name, inbox, outbox, workers, handle):
+        """Run workers consuming inbox until STOP; a failing batch is reported and dropped."""
+        async def worker():
+            while True:
+                item = await inbox.get()
+                if item is STOP:
+                    return
+                batch = item[0]
+                try:
+                    out = await self._timed(name, handle(*item))
+                except Exception as e:
+                    metrics.inc("stage_errors_total", stage=name)
+                    print(f"[ERROR] Pipeline {name} failed for UIDs {batch[0]}-{batch[-1]}: {e}")
+                    continue
+                metrics.inc("stage_messages_total", len(batch), stage=name)
+                if outbox is not None:
+                    await outbox.put((batch, out))
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+    async def _then_stop(self, stage, outbox, receivers):
+        await stage
+        for _ in range(receivers):
+            await outbox.put(STOP)
+
+    async def _fetch_all(self, uids, outbox):
+        for batch in chunk_list(uids, self.batch_size):
+            try:
+                fetched = await self._timed('fetch', self._call(self._imap_pool, self.fetch_data, self.imap, batch))
+            except Exception as e:
+                metrics.inc("stage_errors_total", stage='fetch')
+                print(f"[ERROR] Pipeline fetch failed for UIDs {batch[0]}-{batch[-1]}: {e}")
+                continue
+            metrics.inc("stage_messages_total", len(batch), stage='fetch')
+            await outbox.put((batch, fetched))
+
+    async def _parse(self, batch, fetched):
+        return await self._call(self._parse_pool, self.parse, batch, fetched)
+
+    async def _classify(self, batch, parsed):
+        infos = [{} for _ in parsed]
+        if self.classify_submit is not None:
+            categories = await asyncio.gather(*(
+                asyncio.wrap_future(self.classify_submit(body, headers, info))
+                for (_, _, _, body, headers), info in zip(parsed, infos)))
+        else:
+            categories = await asyncio.gather(*(
+                self._call(self._classify_pool, classify_content, body, headers, None, info)
+                for (_, _, _, body, headers), info in zip(parsed, infos)))
+        return parsed, categories, [info.get("source") for info in infos]
+
+    def _label_and_record(self, parsed, categories, sources):
+        results = label_batch(self.imap, parsed, categories, self.mark_seen, sources)
+        if self.sync is not None:
+            self.sync.record(results)
+        return results
+
+    def _label_forwarded(self, outcome):
+        sent = label_forwarded(self.imap, outcome)
+        if self.sync is not None:
+            self.sync.mark_sent(sent)
+
+    async def _label(self, batch, classified):
+        parsed, categories, sources = classified
+        results = await self._call(self._imap_pool, self._label_and_record, parsed, categories, sources)
+        self.results.update(results)
+        return results
+
+    async def _forward(self, batch, results):
+        if self.forwarder is not None:
+            todo = batch
+            if self.sync is not None:
+                sent = self.sync.forwarded(batch)
+                if sent:
+                    print(f"[INFO] {len(sent)} emails already forwarded according to the ledger, skipping")
+                    todo = [uid for uid in batch if uid not in sent]
+            items = await self._call(self._imap_pool, forward_candidates, todo, self.imap, results,
+                                     self.forwarder.report_to)
+            if items:
+                outcome = await asyncio.wrap_future(self.forwarder.submit(items))
+                await self._call(self._imap_pool, self._label_forwarded, outcome)
+        if self.on_batch_done is not None:
+            self.on_batch_done(batch)
+
+    async def run(self, uids) -> dict:
+        """Process uids through all stages; returns label_batch() results for every labelled UID."""
+        uids = list(uids)
+        if not uids:
+            return {}
+        start = time.monotonic()
+        q_parse, q_classify, q_label, q_forward = (asyncio.Queue(self.queue_size) for _ in range(4))
+        with ThreadPoolExecutor(1, thread_name_prefix='imap') as self._imap_pool, \
+                ThreadPoolExecutor(self.parse_workers, thread_name_prefix='parse') as self._parse_pool, \
+                ThreadPoolExecutor(self.classify_workers, thread_name_prefix='classify') as self._classify_pool:
+            await asyncio.gather(
+                self._then_stop(self._fetch_all(uids, q_parse), q_parse, self.parse_workers),
+                self._then_stop(self._stage('parse', q_parse, q_classify, self.parse_workers, self._parse),
+                                q_classify, CLASSIFY_BATCHES),
+                self._then_stop(self._stage('classify', q_classify, q_label, CLASSIFY_BATCHES, self._classify),
+                                q_label, 1),
+                self._then_stop(self._stage('label', q_label, q_forward, 1, self._label),
+                                q_forward, self.forward_workers),
+                self._stage('forward', q_forward, None, self.forward_workers, self._forward),
+            )
+        busy = ", ".join(f"{name} {secs:.1f}s" for name, secs in self.busy.items())
+        print(f"[INFO] Pipeline: {len(self.results)}/{len(uids)} emails in {time.monotonic() - start:.1f}s "
+              f"(busy: {busy})")
+        return self.results
+
+
+def run_pipeline(imap, uids, forwarder=None, mark_seen=False, on_batch_done=None, classify_submit=None,
+                 sync=None) -> dict:
+    """Blocking entry point: run a Pipeline for uids in a fresh event loop."""
+    return asyncio.run(Pipeline(imap, forwarder, mark_seen, on_batch_done, classify_submit, sync).run(uids))
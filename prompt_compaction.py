@@ -0,0 +1,114 @@
+# prompt_compaction.py
+# Shrinks an email body before it goes into the prompt: quoted history, signatures,
+# unsubscribe/legal footers and tracking URLs are removed and the rest is cut to a token budget.
+import re
+from urllib.parse import urlsplit
+
+# Start of quoted history: everything from this line on is dropped
+_QUOTE_START = re.compile(
+    r'^\s*(?:'
+    r'on\b.{0,200}\bwrote:\s*$'                      # On Mon, 1 Jan 2024, Alice <a@b> wrote:
+    r'|在.{0,200}写道[:：]\s*$'                        # 在 2024年1月1日，Alice 写道：
+    r'|-{2,}\s*original message\s*-{2,}'
+    r'|-{2,}\s*原始邮件\s*-{2,}'
+    r'|_{10,}\s*$'                                    # Outlook separator line
+    r'|from:\s.+\n\s*(?:sent|date):\s'               # Outlook reply header block
+    r'|发件人[:：].+\n\s*(?:发送时间|日期)[:：]'
+    r')',
+    re.IGNORECASE | re.MULTILINE)
+
+# Start of a signature
+_SIGNATURE_START = re.compile(
+    r'^(?:--\s*$'
+    r'|\s*sent from my \w+'
+    r'|\s*get outlook for \w+'
+    r'|\s*发自我的\w+)',
+    re.IGNORECASE | re.MULTILINE)
+
+# Footer lines: list management, legal and "why you got this" boilerplate
+_FOOTER_LINE = re.compile(
+    r'unsubscribe|opt[ -]out|manage (?:your )?(?:email )?(?:preferences|subscriptions)'
+    r'|email preferences|you (?:are )?receiv(?:ed|ing) this (?:e-?mail|message)'
+    r'|view (?:this email |it )?in (?:your|a) browser|privacy policy|terms of (?:use|service)'
+    r'|all rights reserved|©|\(c\) \d{4}|this (?:e-?mail|message) (?:and any attachments )?(?:is|may be) confidential'
+    r'|退订|取消订阅|隐私政策',
+    re.IGNORECASE)
+# Footer lines are only dropped when they are short; longer lines are probably content
+FOOTER_MAX_CHARS = 300
+
+_URL = re.compile(r'https?://[^\s<>"\')\]]+', re.IGNORECASE)
+_CJK = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count: about one token per CJK character and per four other characters."""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens tokens, preferring to end at a line break."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0.0
+    cut = len(text)
+    for i, ch in enumerate(text):
+        used += 1.0 if _CJK.match(ch) else 0.25
+        if used > max_tokens:
+            cut = i
+            break
+    newline = text.rfind('\n', 0, cut)
+    if newline > cut * 0.8:
+        cut = newline
+    return text[:cut].rstrip()
+
+
+def strip_quoted(text: str) -> str:
+    """Drop quoted history: '>' lines and everything after an 'On ... wrote:' style header."""
+    m = _QUOTE_START.search(text)
+    if m:
+        text = text[:m.start()]
+    return '\n'.join(line for line in text.split('\n') if not line.lstrip().startswith('>'))
+
+
+def strip_signature(text: str) -> str:
+    """Drop everything from a signature marker ('-- ', 'Sent from my ...') on."""
+    m = _SIGNATURE_START.search(text)
+    return text[:m.start()] if m else text
+
+
+def strip_footer(text: str) -> str:
+    """Drop short unsubscribe, legal and 'view in browser' lines."""
+    return '\n'.join(line for line in text.split('\n')
+                     if len(line) > FOOTER_MAX_CHARS or not _FOOTER_LINE.search(line))
+
+
+def shorten_urls(text: str) -> str:
+    """Replace URLs (mostly tracking redirects) by their host name."""
+    def host(m):
+        netloc = urlsplit(m.group()).netloc.lower()
+        return f'<{netloc[4:] if netloc.startswith("www.") else netloc}>' if netloc else ''
+    return _URL.sub(host, text)
+
+
+def collapse_whitespace(text: str) -> str:
+    text = re.sub(r'[ \t\u00a0\u200b-\u200d\ufeff]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def compact_body(body: str, max_tokens: int) -> str:
+    """
+    Body text for the prompt: quoted replies, signatures, footers and URLs removed,
+    whitespace collapsed, cut to max_tokens. If stripping leaves nothing (a bare
+    forward or a quote-only reply) the unstripped text is used instead.
+    """
+    if not body:
+        return ''
+    body = body.replace('\r\n', '\n').replace('\r', '\n')
+    text = collapse_whitespace(shorten_urls(strip_footer(strip_signature(strip_quoted(body)))))
+    if not text:
+        text = collapse_whitespace(shorten_urls(body))
+    return truncate_tokens(text, max_tokens)
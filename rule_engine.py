@@ -0,0 +1,124 @@
+# rule_engine.py
+# Keyword rules for the rule-based fallback, compiled once into one regex per field.
+import re
+
+# Fields a rule can look at. "body" is matched against the first N characters given in the rule.
+FIELDS = ("from", "subject", "body")
+
+# Rules in priority order: the first rule with any matching term wins.
+# fields maps field name -> None (whole field) or max body prefix length.
+RULES = [
+    # Blacklisted senders
+    {"category": "Promotion", "fields": {"from": None}, "terms": [
+        "otter.ai", "everyday rewards", "telstra", "gumtree", "prosple", "academia",
+        "13cabs", "flybuys", "doordash", "promotions@", "no-reply@", "unsubscribe@",
+        "noreply@", "notifications@", "newsletter@", "marketing@", "bandmix",
+        "advertisement", "promotion", "discount", "sale", "off", "coupon",
+    ]},
+    {"category": "Security", "fields": {"subject": None, "from": None, "body": 500}, "terms": [
+        "security", "verification code", "login", "password", "bigfamily",
+        "account", "confirm", "authenticate", "secondary verification", "2fa",
+        "identity verification", "secure", "authentication", "alert", "warning", "suspicious",
+    ]},
+    {"category": "Opportunities", "fields": {"subject": None, "body": 500}, "terms": [
+        "job", "career", "opportunity", "position", "interview", "hire", "recruitment",
+        "application", "resume", "offer", "employment", "hiring",
+        "talent", "apply", "candidate", "job opening", "job opportunities", "career development",
+    ]},
+    {"category": "Work", "fields": {"subject": None, "body": 300}, "terms": [
+        "urgent", "important", "action", "required", "please note",
+        "deadline", "payment", "invoice", "contract", "project", "task",
+        "meeting", "report", "work", "colleague", "team", "customer", "collaborate",
+    ]},
+    {"category": "Personal", "fields": {"subject": None, "body": 300}, "terms": [
+        "personal", "friend", "family", "social", "invite", "invitation",
+        "party", "celebration", "birthday", "wedding", "travel", "trip",
+        "private", "tour", "vacation", "holiday",
+    ]},
+    {"category": "Update", "fields": {"subject": None, "body": 300}, "terms": [
+        "update", "upgrade", "new version", "patch", "version", "release",
+        "improvement", "enhancement", "system", "software", "app", "application",
+        "changelog", "change log", "new feature", "feature",
+    ]},
+    {"category": "Transaction", "fields": {"subject": None, "body": 300}, "terms": [
+        "transaction", "receipt", "payment", "order", "purchase", "bill", "invoice",
+        "statement", "bought", "paid", "confirmation", "shipped", "delivery", "tracking",
+    ]},
+    {"category": "Promotion", "fields": {"subject": None, "from": None, "body": 500}, "terms": [
+        "promotion", "discount", "sale", "offer", "deal", "coupon", "code",
+        "subscription", "newsletter", "marketing", "advertisement",
+        "special price", "limited time", "flash sale", "full reduction", "new product", "activity", "special",
+    ]},
+]
+
+_WORD_START = r"(?<![a-z0-9])"
+# Terms ending in a letter/digit must end on a word boundary; a plural "s" is allowed
+_WORD_END = r"s?(?![a-z0-9])"
+
+
+def _trie_pattern(terms) -> str:
+    """Regex for a set of terms, factored as a prefix trie so matching is one left-to-right scan."""
+    trie = {}
+    for term in terms:
+        node = trie
+        for ch in term:
+            node = node.setdefault(ch, {})
+        node[""] = term
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if "" in node:
+            # Term ends here; longer terms are tried first
+            alts.append(_WORD_END if node[""][-1].isalnum() else "")
+        return alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+
+    return _WORD_START + build(trie)
+
+
+def compile_rules(rules=RULES) -> dict:
+    """
+    Compile the rule table into {field: (regex, {term: [(priority, limit, category), ...]})}.
+    Each term keeps the rules it belongs to, best priority first.
+    """
+    compiled = {}
+    for field in FIELDS:
+        index = {}
+        for priority, rule in enumerate(rules):
+            if field not in rule["fields"]:
+                continue
+            limit = rule["fields"][field]
+            for term in rule["terms"]:
+                index.setdefault(term, []).append((priority, limit, rule["category"]))
+        if index:
+            for entries in index.values():
+                entries.sort()
+            compiled[field] = (re.compile(_trie_pattern(index)), index)
+    return compiled
+
+
+_COMPILED = compile_rules()
+_BODY_SCAN = max((r["fields"].get("body") or 0) for r in RULES)
+
+
+def match_rules(from_addr: str, subject: str, body_lower: str, compiled=None):
+    """
+    Return (category, field, term) for the highest-priority matching rule, or None.
+    Inputs are expected in lower case.
+    """
+    compiled = compiled or _COMPILED
+    fields = {"from": from_addr or "", "subject": subject or "", "body": (body_lower or "")[:_BODY_SCAN]}
+    best = None
+    for field, (regex, index) in compiled.items():
+        for m in regex.finditer(fields[field]):
+            term = m.group()
+            if term not in index:
+                term = term[:-1]  # plural "s"
+            for priority, limit, category in index[term]:
+                if limit is not None and m.end() > limit:
+                    continue
+                if best is None or priority < best[0]:
+                    best = (priority, category, field, term)
+                break
+            if best is not None and best[0] == 0:
+                return best[1:]
+    return best[1:] if best else None
@@ -0,0 +1,167 @@
+# sender_reputation.py
+# Learned sender/domain -> category table used to skip the LLM for predictable senders.
+import email
+import time
+import threading
+from email.utils import parseaddr
+
+from config import (
+    MAIN_CATS, REPUTATION_MIN_COUNT, REPUTATION_MIN_SHARE, REPUTATION_HALF_LIFE_DAYS,
+)
+from db_utils import get_db, db_lock
+
+# Shared mail providers: the domain says nothing about the category
+FREEMAIL_DOMAINS = {
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com", "yahoo.com",
+    "icloud.com", "me.com", "qq.com", "163.com", "126.com", "proton.me", "protonmail.com",
+}
+
+# Entries whose decayed weight falls below this are deleted
+PRUNE_WEIGHT = 0.05
+# Prune after this many recorded messages
+PRUNE_EVERY = 500
+
+
+def sender_keys(from_header: str) -> list:
+    """Reputation keys for a From header: the address, then its domain (unless free mail)."""
+    addr = parseaddr(from_header or "")[1].strip().lower()
+    if "@" not in addr:
+        return []
+    keys = [f"addr:{addr}"]
+    domain = addr.rsplit("@", 1)[1]
+    if domain and domain not in FREEMAIL_DOMAINS:
+        keys.append(f"domain:{domain}")
+    return keys
+
+
+class SenderReputation:
+    """
+    Per-sender and per-domain category weights with exponential decay.
+    lookup() returns a category only when the decayed history is large enough
+    and dominated by a single category; every hit counts as a saved LLM call.
+    """
+
+    def __init__(self, conn=None, min_count=REPUTATION_MIN_COUNT, min_share=REPUTATION_MIN_SHARE,
+                 half_life_days=REPUTATION_HALF_LIFE_DAYS):
+        self.conn = conn or get_db()
+        self.min_count = min_count
+        self.min_share = min_share
+        self.half_life = half_life_days * 86400
+        self.saved = 0
+        self.lookups = 0
+        self._recorded = 0
+        self._lock = threading.Lock()
+        with db_lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS sender_reputation (
+                    key TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    weight REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (key, category)
+                )
+            ''')
+            self.conn.commit()
+
+    def _decay(self, weight, updated_at, now):
+        return weight * 0.5 ** (max(0.0, now - updated_at) / self.half_life)
+
+    def _weights(self, key, now):
+        rows = self.conn.execute(
+            "SELECT category, weight, updated_at FROM sender_reputation WHERE key = ?", (key,)).fetchall()
+        return {cat: self._decay(w, ts, now) for cat, w, ts in rows}
+
+    def lookup(self, from_header: str):
+        """Return the stable category for this sender, or None."""
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+        with db_lock:
+            for key in sender_keys(from_header):
+                weights = self._weights(key, now)
+                total = sum(weights.values())
+                if total < self.min_count:
+                    continue
+                cat, top = max(weights.items(), key=lambda kv: kv[1])
+                if top / total >= self.min_share:
+                    with self._lock:
+                        self.saved += 1
+                    return cat
+                # The address is known but mixed, the domain will not be more reliable
+                return None
+        return None
+
+    def record(self, from_header: str, category: str, weight: float = 1.0, commit: bool = True):
+        """Add one observation of category for this sender and its domain."""
+        if category not in MAIN_CATS:
+            return
+        now = time.time()
+        with db_lock:
+            for key in sender_keys(from_header):
+                row = self.conn.execute(
+                    "SELECT weight, updated_at FROM sender_reputation WHERE key = ? AND category = ?",
+                    (key, category)).fetchone()
+                new_weight = weight + (self._decay(row[0], row[1], now) if row else 0.0)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO sender_reputation (key, category, weight, updated_at) VALUES (?, ?, ?, ?)",
+                    (key, category, new_weight, now))
+            if commit:
+                self.conn.commit()
+            self._recorded += 1
+            if self._recorded % PRUNE_EVERY == 0:
+                self.prune()
+
+    def prune(self):
+        """Delete entries whose decayed weight has become negligible."""
+        now = time.time()
+        with db_lock:
+            stale = [
+                (key, cat) for key, cat, w, ts in
+                self.conn.execute("SELECT key, category, weight, updated_at FROM sender_reputation")
+                if self._decay(w, ts, now) < PRUNE_WEIGHT
+            ]
+            self.conn.executemany("DELETE FROM sender_reputation WHERE key = ? AND category = ?", stale)
+            self.conn.commit()
+        if stale:
+            print(f"[INFO] Sender reputation: pruned {len(stale)} stale entries")
+
+    def is_empty(self) -> bool:
+        with db_lock:
+            return self.conn.execute("SELECT 1 FROM sender_reputation LIMIT 1").fetchone() is None
+
+    def bootstrap_from_db(self):
+        """Seed from past results in the processed table (rows with a sender and category)."""
+        with db_lock:
+            columns = [col[1] for col in self.conn.execute("PRAGMA table_info(processed)")]
+            if "from_addr" not in columns:
+                return 0
+            rows = self.conn.execute(
+                "SELECT from_addr, category FROM processed WHERE from_addr IS NOT NULL AND category IS NOT NULL"
+            ).fetchall()
+            for from_addr, category in rows:
+                self.record(from_addr, category, commit=False)
+            self.conn.commit()
+        print(f"[INFO] Sender reputation: seeded from {len(rows)} processed rows")
+        return len(rows)
+
+    def bootstrap_from_imap(self, imap, per_label=500):
+        """Seed from the newest per_label messages carrying each Gmail category label."""
+        total = 0
+        for cat in MAIN_CATS:
+            uids = imap.search(['X-GM-LABELS', cat])[-per_label:]
+            if not uids:
+                continue
+            data = imap.fetch(uids, ['BODY.PEEK[HEADER.FIELDS (FROM)]'])
+            with db_lock:
+                for d in data.values():
+                    raw = next((v for k, v in d.items() if k.startswith(b'BODY[HEADER')), b'')
+                    from_addr = email.message_from_bytes(raw or b'').get('From', '')
+                    self.record(from_addr, cat, commit=False)
+                    total += 1
+                self.conn.commit()
+        print(f"[INFO] Sender reputation: seeded from {total} labeled messages")
+        return total
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"lookups": self.lookups, "llm_calls_saved": self.saved}
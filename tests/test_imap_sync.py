@@ -0,0 +1,99 @@
+# Tests for the persistent pending set and the unread-first work scheduler.
+import sqlite3
+
+import pytest
+
+import imap_sync
+from imap_sync import MailboxSync, WorkScheduler, STALL_BACKOFF, uid_set
+from ledger import Ledger
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(imap_sync.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def sync():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    sync = MailboxSync(imap=None, conn=conn, ledger=Ledger(conn))
+    sync.uidvalidity = 7
+    return sync
+
+
+def _pending(sync, read=(), unread=()):
+    sync._apply({**{uid: {b'FLAGS': (b'\\Seen',)} for uid in read},
+                 **{uid: {b'FLAGS': ()} for uid in unread}})
+
+
+def test_uid_set_ranges():
+    assert uid_set([5, 1, 2, 3, 9, 10]) == '1:3,5,9:10'
+
+
+def test_apply_skips_ledger_and_processed_label(sync):
+    sync.record({1: {'category': 'Work'}})
+    sync._apply({1: {b'FLAGS': ()},
+                 2: {b'FLAGS': (), b'X-GM-LABELS': (imap_sync.PROCESSED_CAT.encode(),)},
+                 3: {b'FLAGS': ()}})
+    assert sync.unprocessed() == [3]
+    sync.discard([3])
+    assert sync.unprocessed() == []
+
+
+def test_unread_first_and_in_full(sync, clock):
+    _pending(sync, read=range(1, 50), unread=[60, 61])
+    scheduler = WorkScheduler(sync, history_rate=10, chunk=5)
+    assert scheduler.next_batch() == ([60, 61], True)
+    sync.discard([60, 61])
+    assert scheduler.next_batch() == ([1, 2, 3, 4, 5], False)
+
+
+def test_history_token_bucket(sync, clock):
+    _pending(sync, read=range(1, 50))
+    scheduler = WorkScheduler(sync, history_rate=10, chunk=5)
+    assert scheduler.next_batch()[0] == [1, 2, 3, 4, 5]
+    sync.discard([1, 2, 3, 4, 5])
+    # The bucket is empty: 5 messages at 10/min take 30 seconds to refill
+    assert scheduler.next_batch() == ([], False)
+    assert scheduler.history_wait() == pytest.approx(30.0)
+    clock.now += 29
+    assert scheduler.next_batch() == ([], False)
+    clock.now += 1
+    assert scheduler.next_batch()[0] == [6, 7, 8, 9, 10]
+
+
+def test_history_unlimited_and_disabled(sync, clock):
+    _pending(sync, read=range(1, 20))
+    assert WorkScheduler(sync, history_rate=None, chunk=5).next_batch() == ([], False)
+    assert WorkScheduler(sync, history_rate=None, chunk=5).history_wait() is None
+    scheduler = WorkScheduler(sync, history_rate=0, chunk=5)
+    assert scheduler.next_batch()[0] == [1, 2, 3, 4, 5]
+    sync.discard([1, 2, 3, 4, 5])
+    assert scheduler.next_batch()[0] == [6, 7, 8, 9, 10]
+    assert scheduler.history_wait() == 0
+
+
+def test_stall_backoff(sync, clock):
+    _pending(sync, unread=[3, 4])
+    scheduler = WorkScheduler(sync, history_rate=0)
+    assert scheduler.next_batch() == ([3, 4], True)
+    # Still pending after processing: the same batch is held back for STALL_BACKOFF
+    assert scheduler.next_batch() == ([], False)
+    clock.now += STALL_BACKOFF - 1
+    assert scheduler.next_batch() == ([], False)
+    assert scheduler.history_wait() == pytest.approx(1.0)
+    clock.now += 1
+    assert scheduler.next_batch() == ([3, 4], True)
+    # New mail changes the batch and is released at once
+    _pending(sync, unread=[5])
+    assert scheduler.next_batch() == ([3, 4, 5], True)
@@ -0,0 +1,56 @@
+# Tests for the nearest-neighbour fast path (hashing embedder, no Ollama needed).
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from knn_index import KnnIndex, hash_vector  # noqa: E402
+
+
+def _index(path, **kwargs):
+    options = dict(embedder="hash", dim=256, k=3, min_similarity=0.5, min_agreement=0.6)
+    options.update(kwargs)
+    return KnnIndex(path=str(path), **options)
+
+
+def _unit(*values):
+    vec = np.asarray(values + (0.0,) * (256 - len(values)), dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def test_hash_vector_is_unit_and_stable():
+    headers = {"From": "Shop <news@shop.example>", "Subject": "Weekend sale"}
+    vec = hash_vector(headers, "Everything 20% off", dim=256)
+    assert vec.shape == (256,)
+    assert np.linalg.norm(vec) == pytest.approx(1.0)
+    assert np.array_equal(vec, hash_vector(headers, "Everything 20% off", dim=256))
+    assert float(vec @ hash_vector({"From": "a@b.example", "Subject": "Minutes"}, "", dim=256)) < 0.5
+
+
+def test_agreement_threshold(tmp_path):
+    index = _index(tmp_path / "knn.f32")
+    assert index.is_empty()
+    index.add_many(np.stack([_unit(1, 0.1), _unit(1, 0.2), _unit(1, -0.1)]), ["Promotion", "Promotion", "Work"])
+    assert index.search(_unit(1))[0][1] in ("Promotion", "Work")
+    # 2 of 3 neighbours agree: 0.67 >= 0.6
+    assert index.lookup(_unit(1)) == "Promotion"
+    assert _index(tmp_path / "knn.f32", min_agreement=0.8).lookup(_unit(1)) is None
+    # Neighbours below min_similarity do not vote
+    assert index.lookup(_unit(0, 1)) is None
+    assert index.stats() == {"rows": 3, "lookups": 2, "llm_calls_saved": 1}
+
+
+def test_too_few_rows_and_unknown_categories(tmp_path):
+    index = _index(tmp_path / "knn.f32")
+    index.add_many(np.stack([_unit(1), _unit(1), _unit(1)]), ["Promotion", "Promotion", "NotACategory"])
+    assert index.rows == 2
+    assert index.lookup(_unit(1)) is None
+
+
+def test_reopen_and_embedder_change(tmp_path):
+    path = tmp_path / "knn.f32"
+    _index(path).add(_unit(1), "Work")
+    # A partly written row from a crash is dropped on open
+    with open(path, "ab") as f:
+        f.write(b"\0" * 10)
+    assert _index(path).rows == 1
+    assert _index(path, dim=128).is_empty()
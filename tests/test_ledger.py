@@ -0,0 +1,60 @@
+# Tests for the processing ledger in processed_emails.db.
+import sqlite3
+
+import pytest
+
+from ledger import Ledger
+
+
+@pytest.fixture
+def ledger():
+    return Ledger(sqlite3.connect(':memory:', check_same_thread=False))
+
+
+def test_upsert_keeps_known_values(ledger):
+    ledger.record('INBOX', 1, {10: {'category': 'Work', 'msgid': 123, 'from': 'a@example.com', 'unread': True,
+                                    'source': 'llm'}})
+    ledger.record('INBOX', 1, {10: {'category': 'Promotion', 'unread': False}})
+    assert ledger.results('INBOX', 1, [10]) == {10: {'category': 'Promotion', 'msgid': 123, 'from': 'a@example.com'}}
+    row = ledger.conn.execute("SELECT was_unread, source FROM processed WHERE uid = 10").fetchone()
+    assert row == (1, 'llm')
+
+
+def test_keyed_by_folder_and_uidvalidity(ledger):
+    ledger.record('INBOX', 1, {10: {'category': 'Work'}})
+    ledger.record('acct/INBOX', 1, {11: {'category': 'Work'}})
+    assert ledger.processed('INBOX', 1, [10, 11]) == {10}
+    assert ledger.processed('INBOX', 2, [10]) == set()
+
+
+def test_sent(ledger):
+    ledger.record('INBOX', 1, {uid: {'category': 'Work'} for uid in range(1, 1200)})
+    ledger.mark_sent('INBOX', 1, [2, 3, 999, 5000])
+    assert ledger.sent('INBOX', 1, range(1, 1200)) == {2, 3, 999}
+    assert ledger.stats() == {"processed": 1199, "forwarded": 3}
+
+
+def test_categories_by_source(ledger):
+    ledger.record('INBOX', 1, {1: {'category': 'Work', 'source': 'llm'},
+                               2: {'category': 'Work', 'source': 'rules'},
+                               3: {'category': 'Update', 'source': 'cache'}})
+    assert ledger.categories('INBOX', 1, ('llm', 'cache')) == {1: 'Work', 3: 'Update'}
+
+
+def test_migrations():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.execute("CREATE TABLE processed (uid INTEGER PRIMARY KEY)")
+    Ledger(conn)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'processed', 'processed_v1'} <= tables
+
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    # The table before the source column was added
+    conn.execute("CREATE TABLE processed (folder TEXT NOT NULL, uidvalidity INTEGER NOT NULL, uid INTEGER NOT NULL, "
+                 "msgid INTEGER, processed_at TEXT, sent INTEGER DEFAULT 0, was_unread INTEGER, category TEXT, "
+                 "from_addr TEXT, PRIMARY KEY (folder, uidvalidity, uid))")
+    conn.execute("INSERT INTO processed (folder, uidvalidity, uid, category) VALUES ('INBOX', 1, 1, 'Work')")
+    ledger = Ledger(conn)
+    assert ledger.results('INBOX', 1, [1])[1]['category'] == 'Work'
+    ledger.record('INBOX', 1, {1: {'category': 'Work', 'source': 'llm'}})
+    assert ledger.categories('INBOX', 1, ['llm']) == {1: 'Work'}
@@ -0,0 +1,64 @@
+# Tests for body extraction and incremental transfer decoding.
+import base64
+import email
+import quopri
+
+from mime_utils import decode_text, extract_text, iter_transfer_decoded
+
+TEXT = "预订确认：您的航班已经出票。Your booking is confirmed.\n"
+
+
+def _message(encoding, payload: bytes, charset='utf-8'):
+    return email.message_from_bytes(
+        f"Content-Type: text/plain; charset={charset}\nContent-Transfer-Encoding: {encoding}\n\n".encode()
+        + payload)
+
+
+def test_extract_text_8bit_non_ascii():
+    # compat32 get_payload() returns this part already decoded; it used to raise UnicodeEncodeError
+    assert extract_text(_message('8bit', TEXT.encode('utf-8'))) == TEXT
+
+
+def test_extract_text_8bit_legacy_charset():
+    assert extract_text(_message('8bit', TEXT.encode('gb18030'), charset='gb2312')) == TEXT
+
+
+def test_extract_text_encoded_parts():
+    data = TEXT.encode('utf-8')
+    assert extract_text(_message('base64', base64.encodebytes(data))) == TEXT
+    assert extract_text(_message('quoted-printable', quopri.encodestring(data))) == TEXT
+
+
+def test_extract_text_limit_and_html_fallback():
+    msg = email.message_from_bytes(
+        b"Content-Type: multipart/alternative; boundary=b\n\n"
+        b"--b\nContent-Type: text/plain\n\nView in browser\n"
+        b"--b\nContent-Type: text/html; charset=utf-8\nContent-Transfer-Encoding: 8bit\n\n"
+        + "<style>p{}</style><p>Bonjour à tous</p><p>second</p>".encode() + b"\n--b--\n")
+    assert extract_text(msg) == "Bonjour à tous\nsecond"
+    assert len(extract_text(msg, limit=7)) <= 7
+    assert extract_text(_message('8bit', TEXT.encode('utf-8')), limit=4) == TEXT[:4]
+
+
+def test_base64_chunk_boundaries():
+    data = bytes(range(256)) * 40
+    raw = base64.encodebytes(data)
+    for chunk in (5, 77, 1000, 8192):
+        assert b''.join(iter_transfer_decoded(raw, 'base64', chunk=chunk)) == data
+
+
+def test_quoted_printable_chunk_boundaries():
+    data = ("ligne accentuée = égal\n" * 300).encode('utf-8')
+    raw = quopri.encodestring(data)
+    for chunk in (3, 50, 1000, 8192):
+        assert b''.join(iter_transfer_decoded(raw, 'quoted-printable', chunk=chunk)) == data
+
+
+def test_quoted_printable_truncated_escape():
+    assert b''.join(iter_transfer_decoded(b'hello=20world=4', 'quoted-printable')) == b'hello world'
+    assert b''.join(iter_transfer_decoded(b'hello=20world=', 'quoted-printable', chunk=4)) == b'hello world'
+
+
+def test_decode_text_truncated_multibyte_tail():
+    raw = TEXT.encode('utf-8')[:5]
+    assert decode_text(raw, '8bit', 'utf-8', truncated=True) == TEXT[:1]
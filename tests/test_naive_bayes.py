@@ -0,0 +1,65 @@
+# Tests for the local naive Bayes classifier.
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from config import MAIN_CATS  # noqa: E402
+from ledger import Ledger  # noqa: E402
+from naive_bayes import NaiveBayes, evaluate, hashed_features, llm_labelled_uids  # noqa: E402
+
+BITS = 12
+PROMO = ({"From": "Shop <deals@shop.example>", "Subject": "Weekend sale"}, "Everything half price, coupon inside")
+WORK = ({"From": "Bob <bob@corp.example>", "Subject": "Project meeting"}, "Agenda for the project review meeting")
+
+
+def _doc(message):
+    return hashed_features(*message, bits=BITS, body_chars=1000)
+
+
+@pytest.fixture
+def model():
+    docs = [_doc(PROMO)] * 5 + [_doc(WORK)] * 5
+    labels = [MAIN_CATS.index("Promotion")] * 5 + [MAIN_CATS.index("Work")] * 5
+    return NaiveBayes.train(docs, labels, bits=BITS, body_chars=1000)
+
+
+def test_train_and_predict(model):
+    assert model.predict(*PROMO)[0] == "Promotion"
+    assert model.predict(*WORK)[0] == "Work"
+    assert model.scores(_doc(PROMO)).sum() == pytest.approx(1.0)
+
+
+def test_lookup_threshold(model):
+    assert model.lookup(*PROMO, min_confidence=0.5) == "Promotion"
+    assert model.lookup(*PROMO, min_confidence=1.01) is None
+    assert model.stats() == {"lookups": 2, "llm_calls_saved": 1}
+
+
+def test_save_load_round_trip(model, tmp_path):
+    path = str(tmp_path / "nb.npz")
+    model.meta = {"trained_on": 10}
+    model.save(path)
+    loaded = NaiveBayes.load(path)
+    assert loaded.bits == BITS and loaded.meta["trained_on"] == 10
+    assert np.array_equal(loaded.counts, model.counts)
+    assert loaded.predict(*WORK) == model.predict(*WORK)
+    assert NaiveBayes.load(str(tmp_path / "missing.npz")) is None
+
+
+def test_evaluate(model):
+    report = evaluate(model, [_doc(PROMO), _doc(WORK)],
+                      [MAIN_CATS.index("Promotion"), MAIN_CATS.index("Work")], min_confidence=0.5)
+    assert report["held_out"] == 2 and report["accuracy"] == 1.0 and report["coverage"] == 1.0
+    assert evaluate(model, [], [])["accuracy"] is None
+
+
+def test_training_set_is_llm_answers_only():
+    ledger = Ledger(sqlite3.connect(':memory:', check_same_thread=False))
+    ledger.record('INBOX', 1, {1: {'category': 'Work', 'source': 'llm'},
+                               2: {'category': 'Work', 'source': 'nb'},
+                               3: {'category': 'Work', 'source': 'cache'},
+                               4: {'category': 'Promotion', 'source': 'rules'}})
+    assert llm_labelled_uids(ledger, 'INBOX', 1, per_label=10) == {1: 'Work', 3: 'Work'}
+    assert llm_labelled_uids(ledger, 'INBOX', 1, per_label=1) == {3: 'Work'}
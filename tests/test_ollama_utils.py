@@ -0,0 +1,74 @@
+# Tests for ModelResidency against a local stub of the Ollama HTTP API.
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ollama_utils import ModelResidency, OllamaClient
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    status = 200
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({"done": True} if self.status == 200 else {"error": "model not found"}).encode()
+        self.send_response(self.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_ollama():
+    """Start a stub server; yields a function setting its HTTP status and returning its port."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (_StubHandler,), {}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def configure(status):
+        server.RequestHandlerClass.status = status
+        return server.server_address[1]
+
+    yield configure
+    server.shutdown()
+    server.server_close()
+
+
+def _closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _residency(port):
+    return ModelResidency(model='missing', client=OllamaClient(port=port, timeout=2), manage_server=False)
+
+
+def test_acquire_loads_model(stub_ollama):
+    residency = _residency(stub_ollama(200))
+    assert residency.acquire() is True
+    assert residency.loaded
+    assert residency.stats()["loads"] == 1
+
+
+def test_acquire_survives_missing_model(stub_ollama):
+    residency = _residency(stub_ollama(404))
+    assert residency.acquire() is False
+    assert not residency.loaded
+    # hold() is used around whole rounds and must not raise either
+    with residency.hold():
+        pass
+    assert residency.stats()["loads"] == 0
+    assert residency.stats()["load_failures"] == 2
+
+
+def test_acquire_survives_refused_connection():
+    residency = _residency(_closed_port())
+    assert residency.acquire() is False
+    assert not residency.loaded
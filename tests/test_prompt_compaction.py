@@ -0,0 +1,32 @@
+# Tests for the body cleanup applied before the LLM prompt.
+from prompt_compaction import compact_body, estimate_tokens, truncate_tokens
+
+
+def test_quoted_reply_and_signature_removed():
+    body = ("Can we move the meeting to 3pm?\r\n\r\n"
+            "--\r\nAlice\r\n\r\n"
+            "On Mon, 1 Jan 2024, Bob <bob@example.com> wrote:\r\n> Meeting at 2pm\r\n")
+    assert compact_body(body, 100) == "Can we move the meeting to 3pm?"
+
+
+def test_chinese_quote_header():
+    body = "好的，周五见。\n\n在 2024年1月1日，张三 写道：\n之前的内容"
+    assert compact_body(body, 100) == "好的，周五见。"
+
+
+def test_footer_and_urls():
+    body = ("Your order has shipped: https://www.tracking.example/r?id=123&x=y\n"
+            "Unsubscribe | Privacy Policy\n"
+            "© 2024 Shop Inc. All rights reserved.\n")
+    assert compact_body(body, 100) == "Your order has shipped: <tracking.example>"
+
+
+def test_quote_only_body_falls_back_to_original():
+    assert compact_body("> forwarded text only", 100) == "> forwarded text only"
+
+
+def test_token_budget():
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("你好") == 2
+    assert truncate_tokens("word " * 100, 10) == ("word " * 8).strip()
+    assert len(compact_body("你" * 500, 50)) == 50
@@ -0,0 +1,44 @@
+# Tests for the compiled keyword rules of the fallback classifier.
+import re
+
+from rule_engine import compile_rules, match_rules, _trie_pattern
+
+RULES = [
+    {"category": "Security", "fields": {"subject": None, "body": 20}, "terms": ["login", "2fa"]},
+    {"category": "Opportunities", "fields": {"subject": None}, "terms": ["job", "job opening"]},
+    {"category": "Promotion", "fields": {"from": None, "subject": None}, "terms": ["sale", "no-reply@"]},
+]
+COMPILED = compile_rules(RULES)
+
+
+def _match(from_addr="", subject="", body=""):
+    return match_rules(from_addr, subject, body, compiled=COMPILED)
+
+
+def test_trie_pattern_matches_whole_words():
+    regex = re.compile(_trie_pattern(["job", "job opening", "jobs board"]))
+    assert [m.group() for m in regex.finditer("jobs, a job opening, jobless")] == ["jobs", "job opening"]
+
+
+def test_priority_and_plural():
+    assert _match(subject="big sale on login pages") == ("Security", "subject", "login")
+    assert _match(subject="sales today") == ("Promotion", "subject", "sale")
+    assert _match(subject="new job opening") == ("Opportunities", "subject", "job opening")
+    assert _match(subject="wholesale prices") is None
+
+
+def test_terms_ending_in_punctuation():
+    assert _match(from_addr="no-reply@shop.example") == ("Promotion", "from", "no-reply@")
+
+
+def test_body_limit():
+    assert _match(body="your 2fa code") == ("Security", "body", "2fa")
+    assert _match(body="x" * 30 + " 2fa") is None
+    # Fields the rule does not list are not searched
+    assert _match(body="sale") is None
+
+
+def test_default_rules():
+    assert match_rules("noreply@service.example", "", "") == ("Promotion", "from", "noreply@")
+    assert match_rules("alice@example.com", "interview invitation", "")[0] == "Opportunities"
+    assert match_rules("alice@example.com", "", "") is None
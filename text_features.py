@@ -0,0 +1,43 @@
+# text_features.py
+# Tokens of the sender, subject and start of the body, shared by the local (non-LLM) classifiers.
+import re
+import zlib
+from email.utils import parseaddr
+
+_WORD = re.compile(r"[a-z][a-z'’\-]+|[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+")
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]")
+_SUBJECT_PREFIX = re.compile(r'^\s*((re|fw|fwd|回复|转发)\s*[:：]\s*)+', re.IGNORECASE)
+
+
+def tokens(text: str) -> list:
+    """Lowercase words of two or more letters; CJK runs become character bigrams. Digits are dropped."""
+    out = []
+    for word in _WORD.findall((text or "").lower()):
+        if _CJK.match(word):
+            out.extend(word[i:i + 2] for i in range(max(1, len(word) - 1)))
+        else:
+            out.append(word.strip("'’-"))
+    return [t for t in out if t]
+
+
+def features(headers: dict, body: str, body_chars: int) -> list:
+    """
+    Feature strings for one message, prefixed by field: "a:" sender address and
+    "@domain" (plus display-name words), "s:" subject words, "b:" words of the
+    first body_chars characters of the body.
+    """
+    name, addr = parseaddr(headers.get("From", "") or "")
+    addr = addr.strip().lower()
+    feats = []
+    if "@" in addr:
+        feats.append("a:" + addr)
+        feats.append("a:@" + addr.rsplit("@", 1)[1])
+    feats.extend("a:" + t for t in tokens(name))
+    feats.extend("s:" + t for t in tokens(_SUBJECT_PREFIX.sub("", headers.get("Subject", "") or "")))
+    feats.extend("b:" + t for t in tokens((body or "")[:body_chars]))
+    return feats
+
+
+def feature_hash(feature: str) -> int:
+    """Stable 32-bit hash of a feature string (same value in every process and Python version)."""
+    return zlib.crc32(feature.encode("utf-8"))